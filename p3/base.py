@@ -2,9 +2,46 @@
 TODO
 """
 import os
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from nipype import Node,Workflow
-from nipype.interfaces.utility import IdentityInterface
+from nipype.interfaces.utility import IdentityInterface,Function
 from nipype.interfaces.io import DataSink
+from .command import node_threads
+from .metadata import write_manifest,select_metadata
+
+def compress_file(filename):
+    """
+        Gzip a file in place (filename -> filename.gz)
+    """
+
+    with open(filename,'rb') as f, gzip.open(filename+'.gz','wb',compresslevel=6) as g:
+        shutil.copyfileobj(f,g,1024*1024)
+    os.remove(filename)
+    return filename+'.gz'
+
+class CompressingDataSink(DataSink):
+    """DataSink that gzips the uncompressed NIfTI images it copies
+
+        Used when intermediates are written uncompressed, so images are only
+        compressed once, in output_dir. Images are compressed in parallel with
+        the threads given to the node.
+
+    """
+
+    def _list_outputs(self):
+        # copy the outputs
+        outputs = super()._list_outputs()
+
+        # compress the copied images
+        with ThreadPoolExecutor(max_workers=node_threads()) as pool:
+            outputs['out_file'] = list(pool.map(
+                lambda f: compress_file(f) if os.path.isfile(f) and f.endswith('.nii') else f,
+                outputs['out_file']))
+
+        # return outputs
+        return outputs
 
 class basenodedefs:
     """Base class for initializing nodes in workflow
@@ -13,9 +50,19 @@ class basenodedefs:
 
     """
     def __init__(self,settings):
+        # set the format of intermediate images (uncompressed images are compressed by the datasink)
+        if settings['compress_intermediates']:
+            self.outputtype = 'NIFTI_GZ'
+            self.ext = '.nii.gz'
+            sink = DataSink
+        else:
+            self.outputtype = 'NIFTI'
+            self.ext = '.nii'
+            sink = CompressingDataSink
+
         # Define datasink node
         self.datasink = Node(
-            DataSink(
+            sink(
                 base_directory=os.path.join(settings['output_dir']),
                 substitutions=[
                     ('_subject_','sub-')
@@ -42,6 +89,18 @@ class basenodedefs:
             name='output'
         )
 
+    def set_metadata(self,settings):
+        # select the manifest entries of the functional runs (see p3.metadata)
+        self.select_metadata = Node(
+            Function(
+                input_names=['func','manifest_dir'],
+                output_names=['metadata'],
+                function=select_metadata
+            ),
+            name='select_metadata'
+        )
+        self.select_metadata.inputs.manifest_dir = write_manifest(settings)
+
     def set_subs(self,sub_list):
         # append substitution list to substitutions
         self.datasink.inputs.substitutions.extend(sub_list)
@@ -0,0 +1,95 @@
+"""Remove intermediate files as soon as no running node needs them
+"""
+import os
+import glob
+from nipype import logging
+from nipype.pipeline.engine.utils import load_resultfile
+
+logger = logging.getLogger('nipype.workflow')
+
+def _paths(value):
+    # get all paths in an output value
+    if isinstance(value,(list,tuple)):
+        return [p for v in value for p in _paths(v)]
+    if isinstance(value,str) and os.path.isabs(value):
+        return [value]
+    return []
+
+class EagerCleanup:
+    """Delete the output files of nodes once all their consumers are done
+
+        A node is released when every node connected to its outputs (including
+        the DataSink copying them to output_dir) has finished. A file is deleted
+        when all nodes whose outputs point at it are released, so files passed
+        through by other nodes are kept until those are released too. Only files
+        under work_dir are deleted, and outputs of nodes without consumers are
+        kept.
+
+        Nipype bookkeeping (result and report files) is kept, but the hash files
+        of nodes that lost outputs are removed: when a crashed run is resumed,
+        those nodes are rerun if a node that still has to run needs them, rather
+        than being reported as up to date with missing files.
+
+    """
+
+    def __init__(self,work_dir):
+        self.work_dir = os.path.abspath(work_dir)
+        self._waiting = {} # node -> consumers that have not finished
+        self._holders = {} # file -> nodes with outputs pointing at it that are not released
+        self._owners = {} # file -> all nodes with outputs pointing at it
+        self._files = {} # node -> files its outputs point at
+
+    def node_finished(self,node,graph):
+        """
+            Record that a node of the execution graph finished
+        """
+
+        # record the files the outputs of the node point at (nodes without consumers are never released)
+        self._waiting[node] = set(graph.successors(node))
+        self._files[node] = self._output_files(node)
+        for filename in self._files[node]:
+            self._holders.setdefault(filename,set()).add(node)
+            self._owners.setdefault(filename,set()).add(node)
+
+        # release the nodes this node was the last consumer of
+        for producer in graph.predecessors(node):
+            waiting = self._waiting.get(producer)
+            if waiting is None:
+                continue
+            waiting.discard(node)
+            if not waiting:
+                self._release(producer)
+
+    def _output_files(self,node):
+        # read the outputs of the node from its result file
+        try:
+            result = load_resultfile(os.path.join(node.output_dir(),'result_{}.pklz'.format(node.name)))
+            outputs = result.outputs.get() if result.outputs else {}
+        except Exception:
+            return set()
+
+        # only files in the working directory are candidates
+        return {p for p in _paths(list(outputs.values())) if p.startswith(self.work_dir+os.sep) and os.path.isfile(p)}
+
+    def _release(self,node):
+        # delete the files no other node holds
+        del self._waiting[node]
+        stale = set()
+        for filename in self._files.pop(node):
+            holders = self._holders[filename]
+            holders.discard(node)
+            if holders:
+                continue
+            del self._holders[filename]
+            stale |= self._owners.pop(filename)
+            try:
+                os.remove(filename)
+                logger.debug('[EagerCleanup] Removed %s.',filename)
+            except OSError:
+                pass
+
+        # nodes that lost outputs must rerun when a resumed run needs them
+        for stale_node in stale:
+            for root,_,_ in os.walk(stale_node.output_dir()):
+                for hashfile in glob.glob(os.path.join(root,'_0x*.json')):
+                    os.remove(hashfile)
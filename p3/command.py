@@ -0,0 +1,96 @@
+"""Run external commands from custom functions
+"""
+import os
+import signal
+import subprocess
+from time import time,sleep
+from . import trace
+
+# environment variable holding the number of threads the running node was given
+THREADS_ENV = 'P3_NUM_THREADS'
+
+# log of the commands run by a node (written to the node directory)
+COMMAND_LOG = 'p3_commands.log'
+
+class CommandError(RuntimeError):
+    """Raised when a command fails or times out
+    """
+
+def node_threads():
+    """
+        Get the number of threads the running node was given (all cores if not set)
+    """
+
+    return int(os.environ.get(THREADS_ENV,os.cpu_count()))
+
+def thread_env(n_threads):
+    """
+        Get the environment variables setting the thread count of ANTs/ITK, AFNI and other OpenMP tools
+    """
+
+    return {
+        'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(n_threads),
+        'OMP_NUM_THREADS': str(n_threads)
+    }
+
+def _tail(filename,n_lines=20):
+    # get the last lines of a log
+    with open(filename,'r',errors='replace') as f:
+        return ''.join(f.readlines()[-n_lines:])
+
+def run_command(command,timeout=None,n_threads=None):
+    """
+        Run a shell command from a custom function
+
+        The command is run with the thread count of the node (n_threads overrides
+        it) and its output is appended to p3_commands.log in the node directory
+        instead of the console. The time and resources used by the command are
+        recorded in the p3 trace. A CommandError is raised if the command exits
+        with an error or runs longer than timeout seconds.
+    """
+
+    # set the thread count of the tools
+    env = dict(os.environ)
+    env.update(thread_env(n_threads if n_threads else node_threads()))
+
+    # print the command (its output goes to the log)
+    log_file = os.path.join(os.getcwd(),COMMAND_LOG)
+    print('{} (log: {})'.format(command,log_file))
+
+    # run the command in its own process group, so a timeout stops all of it
+    with open(log_file,'a') as log:
+        log.write('$ {}\n'.format(command))
+        log.flush()
+        start = time()
+        proc = subprocess.Popen(command,shell=True,stdout=log,stderr=subprocess.STDOUT,env=env,start_new_session=True)
+
+        # wait for the command (wait4 gives the resources used by the command alone)
+        timed_out = False
+        if timeout:
+            pid,status,usage = os.wait4(proc.pid,os.WNOHANG)
+            while not pid:
+                if time()-start > timeout:
+                    os.killpg(proc.pid,signal.SIGKILL)
+                    timed_out = True
+                    pid,status,usage = os.wait4(proc.pid,0)
+                    break
+                sleep(0.1)
+                pid,status,usage = os.wait4(proc.pid,os.WNOHANG)
+        else:
+            pid,status,usage = os.wait4(proc.pid,0)
+        end = time()
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    # record the command
+    trace.record('command',command.split()[0],start,end,
+        cpu_time=usage.ru_utime+usage.ru_stime,
+        peak_rss=usage.ru_maxrss*1024,
+        read=usage.ru_inblock*512,
+        written=usage.ru_oublock*512,
+        status='ok' if proc.returncode == 0 and not timed_out else 'failed')
+
+    # check the command ran successfully
+    if timed_out:
+        raise CommandError('Command timed out after {}s: {}\n{}'.format(timeout,command,_tail(log_file)))
+    if proc.returncode != 0:
+        raise CommandError('Command failed with exit code {}: {}\n{}'.format(proc.returncode,command,_tail(log_file)))
@@ -0,0 +1,98 @@
+"""Cache of the connected and sideloaded pipeline graph
+"""
+import os
+import sys
+import json
+import hashlib
+from nipype.utils.filemanip import loadpkl,savepkl
+from .registry import get_workflow
+from . import __version__
+
+# folder in tmp_dir holding the cached graphs
+GRAPH_CACHE_DIR = 'graph_cache'
+
+# settings that don't change the graph (how and where it runs)
+RUN_SETTINGS = {
+    'multiproc',
+    'n_procs',
+    'memory_gb',
+    'scheduler',
+    'subject_parallel',
+    'max_threads',
+    'disable_run',
+    'debug',
+    'rebuild_graph',
+    'graph_cache',
+    'graph_dir',
+    'graphs',
+    'graph_background',
+    'trace',
+    'trace_dir',
+    'hash_cache',
+    'result_cache',
+    'result_cache_dir',
+    'result_cache_size_gb',
+    'eager_cleanup'
+}
+
+def _source_files(path):
+    # get the python files of a package (or of the folder of a module)
+    if os.path.isfile(path):
+        path = os.path.dirname(path)
+    return sorted(os.path.join(root,f) for root,_,files in os.walk(path) for f in files if f.endswith('.py'))
+
+def graph_key(settings,fingerprint,imported_workflows=None):
+    """
+        Get the key of the graph built from settings for a dataset with the given layout fingerprint
+
+        The key covers the settings (except RUN_SETTINGS), the subjects, the
+        dataset (the node inputs hold its metadata), and the source of p3 and of
+        every workflow of the pipeline (imported_workflows may map names to
+        already imported workflow modules, as in generate_subworkflows).
+    """
+
+    # hash the source of p3 and of the workflows
+    imported_workflows = imported_workflows if imported_workflows else {}
+    files = set(_source_files(os.path.dirname(os.path.abspath(__file__))))
+    for name in settings['workflows']:
+        module = imported_workflows[name] if name in imported_workflows else sys.modules[get_workflow(name).__module__]
+        files.update(_source_files(module.__file__))
+    digest = hashlib.sha256(__version__.encode())
+    for filename in sorted(files):
+        with open(filename,'rb') as f:
+            digest.update(filename.encode()+b'\n'+f.read())
+
+    # hash the settings and dataset
+    graph_settings = {key: value for key,value in settings.items() if key not in RUN_SETTINGS}
+    digest.update(json.dumps([graph_settings,fingerprint],sort_keys=True,default=str).encode())
+    return digest.hexdigest()
+
+def cache_file(settings,key):
+    """
+        Get the file the graph with the given key is cached in
+    """
+
+    return os.path.join(settings['tmp_dir'],GRAPH_CACHE_DIR,'{}.pklz'.format(key))
+
+def load_graph(filename):
+    """
+        Load a cached graph (None if there is none or it can't be read)
+    """
+
+    if not os.path.exists(filename):
+        return None
+    try:
+        return loadpkl(filename)
+    except Exception:
+        return None
+
+def save_graph(graph,filename):
+    """
+        Cache a graph
+    """
+
+    # write the graph (moved into place, so an interrupted write is never loaded)
+    os.makedirs(os.path.dirname(filename),exist_ok=True)
+    tmp_file = '{}.{}.pklz'.format(filename[:-len('.pklz')],os.getpid())
+    savepkl(tmp_file,graph)
+    os.replace(tmp_file,filename)
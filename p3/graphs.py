@@ -0,0 +1,131 @@
+"""Write the graphs of the pipeline and its workflows, optionally in a background process
+"""
+import os
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from nipype import Workflow,MapNode,logging
+
+logger = logging.getLogger('nipype.workflow')
+
+# graphs that can be written (json is a description of the flat graph, the others are graphviz images)
+GRAPH_TYPES = ['json','flat','colored']
+
+def _field(field):
+    # get the name of a connected field (source fields may be (field,function,args) tuples)
+    return field if isinstance(field,str) else field[0]
+
+def graph_description(workflow):
+    """
+        Describe the flat graph of a workflow (nodes and the links between them) as a dictionary that can be saved as JSON
+
+        .. code:: python
+
+            {
+                'name': 'p3_pipeline',
+                'nodes': [{'id': 'p3_pipeline.p3_skullstrip.input', 'workflow': 'p3_pipeline.p3_skullstrip',
+                           'name': 'input', 'interface': 'IdentityInterface', 'mapnode': False, 'iterables': []}, ...],
+                'edges': [{'source': ..., 'target': ..., 'links': [['output_field','input_field'], ...]}, ...]
+            }
+    """
+
+    # flatten the workflow (nodes of subworkflows become nodes of the graph)
+    graph = workflow._create_flat_graph()
+
+    # describe nodes
+    nodes = []
+    for node in sorted(graph.nodes(),key=lambda n: n.fullname):
+        iterables = node.iterables if node.iterables else []
+        nodes.append({
+            'id': node.fullname,
+            'workflow': node.fullname.rsplit('.',1)[0] if '.' in node.fullname else '',
+            'name': node.name,
+            'interface': type(node.interface).__name__,
+            'mapnode': isinstance(node,MapNode),
+            'iterables': [field for field,_ in (iterables.items() if isinstance(iterables,dict) else iterables)]
+        })
+
+    # describe edges
+    edges = []
+    for source,dest,data in graph.edges(data=True):
+        edges.append({
+            'source': source.fullname,
+            'target': dest.fullname,
+            'links': [[_field(source_field),dest_field] for source_field,dest_field in data['connect']]
+        })
+    edges.sort(key=lambda e: (e['source'],e['target']))
+
+    return {'name': workflow.name,'nodes': nodes,'edges': edges}
+
+def write_graphs(workflow,graph_dir,graphs):
+    """
+        Write the graphs of a workflow to graph_dir/<workflow name>, and those of each of its subworkflows
+
+        graphs is a list of GRAPH_TYPES: json writes graph.json (see
+        graph_description), flat and colored write graphviz images.
+    """
+
+    # the workflow and its subworkflows
+    workflows = [workflow]+sorted((n for n in workflow._graph.nodes() if isinstance(n,Workflow)),key=lambda n: n.name)
+    for wf in workflows:
+        wf_dir = os.path.join(graph_dir,'p3' if wf is workflow else wf.name)
+        if 'json' in graphs:
+            os.makedirs(wf_dir,exist_ok=True)
+            with open(os.path.join(wf_dir,'graph.json'),'w') as f:
+                json.dump(graph_description(wf),f,indent=4)
+        if 'flat' in graphs:
+            wf.write_graph(os.path.join(wf_dir,'graph.dot'),graph2use='flat',simple_form=False)
+        if 'colored' in graphs:
+            wf.write_graph(os.path.join(wf_dir,'graph.dot'),graph2use='colored')
+
+def _write_pickled_graphs(pickled_workflow,graph_dir,graphs):
+    # write the graphs of a pickled workflow (run in the background process)
+    write_graphs(pickle.loads(pickled_workflow),graph_dir,graphs)
+
+class GraphWriter:
+    """Write the graphs of a workflow while it runs
+
+        The workflow is pickled when the writer is started, so later changes
+        (e.g. running it) don't affect the graphs. In the background the graphs
+        are written by a separate process; failures (e.g. graphviz not being
+        installed) are logged and don't stop the pipeline.
+
+    """
+
+    def __init__(self,workflow,graph_dir,graphs,background=True):
+        self.workflow = workflow
+        self.graph_dir = graph_dir
+        self.graphs = graphs
+        self.background = background
+        self._pool = None
+        self._future = None
+
+    def start(self):
+        """
+            Start writing the graphs (returns once they are written when not in the background)
+        """
+
+        if not self.graphs:
+            return self
+        if self.background:
+            self._pool = ProcessPoolExecutor(max_workers=1)
+            self._future = self._pool.submit(_write_pickled_graphs,pickle.dumps(self.workflow),self.graph_dir,self.graphs)
+        else:
+            try:
+                write_graphs(self.workflow,self.graph_dir,self.graphs)
+            except Exception as err:
+                logger.warning('[GraphWriter] Could not write the graphs to %s: %s',self.graph_dir,err)
+        return self
+
+    def wait(self):
+        """
+            Wait for the graphs to be written
+        """
+
+        if self._future:
+            try:
+                self._future.result()
+            except Exception as err:
+                logger.warning('[GraphWriter] Could not write the graphs to %s: %s',self.graph_dir,err)
+            self._pool.shutdown()
+            self._future = None
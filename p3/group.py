@@ -0,0 +1,138 @@
+"""Group level summaries of the motion (FD) outputs of participant level runs
+"""
+import os
+import re
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# folder in output_dir the group outputs are written to
+GROUP_DIR = 'p3_group'
+
+# BIDS entities of the run columns of the tables
+ENTITIES = {'sub': 'subject','ses': 'session','task': 'task','acq': 'acquisition','run': 'run'}
+
+def _entities(name):
+    # get the BIDS entities of a file name
+    found = dict(re.findall(r'(?:^|_)({})-([a-zA-Z0-9]+)'.format('|'.join(ENTITIES)),name))
+    return {column: found.get(key) for key,column in ENTITIES.items()}
+
+def _walk(path):
+    # find the FD files in a folder
+    return [os.path.join(root,f) for root,_,files in os.walk(path) for f in files
+            if f.endswith('.FD') and not f.endswith('_filtered.FD')]
+
+def find_fd_files(output_dir,subjects=None,n_threads=8):
+    """
+        Find the runs with FD outputs in output_dir/p3, returns the file name of each run without the .FD extension
+
+        Subject folders (only those of the given subject labels, if any) are
+        walked in parallel.
+    """
+
+    root = os.path.join(output_dir,'p3')
+    if not os.path.isdir(root):
+        return []
+    subject_dirs = [entry.path for entry in os.scandir(root) if entry.is_dir() and entry.name.startswith('sub-')
+                    and (not subjects or entry.name[len('sub-'):] in subjects)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        files = [f for found in pool.map(_walk,subject_dirs) for f in found]
+    return sorted(f[:-len('.FD')] for f in files)
+
+def _load_run(prefix):
+    # load the FD, tmask, filtered FD and filtered tmask of a run (from its .npz file if there is one)
+    if os.path.exists(prefix+'_FD.npz'):
+        with np.load(prefix+'_FD.npz') as arrays:
+            return [arrays[name].astype(float) for name in ['FD','tmask','filt_FD','filt_tmask']]
+    columns = []
+    for suffix in ['.FD','.tmask','_filtered.FD','_filtered.tmask']:
+        columns.append(np.loadtxt(prefix+suffix,ndmin=1) if os.path.exists(prefix+suffix) else None)
+    return [column if column is not None else np.full(columns[0].shape,np.nan) for column in columns]
+
+def load_fd_table(prefixes,n_threads=8):
+    """
+        Load the FD outputs of runs (see find_fd_files) into one table with a row per frame
+
+        The columns are name (the file name of the run), the BIDS entities
+        (subject, session, task, acquisition and run), frame, FD, tmask,
+        filt_FD and filt_tmask. Filtered columns are NaN for runs without
+        filtered outputs.
+    """
+
+    # load the runs in parallel
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        runs = list(pool.map(_load_run,prefixes))
+
+    # build the columns
+    lengths = np.array([run[0].shape[0] for run in runs],dtype=int)
+    names = [os.path.basename(prefix) for prefix in prefixes]
+    table = {'name': pd.Categorical(np.repeat(names,lengths),categories=names)}
+    entities = [_entities(name) for name in names]
+    for column in ENTITIES.values():
+        table[column] = pd.Categorical(np.repeat(np.array([e[column] for e in entities],dtype=object),lengths))
+    table['frame'] = np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths,lengths)
+    for n,column in enumerate(['FD','tmask','filt_FD','filt_tmask']):
+        table[column] = np.concatenate([run[n] for run in runs]) if runs else np.array([])
+    return pd.DataFrame(table)
+
+def run_summary(table):
+    """
+        Summarize each run of a table of load_fd_table
+
+        Gives the number of frames, the number of retained (tmask) and
+        censored frames, the fraction of frames retained, and the mean, median
+        and maximum FD, for the raw and filtered FD.
+    """
+
+    groups = table.groupby('name',observed=True,sort=False)
+    summary = groups[list(ENTITIES.values())].first()
+    summary['frames'] = groups.size()
+    for prefix in ['','filt_']:
+        summary[prefix+'retained'] = groups[prefix+'tmask'].sum(min_count=1)
+        summary[prefix+'censored'] = summary['frames']-summary[prefix+'retained']
+        summary[prefix+'retention'] = summary[prefix+'retained']/summary['frames']
+        summary[prefix+'mean_FD'] = groups[prefix+'FD'].mean()
+        summary[prefix+'median_FD'] = groups[prefix+'FD'].median()
+        summary[prefix+'max_FD'] = groups[prefix+'FD'].max()
+    return summary.reset_index()
+
+def subject_summary(summary):
+    """
+        Summarize each subject of a run_summary (totals over the runs, and the mean FD over all frames)
+    """
+
+    totals = summary.assign(
+        FD_sum=summary['mean_FD']*summary['frames'],
+        filt_FD_sum=summary['filt_mean_FD']*summary['frames']
+    ).groupby('subject',observed=True)
+    subjects = totals[['frames','retained','censored','filt_retained','filt_censored']].sum(min_count=1)
+    subjects.insert(0,'runs',totals.size())
+    subjects['retention'] = subjects['retained']/subjects['frames']
+    subjects['filt_retention'] = subjects['filt_retained']/subjects['frames']
+    subjects['mean_FD'] = totals['FD_sum'].sum()/subjects['frames']
+    subjects['filt_mean_FD'] = totals['filt_FD_sum'].sum(min_count=1)/subjects['frames']
+    return subjects.reset_index()
+
+def run_group(output_dir,subjects=None,n_threads=8):
+    """
+        Summarize the motion of all runs in output_dir, writes motion_runs.tsv and motion_subjects.tsv to output_dir/p3_group
+
+        Only the given subject labels are summarized, if any. Returns the run
+        summary.
+    """
+
+    # load all runs
+    prefixes = find_fd_files(output_dir,subjects,n_threads)
+    if not prefixes:
+        print('No FD outputs found in {}.'.format(os.path.join(output_dir,'p3')))
+        return None
+    table = load_fd_table(prefixes,n_threads)
+
+    # write summaries
+    group_dir = os.path.join(output_dir,GROUP_DIR)
+    os.makedirs(group_dir,exist_ok=True)
+    summary = run_summary(table)
+    summary.to_csv(os.path.join(group_dir,'motion_runs.tsv'),sep='\t',index=False,na_rep='n/a')
+    subject_summary(summary).to_csv(os.path.join(group_dir,'motion_subjects.tsv'),sep='\t',index=False,na_rep='n/a')
+    print('Summarized the motion of {} runs ({} frames) in {}.'.format(len(summary),len(table),group_dir))
+    return summary
@@ -0,0 +1,130 @@
+"""Persistent cache of file content hashes
+"""
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from nipype.interfaces.base import specs,support
+from nipype.utils import filemanip
+
+# the nipype hash function the cache wraps
+_hash_infile = filemanip.hash_infile
+
+class HashCache:
+    """Content hashes of files keyed on (device, inode, size, mtime_ns)
+
+        A file is only read again when one of these changes, so content hashing
+        stays correct while each file is read once per change instead of once
+        per node per run. Hashes are appended to a journal file (one JSON entry
+        per line), so several processes can share the cache safely; threads of
+        a process share it through a lock.
+
+    """
+
+    def __init__(self,cache_file):
+        # initialize the cache
+        self.cache_file = cache_file
+        self._hashes = {}
+        self._offset = 0
+        self._inode = None
+        self._lock = threading.Lock()
+
+        # compact the journal, then load it
+        with self._lock:
+            self._compact()
+            self._refresh()
+
+    def _refresh(self):
+        # read entries appended to the journal since the last read (call with the lock held)
+        if not os.path.exists(self.cache_file):
+            return
+        with open(self.cache_file,'rb') as f:
+            # start over when another process compacted the journal
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._inode:
+                self._inode = inode
+                self._offset = 0
+            f.seek(self._offset)
+            for line in f:
+                # stop at an entry that is still being written
+                if not line.endswith(b'\n'):
+                    break
+
+                # every complete line is consumed, even one that can't be parsed
+                self._offset += len(line)
+                try:
+                    key,md5 = json.loads(line.decode())
+                except ValueError:
+                    continue
+                self._hashes[tuple(key)] = md5
+
+    def _compact(self):
+        # rewrite the journal without superseded entries (call with the lock held)
+        if not os.path.exists(self.cache_file):
+            return
+        self._refresh()
+        tmp_file = '{}.{}'.format(self.cache_file,os.getpid())
+        with open(tmp_file,'w') as f:
+            for key,md5 in self._hashes.items():
+                f.write(json.dumps([key,md5])+'\n')
+        os.replace(tmp_file,self.cache_file)
+        self._offset = os.path.getsize(self.cache_file)
+        self._inode = os.stat(self.cache_file).st_ino
+
+    def hash_infile(self,afile,chunk_len=8192,crypto=hashlib.md5,raise_notfound=False):
+        """
+            Drop-in replacement for nipype.utils.filemanip.hash_infile
+        """
+
+        # only md5 hashes of existing files are cached
+        if crypto is not hashlib.md5 or not os.path.isfile(afile):
+            return _hash_infile(afile,chunk_len=chunk_len,crypto=crypto,raise_notfound=raise_notfound)
+
+        # look up the file (another process may have hashed it already)
+        st = os.stat(afile)
+        key = (st.st_dev,st.st_ino,st.st_size,st.st_mtime_ns)
+        with self._lock:
+            if key not in self._hashes:
+                self._refresh()
+            if key in self._hashes:
+                return self._hashes[key]
+
+        # hash the file (outside the lock, so threads hash in parallel) and append it to the journal
+        md5 = _hash_infile(afile,chunk_len=1024*1024,crypto=crypto)
+        with self._lock:
+            self._hashes[key] = md5
+            with open(self.cache_file,'a') as f:
+                f.write(json.dumps([key,md5])+'\n')
+        return md5
+
+    def prime(self,files,n_threads=8):
+        """
+            Hash files in parallel so nodes find their hashes in the cache
+        """
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(self.hash_infile,files))
+
+def install_hash_cache(cache_file):
+    """
+        Make nipype content hashing go through a persistent hash cache
+
+        Worker processes forked by the MultiProc plugin inherit the cache.
+    """
+
+    # create the cache and route nipype hashing through it
+    cache = HashCache(cache_file)
+    for module in (specs,support,filemanip):
+        module.hash_infile = cache.hash_infile
+
+    # return the cache
+    return cache
+
+def uninstall_hash_cache():
+    """
+        Restore the nipype hash function
+    """
+
+    for module in (specs,support,filemanip):
+        module.hash_infile = _hash_infile
@@ -0,0 +1,293 @@
+"""Index of the BIDS dataset shared by all nodes, runs and the command line
+"""
+import os
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import bids
+import nibabel
+from bids.grabbids import BIDSLayout
+
+# environment variable holding the location of the stored indexes
+LAYOUT_ENV = 'P3_LAYOUT_DIR'
+
+# environment variable holding the index validated at the start of the run (worker processes trust it)
+INDEX_ENV = 'P3_BIDS_INDEX'
+
+# environment variable holding folders (separated by os.pathsep) left out of the dataset fingerprint
+EXCLUDE_ENV = 'P3_LAYOUT_EXCLUDE'
+
+# top level folders of a dataset that are not part of the raw data (left out of the fingerprint)
+FINGERPRINT_SKIP = {'derivatives','sourcedata'}
+
+# version of the index format (stored indexes of other versions are rebuilt)
+INDEX_VERSION = 2
+
+# field map types (only phasediff maps are used by the pipeline)
+FIELDMAP_TYPES = '(phase1|phasediff|epi|fieldmap)'
+
+# indexes loaded by this process
+_indexes = {}
+
+def default_layout_dir():
+    """
+        Get the default index location ($P3_LAYOUT_DIR or ~/.cache/p3/layouts)
+    """
+
+    return os.environ.get(LAYOUT_ENV,os.path.join(os.path.expanduser('~'),'.cache','p3','layouts'))
+
+def index_file(bids_dir):
+    """
+        Get the file the index of a dataset is stored in
+    """
+
+    name = hashlib.sha256(os.path.abspath(bids_dir).encode()).hexdigest()[:16]
+    return os.path.join(default_layout_dir(),'{}.pkl'.format(name))
+
+def scan_files(path,root,exclude=()):
+    """
+        Get the path (relative to root), size and modification time of every file under path
+
+        Hidden files and folders, and folders in exclude (absolute paths), are skipped.
+    """
+
+    entries = []
+    for entry in os.scandir(path):
+        if entry.name.startswith('.') or entry.path in exclude:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            entries.extend(scan_files(entry.path,root,exclude))
+        else:
+            stat = entry.stat()
+            entries.append('{} {} {}'.format(os.path.relpath(entry.path,root),stat.st_size,stat.st_mtime_ns))
+    return entries
+
+def fingerprint_exclude():
+    """
+        Get the folders left out of the dataset fingerprint (see validate_layout)
+    """
+
+    return {os.path.abspath(path) for path in os.environ.get(EXCLUDE_ENV,'').split(os.pathsep) if path}
+
+def dataset_fingerprint(bids_dir,n_threads=8,exclude=None):
+    """
+        Get a fingerprint of the files in a dataset (changes when a file is added, removed or modified)
+
+        Only file metadata is read, and the top level folders (subjects) are
+        scanned in parallel. The derivatives and sourcedata folders, hidden
+        entries and the folders in exclude (by default those of
+        fingerprint_exclude, e.g. an output_dir inside the dataset) are left
+        out, so p3's own outputs don't change the fingerprint.
+    """
+
+    # scan the top level, then each folder under it
+    bids_dir = os.path.abspath(bids_dir)
+    exclude = fingerprint_exclude() if exclude is None else {os.path.abspath(path) for path in exclude}
+    folders = []
+    entries = []
+    for entry in os.scandir(bids_dir):
+        if entry.name.startswith('.') or entry.name in FINGERPRINT_SKIP or entry.path in exclude:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            folders.append(entry.path)
+        else:
+            stat = entry.stat()
+            entries.append('{} {} {}'.format(entry.name,stat.st_size,stat.st_mtime_ns))
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for folder_entries in pool.map(lambda folder: scan_files(folder,bids_dir,exclude),folders):
+            entries.extend(folder_entries)
+
+    # hash the sorted entries (and the pybids and index versions, which determine the index format)
+    digest = hashlib.sha256('{} {}'.format(bids.__version__,INDEX_VERSION).encode())
+    for entry in sorted(entries):
+        digest.update(entry.encode()+b'\n')
+    return digest.hexdigest()
+
+def afni_orientation(image):
+    """
+        Get the orientation code of an image as reported by 3dinfo -orient (None if the header can't be read)
+    """
+
+    # nibabel gives the direction each axis points to, afni the direction it starts from
+    opposite = {'R':'L','L':'R','A':'P','P':'A','S':'I','I':'S'}
+    try:
+        return ''.join(opposite[code] for code in nibabel.aff2axcodes(nibabel.load(image).affine))
+    except Exception:
+        return None
+
+class BIDSIndex:
+    """BIDS layout of a dataset with the metadata of every image read up front
+
+        Behaves like a pybids BIDSLayout; get_metadata is answered from the
+        sidecars read when the index was built, instead of reading the json
+        files of the image again. The field map of every functional run is
+        resolved when the index is built (see get_fieldmap_entry).
+
+    """
+
+    def __init__(self,bids_dir,fingerprint,n_threads=8):
+        # build the layout
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.fingerprint = fingerprint
+        self.layout = BIDSLayout(self.bids_dir)
+
+        # read the metadata of every image in parallel
+        images = [f.filename for f in self.layout.get() if f.filename.endswith(('.nii','.nii.gz'))]
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            self.metadata = dict(zip(images,pool.map(self.layout.get_metadata,images)))
+
+        # pair each functional run with its field map
+        self.fieldmaps = self._index_fieldmaps(n_threads)
+
+    def _index_fieldmaps(self,n_threads):
+        # get the field maps of each subject and session
+        intended = {}
+        sessions = {}
+        fieldmaps = self.layout.get(type=FIELDMAP_TYPES,extensions=['nii.gz','nii'])
+        for fieldmap in fieldmaps:
+            sessions.setdefault(fieldmap.subject,{}).setdefault(getattr(fieldmap,'session',None),[]).append(fieldmap)
+
+            # runs listed in IntendedFor (paths relative to the subject folder)
+            targets = self.metadata.get(fieldmap.filename,{}).get('IntendedFor',[])
+            for target in [targets] if isinstance(targets,str) else targets:
+                intended[os.path.join(self.bids_dir,'sub-{}'.format(fieldmap.subject),target)] = fieldmap
+
+        # read the orientation of the phasediff maps in parallel
+        phasediffs = sorted({f.filename for f in fieldmaps if f.type == 'phasediff'})
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            orientations = dict(zip(phasediffs,pool.map(afni_orientation,phasediffs)))
+
+        # resolve the field map of each functional run
+        index = {}
+        for run in self.layout.get(type='bold',extensions=['nii.gz','nii']):
+            # use IntendedFor if defined
+            fieldmap = intended.get(run.filename)
+            guessed = fieldmap is None
+
+            # otherwise guess: the only field map of the subject, or the (last) field map of the session of the run
+            if guessed:
+                subject = sessions.get(run.subject,{})
+                candidates = [f for s in subject.values() for f in s]
+                if len(candidates) != 1:
+                    candidates = subject.get(getattr(run,'session',None),[])
+                fieldmap = sorted(candidates,key=lambda f: f.filename)[-1] if candidates else None
+            if fieldmap is None:
+                continue
+
+            # only phasediff maps are used; other types are recorded so the pipeline can report them
+            if fieldmap.type != 'phasediff':
+                index[run.filename] = {'type': fieldmap.type,'guessed': guessed}
+                continue
+
+            # get the effective echo time of the phasediff (None without both echo times; reported
+            # when the field map is used) and the first magnitude image
+            metadata = self.metadata[fieldmap.filename]
+            echo1,echo2 = metadata.get('EchoTime1'),metadata.get('EchoTime2')
+            index[run.filename] = {
+                'type': 'phasediff',
+                'phasediff': fieldmap.filename,
+                'magnitude': fieldmap.filename.replace('phasediff','magnitude1'),
+                'TE': abs(echo2 - echo1)*1000 if echo1 is not None and echo2 is not None else None,
+                'orientation': orientations[fieldmap.filename],
+                'guessed': guessed
+            }
+
+        # return the field map of each run
+        return index
+
+    def get_fieldmap_entry(self,path):
+        """
+            Get the field map of a functional run (None if it has none)
+
+            Returns a dictionary with the type of the field map and, for phasediff
+            maps, the phasediff and magnitude images, the TE difference (ms, None
+            if the sidecar lacks EchoTime1 or EchoTime2), the
+            orientation of the phasediff image (None if it could not be read) and
+            whether the pairing was guessed because IntendedFor is not defined.
+        """
+
+        entry = self.fieldmaps.get(os.path.abspath(path))
+        return dict(entry) if entry else None
+
+    def get_metadata(self,path,**kwargs):
+        """
+            Get the metadata of an image
+        """
+
+        # images outside the index (or other options) go to pybids
+        path = os.path.abspath(path)
+        if kwargs or path not in self.metadata:
+            return self.layout.get_metadata(path,**kwargs)
+        return dict(self.metadata[path])
+
+    def __getattr__(self,name):
+        # everything else is answered by the layout
+        if name == 'layout':
+            raise AttributeError(name)
+        return getattr(self.layout,name)
+
+def _read_index(filename):
+    # load a stored index (None if missing or unreadable)
+    try:
+        with open(filename,'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+def _write_index(index,filename):
+    # store the index (written to a temporary file and moved into place, so readers never see a partial index)
+    try:
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+        tmp_file = '{}.{}'.format(filename,os.getpid())
+        with open(tmp_file,'wb') as f:
+            pickle.dump(index,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file,filename)
+    except OSError:
+        pass
+
+def load_layout(bids_dir):
+    """
+        Get the index of a dataset
+
+        The index is built once and stored on disk with a fingerprint of the
+        dataset; it is rebuilt only when files under bids_dir change. Processes
+        of a run that validated the index (see validate_layout) load it without
+        checking the dataset again.
+    """
+
+    # check the index validated for this run
+    bids_dir = os.path.abspath(bids_dir)
+    filename = index_file(bids_dir)
+    trusted = os.environ.get(INDEX_ENV) == filename
+    if trusted and bids_dir in _indexes:
+        return _indexes[bids_dir]
+
+    # load the index from this process or the disk
+    fingerprint = None if trusted else dataset_fingerprint(bids_dir)
+    index = _indexes.get(bids_dir)
+    if index is None or index.fingerprint != fingerprint:
+        index = _read_index(filename)
+
+    # rebuild a missing or outdated index
+    if index is None or index.bids_dir != bids_dir or (fingerprint and index.fingerprint != fingerprint):
+        index = BIDSIndex(bids_dir,fingerprint if fingerprint else dataset_fingerprint(bids_dir))
+        _write_index(index,filename)
+
+    # keep the index for later calls
+    _indexes[bids_dir] = index
+    return index
+
+def validate_layout(bids_dir,exclude=()):
+    """
+        Bring the index of a dataset up to date and let nodes of this run use it without checking the dataset
+
+        Folders in exclude (e.g. the output and working directories) are left
+        out of the dataset fingerprint, in this and later calls.
+    """
+
+    # check the dataset and point worker processes at the index
+    os.environ.pop(INDEX_ENV,None)
+    os.environ[EXCLUDE_ENV] = os.pathsep.join(os.path.abspath(path) for path in exclude if path)
+    index = load_layout(bids_dir)
+    os.environ[INDEX_ENV] = index_file(bids_dir)
+    return index
@@ -0,0 +1,141 @@
+"""Acquisition parameters of the functional runs, resolved once when the pipeline is built
+"""
+import os
+import re
+import json
+import hashlib
+from nipype import logging
+from .layout import load_layout
+from .utility import get_subject_files
+
+logger = logging.getLogger('nipype.workflow')
+
+# sidecar fields the nodes use
+MANIFEST_FIELDS = [
+    'RepetitionTime',
+    'SliceTiming',
+    'EffectiveEchoSpacing',
+    'PhaseEncodingDirection'
+]
+
+# folder in tmp_dir the per subject manifest files are written to
+MANIFEST_DIR = 'manifest'
+
+# manifests built by this process
+_manifests = {}
+
+def find_fieldmap(layout,epi_file,reported=None):
+    """
+        Find the field map of an epi image (None if there isn't one)
+
+        Field maps are paired with runs through the "IntendedFor" field in the json sidecar of the field map
+        (See section 8.3.5 of the BIDS spec). When it is not defined, the field map is guessed when the layout
+        index is built; guesses are logged once per field map (reported holds the ones already logged).
+    """
+
+    # get the field map from the layout index
+    fieldmap = layout.get_fieldmap_entry(epi_file)
+
+    # report guessed field maps, so they can be checked
+    if fieldmap is None or fieldmap['guessed']:
+        name = fieldmap.get('phasediff',fieldmap['type']) if fieldmap else None
+        if reported is None or (epi_file if name is None else name) not in reported:
+            if name is None:
+                logger.warning('[Fieldmap] IntendedFor is undefined for %s and no field map could be guessed.',epi_file)
+            else:
+                logger.warning('[Fieldmap] IntendedFor is undefined for %s; guessed %s as its field map. You should verify this is correct.',
+                    epi_file,name)
+            if reported is not None:
+                reported.add(epi_file if name is None else name)
+
+    # return the field map
+    return fieldmap
+
+def build_manifest(settings):
+    """
+        Get the acquisition parameters and field map of every functional run being processed
+
+        Returns a dictionary mapping each functional image to its MANIFEST_FIELDS
+        and field map. The manifest is built from the layout index, once per
+        dataset and query; write_manifest splits it by subject for the
+        select_metadata nodes.
+    """
+
+    # reuse the manifest while the dataset and selection are unchanged
+    layout = load_layout(settings['bids_dir'])
+    key = json.dumps([
+        layout.bids_dir,
+        layout.fingerprint,
+        settings['subject'],
+        settings['bids_query'],
+        settings['field_map_correction']
+    ],sort_keys=True,default=str)
+    if key in _manifests:
+        return _manifests[key]
+
+    # resolve the parameters of each run
+    manifest = {}
+    reported = set()
+    for epi in get_subject_files(settings).get('func',[]):
+        metadata = layout.get_metadata(epi)
+        manifest[epi] = {field: metadata.get(field) for field in MANIFEST_FIELDS}
+        manifest[epi]['fieldmap'] = find_fieldmap(layout,epi,reported) if settings['field_map_correction'] else None
+
+    # keep the manifest for the other workflows
+    _manifests[key] = manifest
+    return manifest
+
+def write_manifest(settings):
+    """
+        Write the manifest as one file per subject (sub-<label>.json), returns the folder holding them
+
+        The folder (in tmp_dir/manifest) is named after the hash of the
+        manifest, so it changes when any entry changes, while each subject's
+        select_metadata node only loads and hashes the entries of its own runs.
+    """
+
+    # split the manifest by subject
+    subjects = {}
+    for epi,entry in build_manifest(settings).items():
+        found = re.search(r'(?:^|_)sub-([a-zA-Z0-9]+)',os.path.basename(epi))
+        subjects.setdefault(found.group(1) if found else '',{})[epi] = entry
+    text = {subject: json.dumps(entries,sort_keys=True,default=str) for subject,entries in subjects.items()}
+
+    # write the files of the subjects (once per manifest)
+    digest = hashlib.sha1(json.dumps(text,sort_keys=True).encode()).hexdigest()[:16]
+    manifest_dir = os.path.join(settings['tmp_dir'],MANIFEST_DIR,digest)
+    os.makedirs(manifest_dir,exist_ok=True)
+    for subject,entries in text.items():
+        filename = os.path.join(manifest_dir,'sub-{}.json'.format(subject))
+        if not os.path.exists(filename):
+            with open(filename+'.{}.tmp'.format(os.getpid()),'w') as f:
+                f.write(entries)
+            os.replace(filename+'.{}.tmp'.format(os.getpid()),filename)
+    return manifest_dir
+
+def select_metadata(func,manifest_dir):
+    """
+        Get the manifest entries of the functional runs of a subject (in the order of func)
+
+        Entries are loaded from the subject files of write_manifest.
+    """
+    import os
+    import re
+    import json
+
+    # load the entries of the subjects of the runs
+    manifest = {}
+    for epi in func:
+        found = re.search(r'(?:^|_)sub-([a-zA-Z0-9]+)',os.path.basename(epi))
+        filename = os.path.join(manifest_dir,'sub-{}.json'.format(found.group(1) if found else ''))
+        if epi not in manifest and os.path.exists(filename):
+            with open(filename) as f:
+                manifest.update(json.load(f))
+
+    # check every run was resolved
+    missing = [f for f in func if f not in manifest]
+    if missing:
+        raise ValueError('No metadata was resolved for {}. Is it selected by the bids query?'.format(missing))
+
+    # return the entries
+    return [manifest[f] for f in func]
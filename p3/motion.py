@@ -0,0 +1,157 @@
+"""Framewise displacement (FD) and tmasks of motion parameters, computed for all runs at once
+"""
+import math
+import numpy as np
+
+# arrays stored in the .npz file of each run (see write_fd)
+FD_ARRAYS = ['moco','FD','tmask','filt_moco','filt_FD','filt_tmask']
+
+def load_motion(files):
+    """
+        Load motion parameter files (one row of 6 parameters per frame, rotations in degrees first)
+    """
+
+    return [np.loadtxt(f,ndmin=2) for f in files]
+
+def respiration_iirnotch(TR_in_sec,bpm_min=18.582,bpm_max=25.7263):
+    """
+        Calculate the parameters of the IIR notch respiration filter for a TR (in seconds)
+
+        Breathing rates are in breaths per minute. Returns the filter
+        coefficients b,a.
+    """
+    from scipy import signal
+
+    fs = 1.0/TR_in_sec  # Sampling frequency (Hz)
+    fn = fs/2.0         # Nyquist frequency (Hz)
+
+    # RR MIN
+    rr_min = bpm_min/60.0                              # respiration rate minimum in Hz
+    fa_min = abs(rr_min-math.floor((rr_min+fn)/fs)*fs) # Aliased minimum frequency (Hz)
+    w0_min = fa_min/fn                                 # Normalized minimum frequency
+
+    # RR MAX
+    rr_max = bpm_max/60.0                              # respiration rate maximum in Hz
+    fa_max = abs(rr_max-math.floor((rr_max+fn)/fs)*fs) # Aliased maximum frequency (Hz)
+    w0_max = fa_max/fn                                 # Normalized maximum frequency
+
+    # RR iirnotch filter
+    w0 = np.mean([w0_min,w0_max])      # Mean normalized frequency
+    bw = abs(w0_max-w0_min)            # Normalized bandwidth
+    Q = w0/bw                          # Quality factor
+    b,a = signal.iirnotch(w0,Q)        # Filter design
+
+    return b,a
+
+def filter_motion(runs,TRs,bpm_min,bpm_max):
+    """
+        Filter the respiration out of the motion parameters of each run
+
+        The notch filter is applied forward and backward twice (4th order).
+        Runs with the same TR and number of frames are filtered together.
+    """
+    from scipy import signal
+
+    # group the runs by TR and length
+    groups = {}
+    for n,(run,TR) in enumerate(zip(runs,TRs)):
+        groups.setdefault((float(TR),run.shape[0]),[]).append(n)
+
+    # filter each group as one (runs x frames x parameters) array
+    filtered = [None]*len(runs)
+    for (TR,_),members in groups.items():
+        b,a = respiration_iirnotch(TR,bpm_min,bpm_max)
+        stack = np.stack([runs[n] for n in members])
+        stack = signal.filtfilt(b,a,signal.filtfilt(b,a,stack,axis=1,padtype=None),axis=1,padtype=None)
+        for n,run in zip(members,stack):
+            filtered[n] = run
+    return filtered
+
+def framewise_displacement(runs,brain_radius,rotations=slice(0,3)):
+    """
+        Calculate the FD of each run (sum of absolute frame to frame parameter changes, 0 for the first frame)
+
+        The rotations columns (None for parameters already in mm) are converted
+        from degrees to mm of arc on a sphere of brain_radius mm. All runs are
+        computed in one pass over their concatenated parameters.
+    """
+
+    if not runs:
+        return []
+
+    # concatenate the runs and convert the rotations to mm
+    lengths = [run.shape[0] for run in runs]
+    params = np.concatenate(runs,axis=0).astype(float)
+    if rotations is not None:
+        params[:,rotations] *= brain_radius*math.pi/180
+
+    # difference consecutive frames (restarting at the first frame of each run)
+    FD = np.zeros(params.shape[0])
+    FD[1:] = np.abs(np.diff(params,axis=0)).sum(axis=1)
+    FD[np.cumsum([0]+lengths[:-1])] = 0
+    return np.split(FD,np.cumsum(lengths)[:-1])
+
+def calc_fd(runs,TRs,brain_radius,threshold,filtered_threshold,bpm_min,bpm_max):
+    """
+        Calculate the raw and respiration filtered FD and tmasks of runs of motion parameters
+
+        Returns a dictionary with a list of one array per run for each of
+        FD_ARRAYS (moco being the unfiltered parameters). Frames are kept in the
+        tmask when their FD is below the threshold.
+    """
+
+    results = {'moco': runs}
+
+    # raw FD
+    results['FD'] = framewise_displacement(runs,brain_radius)
+    results['tmask'] = [(FD<threshold).astype(np.uint8) for FD in results['FD']]
+
+    # filtered FD (the filtered parameters keep converting columns 4 and 5 to mm, as p3 always has)
+    filt_moco = filter_motion(runs,TRs,bpm_min,bpm_max)
+    for run in filt_moco:
+        run[:,4:7] *= brain_radius*math.pi/180
+    results['filt_moco'] = filt_moco
+    results['filt_FD'] = framewise_displacement(filt_moco,brain_radius,rotations=None)
+    results['filt_tmask'] = [(FD<filtered_threshold).astype(np.uint8) for FD in results['filt_FD']]
+
+    return results
+
+def _write_column(filename,values):
+    # write one value per line
+    with open(filename,'w') as f:
+        f.write(''.join('{}\n'.format(v) for v in values.tolist()))
+
+def write_fd(basename,results,run):
+    """
+        Write the FD outputs of a run of calc_fd to text files and one .npz file starting with basename
+
+        Writes <basename>.FD, .tmask, _filtered.1D, _filtered.FD,
+        _filtered.tmask and _FD.npz (holding FD_ARRAYS); returns the file names
+        in this order.
+    """
+
+    files = ['{}{}'.format(basename,suffix) for suffix in ['.FD','.tmask','_filtered.1D','_filtered.FD','_filtered.tmask','_FD.npz']]
+    _write_column(files[0],results['FD'][run])
+    _write_column(files[1],results['tmask'][run])
+    with open(files[2],'w') as f:
+        f.write(''.join('{}\n'.format(' '.join(str(v) for v in row)) for row in results['filt_moco'][run].tolist()))
+    _write_column(files[3],results['filt_FD'][run])
+    _write_column(files[4],results['filt_tmask'][run])
+    np.savez_compressed(files[5],**{name: results[name][run] for name in FD_ARRAYS})
+    return files
+
+def load_fd(npz_files):
+    """
+        Load the .npz files of many runs into one table for group QC
+
+        Returns a dictionary of FD_ARRAYS concatenated over the runs, with
+        'run' holding the index (in npz_files) of the run of each frame.
+    """
+
+    table = {name: [] for name in FD_ARRAYS+['run']}
+    for n,filename in enumerate(npz_files):
+        with np.load(filename) as arrays:
+            for name in FD_ARRAYS:
+                table[name].append(arrays[name])
+        table['run'].append(np.full(table['FD'][-1].shape[0],n))
+    return {name: np.concatenate(arrays,axis=0) if arrays else np.array([]) for name,arrays in table.items()}
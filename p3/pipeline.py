@@ -1,12 +1,27 @@
-import inspect
+from concurrent.futures import ProcessPoolExecutor,as_completed
 from nipype import Workflow,config,logging
-from .base import workflowgenerator
+from .registry import get_workflow,find_generator
+from .resources import assign_node_resources,plugin_args
+from .scheduler import P3MultiProcPlugin
+from .hashcache import install_hash_cache
+from .resultcache import open_result_store,default_cache_dir
+from .trace import start_trace,stop_trace,write_trace,NodeTracer
+from .utility import set_atlas_path,get_subject_files
+from .layout import validate_layout
+from .graphcache import graph_key,cache_file,load_graph,save_graph
+from .graphs import GraphWriter
 from shutil import copy2
 import os
 
-def create_and_run_p3_workflow(imported_workflows,settings):
+logger = logging.getLogger('nipype.workflow')
+
+def create_and_run_p3_workflow(imported_workflows,settings,validation=None):
     """
         Create main workflow
+
+        A BIDSValidation started before the call (see p3.validator) keeps
+        running while the pipeline is built; it is waited on, and its report
+        printed, before the pipeline runs.
     """
 
     # Set nipype debug messages if enabled
@@ -19,97 +34,244 @@ def create_and_run_p3_workflow(imported_workflows,settings):
     config.set('execution','stop_on_first_crash','true')
     logging.update_logging(config)
 
-    # define subworkflows from imported workflows
-    subworkflows = generate_subworkflows(imported_workflows,settings)
+    # index the dataset once; nodes query the index instead of the dataset
+    layout = validate_layout(settings['bids_dir'],exclude=[settings['output_dir'],settings['tmp_dir']])
+
+    # load the graph built by an earlier run with the same settings, workflows and dataset
+    p3 = None
+    if settings['graph_cache']:
+        graph_file = cache_file(settings,graph_key(settings,layout.fingerprint,imported_workflows))
+        if not settings.get('rebuild_graph',False):
+            p3 = load_graph(graph_file)
+        if p3:
+            print('Loaded the pipeline graph from {}.'.format(graph_file))
+
+    # build the graph
+    if p3 is None:
+        # define subworkflows from imported workflows
+        subworkflows = generate_subworkflows(imported_workflows,settings)
+
+        # create a workflow
+        p3 = Workflow(name='p3_pipeline',base_dir=settings['tmp_dir'])
 
-    # create a workflow
-    p3 = Workflow(name='p3_pipeline',base_dir=settings['tmp_dir'])
+        # get connections
+        connections = generate_connections(subworkflows,settings)
 
-    # get connections
-    connections = generate_connections(subworkflows,settings)
+        # connect nodes
+        p3.connect(connections)
 
-    # connect nodes
-    p3.connect(connections)
+        # apply sideloads
+        sideload_nodes(p3,connections,settings)
 
-    # apply sideloads
-    sideload_nodes(p3,connections,settings)
+        # cache the graph for later runs
+        if settings['graph_cache']:
+            save_graph(p3,graph_file)
 
-    # Create graph images
-    p3.write_graph(os.path.join(settings['output_dir'],'graph','p3'),graph2use='flat',simple_form=False)
-    p3.write_graph(os.path.join(settings['output_dir'],'graph','p3'),graph2use='colored')
+    # finish the dataset validation (and print its report) before anything runs
+    if validation:
+        validation.wait()
 
-    # copy the grpah files to the output directory
-    # copy2(os.path.join(settings['tmp_dir'],'p3_pipeline','graph.png'),settings['output_dir'])
-    # copy2(os.path.join(settings['tmp_dir'],'p3_pipeline','graph_detailed.png'),settings['output_dir'])
+    # write the graphs of the pipeline and its workflows (in the background while the pipeline runs)
+    graph_dir = settings.get('graph_dir',os.path.join(settings['output_dir'],'graph'))
+    graphs = GraphWriter(p3,graph_dir,settings['graphs'],settings['graph_background'] and not settings['disable_run']).start()
 
     # Run pipeline (check multiproc setting)
-    if not settings['disable_run']:
-        if settings['multiproc']:
-            p3.run(plugin='MultiProc')
-        else:
-            p3.run()
+    if settings['disable_run']:
+        return
+    try:
+        if settings['hash_cache']:
+            # hash the inputs once up front; nodes reuse the hashes until the files change
+            cache = install_hash_cache(os.path.join(settings['tmp_dir'],'hash_cache.json'))
+            inputs = [f for files in get_subject_files(settings).values() for f in files]
+            cache.prime(inputs+[set_atlas_path(settings['atlas'])])
+        if settings['trace']:
+            # record the time and resources used by each node and command
+            trace_dir = settings.get('trace_dir',os.path.join(settings['output_dir'],'trace'))
+            start_trace(os.path.join(trace_dir,'events'))
+        try:
+            if settings['multiproc']:
+                # size each node from the data and pack nodes into the machine budget
+                assign_node_resources(p3,settings)
+                # order ready nodes with the selected scheduler (node durations are kept next to tmp_dir)
+                args = plugin_args(settings)
+                args['scheduler'] = settings['scheduler']
+                args['max_threads'] = settings['max_threads']
+                # delete intermediates as soon as their consumers are done
+                if settings['eager_cleanup']:
+                    args['cleanup_dir'] = settings['tmp_dir']
+                args['history_file'] = os.path.join(settings['tmp_dir'],'node_durations.json')
+                # reuse results of expensive nodes from any earlier run on this machine (if the store can be written)
+                if settings['result_cache']:
+                    args['result_store'] = open_result_store(
+                        settings['result_cache_dir'] if settings['result_cache_dir'] else default_cache_dir(),
+                        settings['result_cache_size_gb'])
+                p3.run(plugin=P3MultiProcPlugin(plugin_args=args))
+            elif settings['trace']:
+                p3.run(plugin='Linear',plugin_args={'status_callback': NodeTracer()})
+            else:
+                p3.run()
+        finally:
+            # write the trace (also when the pipeline crashed)
+            if settings['trace']:
+                stop_trace()
+                write_trace(os.path.join(trace_dir,'events'),trace_dir)
+    finally:
+        # wait for the graphs
+        graphs.wait()
+
+def run_subjects_sharded(settings,validation=None):
+    """
+        Run each subject as its own pipeline in a pool of processes
+
+        Instead of expanding every subject into one iterables graph, a small
+        graph is built and run per subject. settings['subject_parallel']
+        subjects are processed at once, and the settings['n_procs'] core and
+        settings['memory_gb'] memory budgets are split evenly between them. A
+        crashing subject does not stop the others; the labels of failed
+        subjects are returned. A running BIDSValidation is waited on before
+        the subjects start.
+    """
+
+    # finish the dataset validation (and print its report) before anything runs
+    if validation:
+        validation.wait()
+
+    # split the core and memory budget over the concurrently running subjects
+    n_shards = max(1,min(settings['subject_parallel'],len(settings['subject'])))
+    procs_per_subject = max(1,settings['n_procs']//n_shards)
+    memory_per_subject = settings['memory_gb']/n_shards
+
+    # submit a pipeline for each subject
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_shards) as pool:
+        futures = {}
+        for subject in settings['subject']:
+            # each shard gets a copy of the settings restricted to its subject
+            shard_settings = dict(settings)
+            shard_settings['subject'] = [subject]
+            shard_settings['n_procs'] = procs_per_subject
+            shard_settings['memory_gb'] = memory_per_subject
+            shard_settings['graph_dir'] = os.path.join(settings['output_dir'],'graph','sub-{}'.format(subject))
+            shard_settings['trace_dir'] = os.path.join(settings['output_dir'],'trace','sub-{}'.format(subject))
+            futures[pool.submit(_run_subject,shard_settings)] = subject
+
+        # collect results as subjects finish
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                future.result()
+                print('Subject {} finished.'.format(subject))
+            except Exception as err:
+                print('Subject {} failed: {}'.format(subject,err))
+                failed.append(subject)
+
+    # return the subjects that did not complete
+    return sorted(failed)
+
+def _run_subject(settings):
+    """
+        Build and run the pipeline for a single subject (runs in a worker process)
+    """
+
+    # construct and execute workflow (workflows are looked up in the registry)
+    create_and_run_p3_workflow(None,settings)
+
+def connection_index(p3):
+    """
+        Index the connections of the pipeline by their destination (workflow,node,field)
+
+        Each entry lists the (workflow,source,source field,destination,destination field)
+        connections feeding the field, with workflow being the graph to disconnect them in:
+        the pipeline for connections between workflows and the subworkflow for connections
+        inside it.
+    """
+
+    index = {}
+    for source,dest,data in p3._graph.edges(data=True):
+        # connections between workflows (the destination field is node.field of the subworkflow)
+        for source_field,dest_field in data['connect']:
+            node,field = dest_field.rsplit('.',1)
+            index.setdefault((dest.name,node,field),[]).append((p3,source,source_field,dest,dest_field))
+    for workflow in p3._graph.nodes():
+        # connections inside each workflow
+        if not isinstance(workflow,Workflow):
+            continue
+        for source,dest,data in workflow._graph.edges(data=True):
+            for source_field,dest_field in data['connect']:
+                index.setdefault((workflow.name,dest.name,dest_field),[]).append((workflow,source,source_field,dest,dest_field))
+    return index
+
+def validate_sideloads(p3,settings):
+    """
+        Check that the workflow, node and input field of every sideload exist
+
+        All problems are reported at once in a ValueError.
+    """
+
+    errors = []
+    for sideload in settings['sideload']:
+        nodename = '{}.{}'.format(sideload['workflow'],sideload['node'])
+        node = p3.get_node(nodename) if p3.get_node(sideload['workflow']) else None
+        if node is None:
+            errors.append('unknown node {}'.format(nodename))
+        elif sideload['input'][0] not in node.inputs.copyable_trait_names():
+            errors.append('node {} has no input {} (inputs: {})'.format(
+                nodename,sideload['input'][0],', '.join(sorted(node.inputs.copyable_trait_names()))))
+    if errors:
+        raise ValueError('Invalid sideloads:\n{}'.format('\n'.join(errors)))
 
 def sideload_nodes(p3,connections,settings):
     """
         Sideload values into nodes
+
+        The sideloads are validated first, then applied in one pass over an
+        index of the pipeline connections: each sideloaded field is set and the
+        connections feeding it are removed.
     """
+
+    # check all sideloads before changing the graph
+    validate_sideloads(p3,settings)
+
+    # index the connections once
+    index = connection_index(p3)
+
     # loop over sideload list and set the input for the node
     for sideload in settings['sideload']:
-        # construct the node name
+        field,value = sideload['input']
         nodename = '{}.{}'.format(sideload['workflow'],sideload['node'])
-        # set the input for the selected field
-        p3.get_node(nodename).set_input(sideload['input'][0],sideload['input'][1])
-
-        # get edge list for the entire pipeline
-        edge_list = p3._graph.edges
-        # find edges of the destination node whose input we are overriding
-        edge_dest = [edge for edge in edge_list if edge[1].name == sideload['workflow']]
-        for edge in edge_dest:
-            edge_data = p3._graph.get_edge_data(*edge) # get edge data
-            # check if the connection contains the field we are trying to replace
-            for connection in edge_data['connect']:
-                # disconnect the nodes if it is the field we are replacing
-                if connection[1] == '{}.{}'.format(sideload['node'],sideload['input'][0]):
-                    p3.disconnect(edge[0],connection[0],edge[1],connection[1])
-                    print('Disconnect: {}'.format((edge[0].name,connection[0],edge[1].name,connection[1])))
-
-        # get the edge list for the workflow
-        edge_list = p3.get_node(sideload['workflow'])._graph.edges
-        # find edges of the destination node whose input we are overriding
-        edge_dest = [edge for edge in edge_list if edge[1].name == sideload['node']]
-        # loop through each edge pair and check if the field we are side loading exists with that pair
-        for edge in edge_dest:
-            edge_data = p3.get_node(sideload['workflow'])._graph.get_edge_data(*edge) # get edge data
-            # check if the connection contains the field we are trying to replace
-            for connection in edge_data['connect']:
-                # disconnect the nodes if it is the field we are replacing
-                if connection[1] == '{}'.format(sideload['input'][0]):
-                    p3.get_node(sideload['workflow']).disconnect(edge[0],connection[0],edge[1],connection[1])
-                    print('Disconnect: {}'.format((edge[0].name,connection[0],edge[1].name,connection[1])))
-
-        # print sideload status
-        print('\nSideload Status for node {}.{}:'.format(sideload['workflow'],sideload['node']))
-        print(p3.get_node('{}.{}'.format(sideload['workflow'],sideload['node'])).inputs)
+        p3.get_node(nodename).set_input(field,value)
+
+        # disconnect the connections feeding the field we are replacing
+        disconnected = []
+        for workflow,source,source_field,dest,dest_field in index.pop((sideload['workflow'],sideload['node'],field),[]):
+            workflow.disconnect(source,source_field,dest,dest_field)
+            disconnected.append('{}.{}'.format(source.name,source_field))
+
+        # report sideload status
+        logger.info('[Sideload] %s.%s = %s (disconnected: %s)',nodename,field,value,
+            ', '.join(disconnected) if disconnected else 'none')
+        logger.debug('[Sideload] %s inputs:\n%s',nodename,p3.get_node(nodename).inputs)
 
 def generate_subworkflows(imported_workflows,settings):
     """
-        TODO: document this function
+        Create the workflows listed in settings['workflows']
+
+        The generator class of each workflow is looked up in the workflow
+        registry (see p3.registry); imported_workflows may map names to already
+        imported workflow modules instead (None looks up every workflow).
     """
 
     # create sub-workflows
     subworkflows = {}
-    # loop over all imported workflows
-    for name,wf in imported_workflows.items():
-        # find the class whos base is the workflowgenerator
-        for obj in dir(wf):
-            if inspect.isclass(getattr(wf,obj)): # check if object is class
-                # the object is a workflowgenerator object
-                if getattr(wf,obj).__bases__[0] == workflowgenerator:
-                    # create and assign the workflow to the dictionary
-                    subworkflows[name] = getattr(wf,obj)(name,settings)
-                    # write out the graphs for each subworkflow
-                    subworkflows[name].write_graph(os.path.join(settings['output_dir'],'graph',name),graph2use='flat',simple_form=False)
-                    subworkflows[name].write_graph(os.path.join(settings['output_dir'],'graph',name),graph2use='colored')
+    imported_workflows = imported_workflows if imported_workflows else {}
+    for name in settings['workflows']:
+        # get the generator class of the workflow
+        if name in imported_workflows:
+            generator = find_generator(imported_workflows[name])
+        else:
+            generator = get_workflow(name)
+        # create and assign the workflow to the dictionary
+        subworkflows[name] = generator(name,settings)
 
     # return subworkflows
     return subworkflows
@@ -124,6 +286,11 @@ def generate_connections(subworkflows,settings):
 
     # go through connections in settings and build connections list
     for connection_entry in settings['connections']:
+        # check both ends are workflows of the pipeline
+        for name in (connection_entry['source'],connection_entry['destination']):
+            if name not in subworkflows:
+                get_workflow(name) # raises if the workflow is unknown
+                raise ValueError('Workflow "{}" is used in settings[\'connections\'] but not listed in settings[\'workflows\'].'.format(name))
         # append to connections list
         connections.append(( # define tuple
             subworkflows[connection_entry['source']],
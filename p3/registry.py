@@ -0,0 +1,103 @@
+"""Registry mapping workflow names to their workflow generator classes
+"""
+import importlib
+
+# entry point group other packages register their workflows under (name = module:class)
+ENTRY_POINT_GROUP = 'p3.workflows'
+
+# workflows shipped with p3 (imported when they are used)
+BUILTIN_WORKFLOWS = {
+    'p3_bidsselector': 'p3.workflows.p3_bidsselector.workflow:bidsselectorworkflow',
+    'p3_freesurfer': 'p3.workflows.p3_freesurfer.workflow:freesurferworkflow',
+    'p3_skullstrip': 'p3.workflows.p3_skullstrip.workflow:skullstripworkflow',
+    'p3_stcdespikemoco': 'p3.workflows.p3_stcdespikemoco.workflow:stcdespikemocoworkflow',
+    'p3_fieldmapcorrection': 'p3.workflows.p3_fieldmapcorrection.workflow:fieldmapcorrectionworkflow',
+    'p3_alignanattoatlas': 'p3.workflows.p3_alignanattoatlas.workflow:alignanattoatlasworkflow',
+    'p3_alignfunctoanat': 'p3.workflows.p3_alignfunctoanat.workflow:alignfunctoanatworkflow',
+    'p3_alignfunctoatlas': 'p3.workflows.p3_alignfunctoatlas.workflow:alignfunctoatlasworkflow',
+    'p3_create_fs_masks': 'p3.workflows.p3_create_fs_masks.workflow:createfsmasksworkflow'
+}
+
+# workflows registered with register_workflow
+_registry = {}
+
+def register_workflow(name):
+    """
+        Class decorator registering a workflow generator under name
+
+        .. code:: python
+
+            @register_workflow('customworkflow')
+            class customworkflow(workflowgenerator):
+                ...
+    """
+
+    def register(cls):
+        _registry[name] = cls
+        return cls
+    return register
+
+def _entry_point(name):
+    # find a workflow another package registered under the entry point group (only the match is loaded)
+    try:
+        from importlib.metadata import entry_points
+        group = entry_points()
+        group = group.select(group=ENTRY_POINT_GROUP) if hasattr(group,'select') else group.get(ENTRY_POINT_GROUP,[])
+    except ImportError:
+        from pkg_resources import iter_entry_points
+        group = iter_entry_points(ENTRY_POINT_GROUP)
+    for entry_point in group:
+        if entry_point.name == name:
+            return entry_point.load()
+    return None
+
+def _load(path):
+    # import a module:class path
+    module,cls = path.split(':')
+    return getattr(importlib.import_module(module),cls)
+
+def find_generator(module):
+    """
+        Find the workflow generator class defined in a workflow module (None if there isn't one)
+    """
+
+    from p3.base import workflowgenerator
+    for obj in vars(module).values():
+        if isinstance(obj,type) and obj.__bases__[0] == workflowgenerator:
+            return obj
+    return None
+
+def get_workflow(name):
+    """
+        Get the workflow generator class of a workflow
+
+        Looks in order at workflows registered with register_workflow, the
+        workflows shipped with p3, workflows other packages registered under the
+        p3.workflows entry point group, and finally imports the workflow.py
+        module of a workflow folder on sys.path (see the --workflows option).
+        Only the module of the requested workflow is imported.
+    """
+
+    # registered and built-in workflows
+    if name in _registry:
+        return _registry[name]
+    if name in BUILTIN_WORKFLOWS:
+        _registry[name] = _load(BUILTIN_WORKFLOWS[name])
+        return _registry[name]
+
+    # workflows of other packages
+    cls = _entry_point(name)
+
+    # workflow folders on sys.path (registered on import, or found by their base class)
+    if cls is None:
+        try:
+            module = importlib.import_module('{}.workflow'.format(name))
+        except ImportError as err:
+            raise ValueError('Unknown workflow "{}": it is not registered and could not be imported ({}).'.format(name,err))
+        cls = _registry.get(name) or find_generator(module)
+        if cls is None:
+            raise ValueError('Workflow module {} does not define a workflowgenerator class.'.format(module.__name__))
+
+    # keep the class for later lookups
+    _registry[name] = cls
+    return cls
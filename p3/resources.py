@@ -0,0 +1,176 @@
+"""Estimate cpu and memory requirements of pipeline nodes
+"""
+import nibabel
+from nipype.utils.profiler import get_system_total_memory_gb
+from .utility import set_atlas_path,get_subject_files
+
+# memory model for known nodes: (image the node works on, single precision copies held in memory)
+#   func: a native space functional run (voxels x frames)
+#   func_atlas: a functional run resampled to the atlas (atlas extent at func resolution x frames)
+#   func3d: a single frame of a functional run
+#   anat: an anatomical image
+# displacement fields count as 3 copies (one per vector component)
+NODE_MEMORY = {
+    # p3_bidsselector
+    'alignanattoanat': ('anat',4),
+    'avganat': ('anat',4),
+    # p3_freesurfer
+    'recon1': ('anat',16),
+    'reconall': ('anat',32),
+    # p3_skullstrip
+    'afni_skullstrip': ('anat',8),
+    'fsl_skullstrip': ('anat',4),
+    'biasfieldcorrect': ('anat',8),
+    # p3_stcdespikemoco
+    'despike': ('func',4),
+    'tshift': ('func',3),
+    'despike_tshift': ('func',2),
+    'moco_before': ('func',3),
+    'moco': ('func',6),
+    'extractroi': ('func',1),
+    'extractroi_post': ('func',1),
+    # p3_fieldmapcorrection
+    'avg_epi': ('func',2),
+    'applyantsunwarp': ('func3d',8),
+    'realign': ('func3d',8),
+    'combine_transforms': ('func3d',8),
+    # p3_alignanattoatlas
+    'atlasregister': ('anat',24),
+    # p3_alignfunctoanat
+    'align_func_2_anat': ('anat',12),
+    # p3_alignfunctoatlas
+    'format_reference': ('func_atlas',2),
+    'combinetransforms': ('func_atlas',4),
+    'applytransforms': ('func_atlas',9),
+    # p3_create_fs_masks
+    'align_fs_2_anat': ('anat',12),
+}
+
+# nodes whose tools are multithreaded and should get settings['num_threads'] cores
+THREADED_NODES = {
+    'recon1',
+    'reconall',
+    '3dallineate_orig',
+    '3dallineate_brainmask',
+    'despike',
+    'tshift',
+    'despike_tshift',
+    'biasfieldcorrect',
+    'moco',
+    'applyantsunwarp',
+    'applyantsunwarprefimg',
+    'realign',
+    'combine_transforms',
+    'atlasregister',
+    'align_func_2_anat',
+    'combinetransforms',
+    'create_dfnd_mask',
+    'applytransforms',
+    'align_fs_2_anat'
+}
+
+# memory every node is given on top of its image estimate (GB)
+BASE_MEMORY_GB = 0.25
+
+def system_memory_gb():
+    """
+        Get the memory p3 is allowed to use on this machine (90% of total)
+    """
+
+    return get_system_total_memory_gb()*0.9
+
+def image_footprint(filename):
+    """
+        Get the voxels, frames, bytes per voxel and voxel volume of an image
+
+        Only the image header is read. Bytes per voxel are at least 4 since the
+        tools p3 calls work on single (or double) precision data.
+    """
+
+    # read the header
+    header = nibabel.load(filename).header
+    shape = header.get_data_shape()
+    zooms = header.get_zooms()
+
+    # return the footprint
+    return {
+        'voxels': int(shape[0]*shape[1]*shape[2]),
+        'frames': int(shape[3]) if len(shape) > 3 else 1,
+        'itemsize': max(header.get_data_dtype().itemsize,4),
+        'voxel_volume': float(zooms[0]*zooms[1]*zooms[2])
+    }
+
+def dataset_footprints(settings):
+    """
+        Get the largest image sizes (in GB) the pipeline works on for the selected subjects
+    """
+
+    # query the dataset for the subjects being processed
+    files = get_subject_files(settings)
+    func = files.get('func',[])
+    anat = files.get('anat',[])
+
+    # get the atlas volume (mm^3) so we can size images resampled to the atlas
+    atlas = image_footprint(set_atlas_path(settings['atlas']))
+    atlas_volume = atlas['voxels']*atlas['voxel_volume']
+
+    # find the largest image of each kind (unreadable images are skipped)
+    footprints = {'func': 0.0,'func_atlas': 0.0,'func3d': 0.0,'anat': 0.0}
+    for filename in func:
+        try:
+            fp = image_footprint(filename)
+        except (nibabel.filebasedimages.ImageFileError,OSError):
+            continue
+        frame_gb = fp['voxels']*fp['itemsize']/1024**3
+        atlas_frame_gb = atlas_volume/fp['voxel_volume']*fp['itemsize']/1024**3
+        footprints['func'] = max(footprints['func'],frame_gb*fp['frames'])
+        footprints['func3d'] = max(footprints['func3d'],frame_gb)
+        footprints['func_atlas'] = max(footprints['func_atlas'],atlas_frame_gb*fp['frames'])
+    for filename in anat:
+        try:
+            fp = image_footprint(filename)
+        except (nibabel.filebasedimages.ImageFileError,OSError):
+            continue
+        footprints['anat'] = max(footprints['anat'],fp['voxels']*fp['itemsize']*fp['frames']/1024**3)
+
+    # return the image sizes
+    return footprints
+
+def assign_node_resources(p3,settings):
+    """
+        Set n_procs and mem_gb on every node of the pipeline
+
+        Memory is estimated from the dimensions of the images each node works on,
+        cpus from whether the node runs a multithreaded tool. Both are capped to
+        the machine budget so no single node is refused by the scheduler.
+    """
+
+    # get image sizes for this dataset
+    footprints = dataset_footprints(settings)
+
+    # set the requirements of each node
+    for node in p3._get_all_nodes():
+        # threaded tools get the configured thread count
+        if node.name in THREADED_NODES:
+            node.n_procs = min(settings['num_threads'],settings['n_procs'])
+
+        # datasinks compress uncompressed intermediates in parallel
+        if node.name == 'datasink' and not settings['compress_intermediates']:
+            node.n_procs = min(settings['num_threads'],settings['n_procs'])
+
+        # estimate memory from the image the node works on
+        if node.name in NODE_MEMORY:
+            image,copies = NODE_MEMORY[node.name]
+            mem_gb = BASE_MEMORY_GB+footprints[image]*copies
+            node._mem_gb = min(mem_gb,settings['memory_gb'])
+
+def plugin_args(settings):
+    """
+        Get the MultiProc plugin arguments for the machine budget
+    """
+
+    return {
+        'n_procs': settings['n_procs'],
+        'memory_gb': settings['memory_gb'],
+        'raise_insufficient': False
+    }
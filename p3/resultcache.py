@@ -0,0 +1,302 @@
+"""Content-addressed store of node results shared by all p3 runs on a machine
+"""
+import os
+import json
+import shutil
+import hashlib
+import nipype
+from nipype import logging
+from nipype.utils import filemanip
+from nipype.utils.filemanip import loadpkl,savepkl
+from nipype.interfaces.base import isdefined
+from nipype.pipeline.engine.utils import save_hashfile,save_resultfile
+from nipype.pipeline.plugins.multiproc import run_node
+from . import __version__
+
+logger = logging.getLogger('nipype.workflow')
+
+# expensive nodes whose results are stored
+CACHED_NODES = {
+    'recon1',
+    'reconall',
+    'afni_skullstrip',
+    'biasfieldcorrect',
+    'despike',
+    'despike_tshift',
+    'moco',
+    'atlasregister',
+    'align_func_2_anat',
+    'combinetransforms',
+    'applytransforms',
+    'align_fs_2_anat'
+}
+
+# inputs nipype hashes that don't change the result of a node (output locations and thread counts);
+# inputs nipype doesn't hash (nohash, e.g. environ and num_threads) are left out as well
+UNHASHED_INPUTS = {
+    'subjects_dir',
+    'openmp',
+    'parallel'
+}
+
+# nipype bookkeeping files that are written again on restore
+BOOKKEEPING_FILES = ['_0x*.json','_inputs.pklz','_node.pklz','_report','result_*.pklz']
+
+def default_cache_dir():
+    """
+        Get the default store location ($P3_CACHE_DIR or ~/.cache/p3/results)
+    """
+
+    return os.environ.get('P3_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.cache','p3','results'))
+
+def _hash_value(value):
+    # replace files with their content hash; everything else is hashed as is
+    if isinstance(value,(list,tuple)):
+        return [_hash_value(v) for v in value]
+    if isinstance(value,dict):
+        return {k: _hash_value(v) for k,v in sorted(value.items())}
+    if isinstance(value,str) and os.path.isfile(value):
+        return ['file',filemanip.hash_infile(value)]
+    return value
+
+def _rebase(value,roots):
+    # move paths under the old roots to the new roots
+    if isinstance(value,(list,tuple)):
+        return type(value)(_rebase(v,roots) for v in value)
+    if isinstance(value,str):
+        for old,new in roots.items():
+            if value == old or value.startswith(old+os.sep):
+                return new+value[len(old):]
+    return value
+
+def _paths(value):
+    # get all absolute paths in an output value
+    if isinstance(value,(list,tuple)):
+        return [p for v in value for p in _paths(v)]
+    if isinstance(value,str) and os.path.isabs(value):
+        return [value]
+    return []
+
+def _subject_dir(node):
+    # freesurfer nodes write their results to subjects_dir/subject_id
+    inputs = node.inputs.get_traitsfree()
+    if 'subjects_dir' in inputs and 'subject_id' in inputs:
+        return os.path.join(inputs['subjects_dir'],inputs['subject_id'])
+    return None
+
+class ResultStore:
+    """Node results keyed on interface, content hash of inputs and tool version
+
+        Each entry holds a copy of the node directory (and, for freesurfer nodes,
+        the subject directory) with the node outputs. Entries are written to a
+        temporary directory and renamed into place, so concurrent runs can share
+        the store. Entries are evicted least recently used first when the store
+        grows past max_size_gb.
+
+    """
+
+    def __init__(self,cache_dir,max_size_gb):
+        # create the store
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        os.makedirs(cache_dir,exist_ok=True)
+
+    def node_key(self,node):
+        """
+            Get the key of a node (its upstream inputs must be available)
+        """
+
+        # fetch upstream outputs and hash the inputs by content
+        node._get_inputs()
+        nohash = set(node.inputs.traits(nohash=True))
+        inputs = {name: value for name,value in node.inputs.get_traitsfree().items()
+                  if name not in UNHASHED_INPUTS and name not in nohash}
+
+        # get the version of the tool the interface calls (if it reports one)
+        interface = node.interface
+        try:
+            version = interface.version
+        except Exception:
+            version = None
+
+        # hash everything that determines the result
+        key = [
+            '{}.{}'.format(interface.__module__,interface.__class__.__name__),
+            str(version),
+            nipype.__version__,
+            __version__,
+            _hash_value(inputs)
+        ]
+        return hashlib.sha256(json.dumps(key,sort_keys=True,default=str).encode()).hexdigest()
+
+    def restore(self,key,node):
+        """
+            Restore a stored result into the node directory, returns whether it was found
+        """
+
+        # check the store
+        entry = os.path.join(self.cache_dir,key)
+        if not os.path.isdir(entry):
+            return False
+        with open(os.path.join(entry,'meta.json'),'r') as f:
+            meta = json.load(f)
+        result = loadpkl(os.path.join(entry,'result.pklz'))
+
+        # copy the node directory
+        outdir = node.output_dir()
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        shutil.copytree(os.path.join(entry,'node'),outdir)
+        roots = {meta['node_dir']: outdir}
+
+        # copy the subject directory of freesurfer nodes
+        subject_dir = _subject_dir(node)
+        if meta['subject_dir']:
+            if os.path.exists(subject_dir):
+                shutil.rmtree(subject_dir)
+            shutil.copytree(os.path.join(entry,'subject'),subject_dir)
+            roots[meta['subject_dir']] = subject_dir
+
+        # point the outputs at the restored files
+        for name,value in result.outputs.get().items():
+            if isdefined(value):
+                setattr(result.outputs,name,_rebase(value,roots))
+
+        # write the result and hash files, so nipype finds the node up to date
+        save_resultfile(result,outdir,node.name,rebase=False)
+        hashed_inputs,hashvalue = node._get_hashval()
+        save_hashfile(os.path.join(outdir,'_0x{}.json'.format(hashvalue)),hashed_inputs)
+
+        # mark the entry as recently used
+        os.utime(entry)
+        return True
+
+    def save(self,key,node,result):
+        """
+            Store the result of a node that just ran
+        """
+
+        # the entry may have been stored by another run in the meantime
+        entry = os.path.join(self.cache_dir,key)
+        if os.path.exists(entry):
+            return
+
+        # only results that live in the node (or subject) directory can be restored elsewhere
+        outdir = node.output_dir()
+        subject_dir = _subject_dir(node)
+        roots = [outdir]+([subject_dir] if subject_dir else [])
+        for path in _paths(list(result.outputs.get().values())):
+            if not any(path == root or path.startswith(root+os.sep) for root in roots):
+                logger.debug('[ResultStore] Not storing "%s", output %s is outside the node directory.',node.fullname,path)
+                return
+
+        # write the entry to a temporary directory and move it into place (files are copied, not linked,
+        # so later changes to the working or subject directory don't change the entry)
+        tmp_entry = os.path.join(self.cache_dir,'.{}.{}'.format(key,os.getpid()))
+        try:
+            shutil.copytree(outdir,os.path.join(tmp_entry,'node'),ignore=shutil.ignore_patterns(*BOOKKEEPING_FILES))
+            if subject_dir:
+                shutil.copytree(subject_dir,os.path.join(tmp_entry,'subject'))
+            savepkl(os.path.join(tmp_entry,'result.pklz'),result)
+            meta = {
+                'node': node.fullname,
+                'node_dir': outdir,
+                'subject_dir': subject_dir,
+                'size': _dir_size(tmp_entry)
+            }
+            with open(os.path.join(tmp_entry,'meta.json'),'w') as f:
+                json.dump(meta,f,indent=4)
+            os.rename(tmp_entry,entry)
+        except OSError:
+            # another run stored the same result first
+            shutil.rmtree(tmp_entry,ignore_errors=True)
+            return
+
+        # keep the store under its size cap
+        self.evict()
+
+    def evict(self):
+        """
+            Remove least recently used entries until the store fits in max_size_gb
+        """
+
+        # get the size and last use of each entry
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir,key)
+            if key.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(entry,'meta.json'),'r') as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(entry),size,entry))
+            except (OSError,ValueError,KeyError):
+                continue
+
+        # remove the oldest entries first
+        total = sum(size for _,size,_ in entries)
+        for _,size,entry in sorted(entries):
+            if total <= self.max_size_gb*1024**3:
+                break
+            shutil.rmtree(entry,ignore_errors=True)
+            total -= size
+
+def open_result_store(cache_dir,max_size_gb):
+    """
+        Get the result store in cache_dir, or None (with a warning) if it can't be created
+
+        A read-only or full home directory then only costs the reuse of results,
+        not the run.
+    """
+
+    try:
+        store = ResultStore(cache_dir,max_size_gb)
+        if not os.access(cache_dir,os.W_OK):
+            raise PermissionError('{} is not writable'.format(cache_dir))
+        return store
+    except OSError as err:
+        logger.warning('[ResultStore] Could not open the result store in %s, running without it: %s',cache_dir,err)
+        return None
+
+def _dir_size(path):
+    # total size of the files under path
+    return sum(os.path.getsize(os.path.join(root,f)) for root,_,files in os.walk(path) for f in files)
+
+def run_node_cached(node,updatehash,taskid,store):
+    """
+        Run a node, restoring its result from the store when it has run before
+
+        Problems with the store are logged and the node is simply run.
+    """
+
+    # look up the node
+    try:
+        key = store.node_key(node)
+    except Exception as err:
+        logger.warning('[ResultStore] Could not hash the inputs of "%s": %s',node.fullname,err)
+        key = None
+    if key:
+        try:
+            if store.restore(key,node):
+                logger.info('[ResultStore] Restored "%s" from %s.',node.fullname,store.cache_dir)
+                key = None
+        except Exception as err:
+            # don't leave a partially restored subject directory behind
+            logger.warning('[ResultStore] Could not restore "%s": %s',node.fullname,err)
+            subject_dir = _subject_dir(node)
+            if subject_dir:
+                shutil.rmtree(subject_dir,ignore_errors=True)
+            key = None
+
+    # run the node (a restored node is found up to date)
+    result = run_node(node,updatehash,taskid)
+
+    # store new results
+    if key and result['traceback'] is None:
+        try:
+            store.save(key,node,result['result'])
+        except Exception as err:
+            logger.warning('[ResultStore] Could not store "%s": %s',node.fullname,err)
+
+    # return the result dictionary
+    return result
@@ -0,0 +1,302 @@
+"""Define the p3 execution plugin
+"""
+import os
+import json
+import fcntl
+from time import time
+import numpy as np
+import networkx as nx
+from nipype import MapNode
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin,run_node
+from .resultcache import CACHED_NODES,run_node_cached
+from .threads import ThreadBudget,apply_threads
+from .cleanup import EagerCleanup
+from . import trace
+
+# expected run time of nodes (in seconds) when there is no history for them yet
+NODE_DURATIONS = {
+    # p3_bidsselector
+    'alignanattoanat': 120,
+    'avganat': 10,
+    # p3_freesurfer
+    'recon1': 1200,
+    'reconall': 28800,
+    'orig_mriconvert': 10,
+    'brainmask_mriconvert': 10,
+    # p3_skullstrip
+    'afni_skullstrip': 300,
+    'fsl_skullstrip': 60,
+    '3dallineate_orig': 120,
+    '3dallineate_brainmask': 60,
+    'biasfieldcorrect': 300,
+    # p3_stcdespikemoco
+    'despike': 180,
+    'tshift': 60,
+    'despike_tshift': 240,
+    'moco_before': 120,
+    'moco': 600,
+    # p3_fieldmapcorrection
+    'calculate_fieldmap': 30,
+    'unmask': 30,
+    'register_magnitude': 30,
+    'applyantsunwarp': 30,
+    'realign': 120,
+    'combine_transforms': 60,
+    # p3_alignanattoatlas
+    'atlasregister': 1800,
+    # p3_alignfunctoanat
+    'align_func_2_anat': 300,
+    # p3_alignfunctoatlas
+    'resample': 30,
+    'format_reference': 60,
+    'combinetransforms': 300,
+    'create_dfnd_mask': 30,
+    'applytransforms': 900,
+    # p3_create_fs_masks
+    'align_fs_2_anat': 300,
+    'join_warps': 60,
+    'apply_warp': 30,
+}
+
+# expected run time of nodes not listed above (in seconds)
+DEFAULT_DURATION = 10
+
+def history_key(node):
+    """
+        Get the key of a node in the duration history (<workflow>.<node>)
+
+        Nodes with the same name in different workflows (e.g. datasink) are
+        timed separately; iterables copies of a node share their key.
+    """
+
+    if node._hierarchy:
+        return '{}.{}'.format(node._hierarchy.split('.')[-1],node.name)
+    return node.name
+
+def load_history(history_file):
+    """
+        Load recorded node durations ({workflow.node: [mean duration, number of runs]})
+    """
+
+    # no history yet
+    if not history_file or not os.path.exists(history_file):
+        return {}
+
+    # read the history; a corrupt history is just ignored
+    try:
+        with open(history_file,'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_history(history_file,history):
+    """
+        Write recorded node durations
+    """
+
+    # write to a temporary file and move it so readers never see a partial file
+    tmp_file = '{}.{}'.format(history_file,os.getpid())
+    with open(tmp_file,'w') as f:
+        json.dump(history,f,indent=4,sort_keys=True)
+    os.replace(tmp_file,history_file)
+
+def update_history(history_file,key,duration):
+    """
+        Add a measured duration to the history file, returns the updated history
+
+        The history is read, updated and written under a lock on
+        <history_file>.lock, so runs sharing the file (e.g. the shards of a
+        sharded run) merge their measurements instead of overwriting them.
+    """
+
+    with open(history_file+'.lock','w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            history = load_history(history_file)
+            mean,count = history.get(key,[0.0,0])
+            history[key] = [(mean*count+duration)/(count+1),count+1]
+            save_history(history_file,history)
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+    return history
+
+def expected_duration(node,history):
+    """
+        Get the expected duration of a node from its history, or the cost table
+    """
+
+    key = history_key(node)
+    if key in history:
+        return history[key][0]
+    return NODE_DURATIONS.get(node.name,DEFAULT_DURATION)
+
+def critical_path_priorities(graph,history):
+    """
+        Get the length of the longest path from each node to the end of the graph
+
+        The length of a path is the sum of the expected durations of the nodes on
+        it. Nodes with the highest priority gate the most work and should run first.
+    """
+
+    # walk the graph from the end so all successors are known
+    priorities = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        remaining = max([priorities[succ] for succ in graph.successors(node)],default=0)
+        priorities[node] = expected_duration(node,history)+remaining
+
+    # return priorities
+    return priorities
+
+def run_p3_node(node,updatehash,taskid,result_store=None):
+    """
+        Run a node in a worker process, recording its time and resource use
+    """
+
+    # the tools run by the node use the threads it was given
+    apply_threads(node,node.n_procs)
+
+    # run the node (through the result store if given)
+    before,sampler = trace.start_span()
+    if result_store:
+        result = run_node_cached(node,updatehash,taskid,result_store)
+    else:
+        result = run_node(node,updatehash,taskid)
+
+    # record the node
+    trace.record_span('node',node.fullname,before,status='failed' if result['traceback'] else 'ok',sampler=sampler)
+    return result
+
+class P3MultiProcPlugin(MultiProcPlugin):
+    """MultiProc plugin that runs the longest remaining path first
+
+        Adds the 'critical_path' scheduler: ready jobs are dispatched in order of
+        the expected duration of the longest path from the job to the end of the
+        graph, so long chains (e.g. recon-all) start before cheap nodes fill the
+        worker slots. Durations come from NODE_DURATIONS until they have been
+        measured; measured durations are merged into plugin_args['history_file']
+        (keyed by workflow.node) for future runs.
+
+        When plugin_args['result_store'] is set, nodes in CACHED_NODES are looked
+        up in the store (a ResultStore) before they run, and stored after. Nodes
+        are recorded in the p3 trace while tracing is on.
+
+        When plugin_args['max_threads'] is set, idle cores are shared between
+        the ready multithreaded nodes (see ThreadBudget).
+
+        When plugin_args['cleanup_dir'] is set, intermediate files under it are
+        deleted once all their consumers are done (see EagerCleanup).
+
+    """
+
+    def __init__(self,plugin_args=None):
+        # call base constructor
+        super().__init__(plugin_args=plugin_args)
+
+        # load the node duration history
+        self._history_file = self.plugin_args.get('history_file')
+        self._history = load_history(self._history_file)
+        self._priorities = {}
+        self._start_times = {}
+
+        # job ids of the procs (by object id), and the job being submitted
+        self._jobids = {}
+        self._submitting = None
+
+        # store of node results shared between runs
+        self._result_store = self.plugin_args.get('result_store')
+
+        # share of the cores given to each multithreaded node
+        max_threads = self.plugin_args.get('max_threads')
+        self._thread_budget = ThreadBudget(max_threads) if max_threads else None
+
+        # removal of intermediate files
+        cleanup_dir = self.plugin_args.get('cleanup_dir')
+        self._cleanup = EagerCleanup(cleanup_dir) if cleanup_dir else None
+        self._graph = None
+
+        # record node start/end times (and forward them to any user callback)
+        self._user_status_callback = self._status_callback
+        self._status_callback = self._record_status
+
+    def _generate_dependency_list(self,graph):
+        # call base method
+        super()._generate_dependency_list(graph)
+        self._graph = graph
+        self._jobids = {}
+
+        # rank the jobs of the graph
+        self._priorities = critical_path_priorities(graph,self._history)
+
+    def _sort_jobs(self,jobids,scheduler='tsort'):
+        # use the base ordering for other schedulers
+        if scheduler != 'critical_path':
+            return super()._sort_jobs(jobids,scheduler=scheduler)
+
+        # highest priority first
+        return sorted(jobids,key=self._job_priority,reverse=True)
+
+    def _jobid(self,node):
+        # index procs added since the last call (mapnode iterations are appended to procs)
+        for jobid in range(len(self._jobids),len(self.procs)):
+            self._jobids[id(self.procs[jobid])] = jobid
+        return self._jobids[id(node)]
+
+    def _job_priority(self,jobid):
+        # mapnode iterations share the priority of their mapnode
+        jobid = self.mapnodesubids.get(jobid,jobid)
+        return self._priorities.get(self.procs[jobid],0)
+
+    def _send_procs_to_workers(self,updatehash=False,graph=None):
+        # share the free cores between the jobs that are ready (mapnodes are expanded first)
+        if self._thread_budget:
+            jobids = np.flatnonzero(~self.proc_done & (self.depidx.sum(axis=0) == 0).__array__())
+            nodes = [self.procs[jobid] for jobid in jobids if not isinstance(self.procs[jobid],MapNode)]
+            self._thread_budget.balance(nodes,self._check_resources(self.pending_tasks)[1])
+
+        # call base method
+        super()._send_procs_to_workers(updatehash=updatehash,graph=graph)
+
+    def _submit_job(self,node,updatehash=False):
+        # only expensive nodes are looked up in the result store (submitted nodes are copies,
+        # the job id comes from the start status sent right before the submission)
+        jobid = self._submitting
+        name = self.procs[self.mapnodesubids.get(jobid,jobid)].name
+        store = self._result_store if jobid not in self.mapnodes and name in CACHED_NODES else None
+
+        # submit the node
+        self._taskid += 1
+        if getattr(node.interface,'terminal_output','') == 'stream':
+            node.interface.terminal_output = 'allatonce'
+        result_future = self.pool.submit(run_p3_node,node,updatehash,self._taskid,store)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+    def _record_status(self,node,status):
+        # track the time each node was started (and which job is about to be submitted)
+        if status == 'start':
+            self._start_times[node] = time()
+            self._submitting = self._jobid(node)
+        # record how long the node took (expanded mapnodes only collate their iterations)
+        elif status == 'end' and node in self._start_times:
+            duration = time()-self._start_times.pop(node)
+            jobid = self._jobid(node)
+            if jobid not in self.mapnodes:
+                # mapnode iterations are recorded under their mapnode
+                key = history_key(self.procs[self.mapnodesubids.get(jobid,jobid)])
+                if self._history_file:
+                    self._history = update_history(self._history_file,key,duration)
+                else:
+                    mean,count = self._history.get(key,[0.0,0])
+                    self._history[key] = [(mean*count+duration)/(count+1),count+1]
+        # crashed nodes are not timed
+        elif status == 'exception':
+            self._start_times.pop(node,None)
+
+        # delete intermediate files nobody needs anymore (mapnode iterations are handled by their mapnode)
+        if status == 'end' and self._cleanup and node in self._graph:
+            self._cleanup.node_finished(node,self._graph)
+
+        # forward to the user callback
+        if self._user_status_callback:
+            self._user_status_callback(node,status)
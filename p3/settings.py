@@ -26,8 +26,24 @@ def default_preproc_settings():
     settings['field_map_correction'] = True # sets whether pipeline should run field map correction. You should have field maps in your dataset for this to work.
     settings['slice_time_correction'] = True # sets whether epi images should be slice time corrected
     settings['despiking'] = True # sets whether epi images should be despiked
+    settings['despike_engine'] = 'afni' # sets the despike implementation ('afni' runs 3dDespike, 'native' runs p3's memory-mapped implementation of the same method in a pool of processes)
+    settings['slicetime_engine'] = 'afni' # sets the slice time correction implementation ('afni' runs 3dTShift, 'native' shifts slices in a pool of processes with the SliceTiming metadata)
+    settings['slicetime_interpolation'] = 'heptic' # sets the interpolation of the native slice time correction ('heptic' or 'fourier')
+    settings['fuse_despike_stc'] = True # sets whether the native despike and slice time correction run in one pass over each epi image, handing motion correction an uncompressed image and its reference frame
+    settings['spike_qc'] = False # sets whether the spikiness images of despiking are written to p3_QC (the native engine only computes them when True)
     settings['run_recon_all'] = True # sets whether pipeline should run recon-all (if you decide not to you should place your own p3_freesurfer data under output p3_freesurfer_output, where each folder is {NAME} in sub-{NAME} in the bids dataset)
-    settings['num_threads'] = 8 # sets the number of threads for ANTS registration
+    settings['num_threads'] = 8 # sets the number of threads for multithreaded nodes (ANTs, FreeSurfer, AFNI)
+    settings['max_threads'] = 16 # sets the most threads a multithreaded node is given when cores are idle (multiproc only)
+    settings['hash_cache'] = True # sets whether file content hashes are cached across runs (files are only rehashed when they change)
+    settings['result_cache'] = False # sets whether results of expensive nodes are stored and reused by later runs (multiproc only)
+    settings['result_cache_dir'] = None # sets the result store location (defaults to $P3_CACHE_DIR or ~/.cache/p3/results)
+    settings['result_cache_size_gb'] = 100 # sets the size of the result store; least recently used results are evicted past this
+    settings['eager_cleanup'] = False # sets whether intermediate files in tmp_dir are deleted as soon as the nodes using them are done (multiproc only)
+    settings['compress_intermediates'] = True # sets whether intermediate images in tmp_dir are gzipped (when False they are written uncompressed and only compressed when copied to output_dir)
+    settings['graph_cache'] = True # sets whether the built pipeline graph is cached in tmp_dir and reused while the settings, workflows and dataset are unchanged
+    settings['graphs'] = [] # sets which graphs of the pipeline and each workflow are written to output_dir/graph ('json' describes the graph for other tools, 'flat' and 'colored' are graphviz images and slow for large pipelines)
+    settings['graph_background'] = True # sets whether graphs are written by a background process while the pipeline runs
+    settings['trace'] = True # sets whether the time and resources used by each node and command are written to output_dir/trace
     settings['brain_radius'] = 50 # brain radius for FD calculations (in mm)
     settings['min_bpm'] = 18.582 # breathing rate for lower bound of filter
     settings['max_bpm'] = 25.7263 # breathing rate for upper bound of filter
@@ -0,0 +1,61 @@
+"""Share the machine's cores between running nodes
+"""
+import os
+from nipype.interfaces.base import CommandLine
+from .command import THREADS_ENV,thread_env
+
+class ThreadBudget:
+    """Give each ready multithreaded node a share of the free cores
+
+        Nodes keep the thread count they were assigned (see
+        resources.assign_node_resources) as a minimum. When cores are idle, the
+        cores not needed by the ready single threaded nodes are split evenly
+        between the ready multithreaded ones, up to max_threads per node. Shares
+        are recomputed every time the scheduler submits jobs, so nodes launched
+        after others finish pick up the freed cores.
+
+    """
+
+    def __init__(self,max_threads):
+        self.max_threads = max_threads
+        self._requested = {}
+
+    def balance(self,nodes,free_processors):
+        """
+            Set n_procs of the nodes about to be submitted
+        """
+
+        # remember the thread count each node was assigned
+        requested = {node: self._requested.setdefault(node.fullname,node.n_procs) for node in nodes}
+        threaded = [node for node in nodes if requested[node] > 1]
+        if not threaded:
+            return
+
+        # split the cores the single threaded nodes don't need
+        spare = free_processors-(len(nodes)-len(threaded))
+        share = min(self.max_threads,max(1,spare//len(threaded)))
+        for node in threaded:
+            node.n_procs = max(requested[node],share)
+
+def apply_threads(node,n_threads):
+    """
+        Make the tools a node runs use n_threads threads
+
+        Sets num_threads (ANTs, AFNI) and openmp (FreeSurfer) inputs where the
+        interface has them, the ITK/OpenMP environment of command line
+        interfaces, and the thread count used by run_command in custom functions.
+    """
+
+    # custom functions
+    os.environ[THREADS_ENV] = str(n_threads)
+
+    # interfaces with a thread count input
+    names = node.inputs.trait_names()
+    if 'num_threads' in names:
+        node.inputs.num_threads = n_threads
+    if 'openmp' in names:
+        node.inputs.openmp = n_threads
+
+    # environment of command line tools
+    if isinstance(node.interface,CommandLine):
+        node.interface.inputs.environ.update(thread_env(n_threads))
@@ -0,0 +1,261 @@
+"""Record the time and resources used by nodes and the commands they run
+"""
+import os
+import csv
+import json
+import glob
+import shutil
+import resource
+import threading
+from time import time
+
+# environment variable pointing worker processes at the trace directory
+TRACE_ENV = 'P3_TRACE_DIR'
+
+# seconds between memory samples of a span
+RSS_INTERVAL = 0.1
+
+# columns of the csv summary
+TRACE_FIELDS = ['kind','name','status','start','duration','cpu_time','peak_rss_mb','read_mb','written_mb','pid']
+
+def start_trace(trace_dir):
+    """
+        Start a new trace; events of this process and its children are written to trace_dir
+    """
+
+    # clear events of earlier runs
+    shutil.rmtree(trace_dir,ignore_errors=True)
+    os.makedirs(trace_dir)
+
+    # worker processes find the trace directory through the environment
+    os.environ[TRACE_ENV] = trace_dir
+
+def stop_trace():
+    """
+        Stop recording events
+    """
+
+    os.environ.pop(TRACE_ENV,None)
+
+def snapshot():
+    """
+        Get the time and resource usage of this process and its finished children
+    """
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'time': time(),
+        'cpu_time': usage_self.ru_utime+usage_self.ru_stime+usage_children.ru_utime+usage_children.ru_stime,
+        'read': (usage_self.ru_inblock+usage_children.ru_inblock)*512,
+        'written': (usage_self.ru_oublock+usage_children.ru_oublock)*512,
+        'rss': max(usage_self.ru_maxrss,usage_children.ru_maxrss)*1024,
+        'children_rss': usage_children.ru_maxrss*1024
+    }
+
+def _tree_pids(pid):
+    # get a process and all its descendants (from /proc/<pid>/task/<tid>/children)
+    pids = [pid]
+    for task in glob.glob('/proc/{}/task/*/children'.format(pid)):
+        try:
+            with open(task,'r') as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for child in children:
+            pids.extend(_tree_pids(int(child)))
+    return pids
+
+def tree_rss(pid=None):
+    """
+        Get the resident memory (bytes) of a process and its descendants (None where /proc is not available)
+    """
+
+    pid = pid if pid else os.getpid()
+    if not os.path.exists('/proc/{}/statm'.format(pid)):
+        return None
+    total = 0
+    for p in _tree_pids(pid):
+        try:
+            with open('/proc/{}/statm'.format(p),'r') as f:
+                total += int(f.read().split()[1])*resource.getpagesize()
+        except (OSError,ValueError,IndexError):
+            continue
+    return total
+
+class RSSSampler:
+    """Peak resident memory of this process and the commands it starts, sampled in a thread during a span
+
+        The lifetime maximum kept by rusage can't tell the peak of a node run in
+        a reused worker process, so the memory is polled every RSS_INTERVAL
+        seconds until stop is called.
+
+    """
+
+    def __init__(self):
+        # start polling (nothing to poll without /proc)
+        self.peak = tree_rss()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._poll,daemon=True)
+            self._thread.start()
+
+    def _poll(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        rss = tree_rss()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    def stop(self):
+        """
+            Stop polling, returns the peak (None if it could not be sampled)
+        """
+
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return self.peak
+
+def record(kind,name,start,end,cpu_time,peak_rss,read,written,status='ok'):
+    """
+        Record an event (times in seconds, sizes in bytes; peak_rss may be None if unknown)
+    """
+
+    # only record while tracing
+    trace_dir = os.environ.get(TRACE_ENV)
+    if not trace_dir:
+        return
+
+    # each process appends to its own file, so writers never interleave
+    event = {
+        'kind': kind,
+        'name': name,
+        'status': status,
+        'start': start,
+        'end': end,
+        'cpu_time': cpu_time,
+        'peak_rss': peak_rss,
+        'read': read,
+        'written': written,
+        'pid': os.getpid()
+    }
+    with open(os.path.join(trace_dir,'{}.jsonl'.format(os.getpid())),'a') as f:
+        f.write(json.dumps(event)+'\n')
+
+def record_span(kind,name,before,status='ok',sampler=None):
+    """
+        Record an event that started at snapshot before and ends now
+
+        The peak memory is taken from an RSSSampler started with the span, or
+        from commands that finished during the span with a higher peak than
+        earlier ones. Without a sampler, it is only known if it exceeded the
+        peak of everything that ran earlier in this process (rusage only keeps
+        a lifetime maximum).
+    """
+
+    after = snapshot()
+    if sampler:
+        peaks = [sampler.stop(),after['children_rss'] if after['children_rss'] > before['children_rss'] else None]
+        peaks = [peak for peak in peaks if peak]
+        peak_rss = max(peaks) if peaks else None
+    else:
+        peak_rss = after['rss'] if after['rss'] > before['rss'] else None
+    record(kind,name,before['time'],after['time'],
+        cpu_time=after['cpu_time']-before['cpu_time'],
+        peak_rss=peak_rss,
+        read=after['read']-before['read'],
+        written=after['written']-before['written'],
+        status=status)
+
+def start_span():
+    """
+        Get the snapshot and memory sampler of a span starting now (the sampler is None when not tracing)
+    """
+
+    return snapshot(),RSSSampler() if os.environ.get(TRACE_ENV) else None
+
+class NodeTracer:
+    """Status callback recording nodes that run in this process (Linear plugin)
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+
+    def __call__(self,node,status):
+        if status == 'start':
+            self._snapshots[node] = start_span()
+        elif node in self._snapshots:
+            before,sampler = self._snapshots.pop(node)
+            record_span('node',node.fullname,before,status='ok' if status == 'end' else 'failed',sampler=sampler)
+
+def load_events(trace_dir):
+    """
+        Load the events recorded by all processes, ordered by start time
+    """
+
+    events = []
+    for filename in glob.glob(os.path.join(trace_dir,'*.jsonl')):
+        with open(filename,'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return sorted(events,key=lambda e: e['start'])
+
+def write_trace(trace_dir,output_dir):
+    """
+        Write the recorded events as a Chrome trace (p3_trace.json) and a csv summary (p3_trace.csv)
+
+        The Chrome trace can be opened in chrome://tracing or https://ui.perfetto.dev.
+        Each process gets a row; commands show up nested in the node that ran them.
+    """
+
+    # get events
+    events = load_events(trace_dir)
+    origin = events[0]['start'] if events else 0
+
+    # write the chrome trace (times in microseconds)
+    trace_events = []
+    for e in events:
+        trace_events.append({
+            'name': e['name'],
+            'cat': e['kind'],
+            'ph': 'X',
+            'ts': int((e['start']-origin)*1e6),
+            'dur': int((e['end']-e['start'])*1e6),
+            'pid': 1,
+            'tid': e['pid'],
+            'args': {
+                'status': e['status'],
+                'cpu_time': e['cpu_time'],
+                'peak_rss_mb': e['peak_rss']/1024**2 if e['peak_rss'] else None,
+                'read_mb': e['read']/1024**2,
+                'written_mb': e['written']/1024**2
+            }
+        })
+    with open(os.path.join(output_dir,'p3_trace.json'),'w') as f:
+        json.dump({'traceEvents': trace_events,'displayTimeUnit': 'ms'},f)
+
+    # write the csv summary (times in seconds from the start of the run)
+    with open(os.path.join(output_dir,'p3_trace.csv'),'w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=TRACE_FIELDS)
+        writer.writeheader()
+        for e in events:
+            writer.writerow({
+                'kind': e['kind'],
+                'name': e['name'],
+                'status': e['status'],
+                'start': round(e['start']-origin,3),
+                'duration': round(e['end']-e['start'],3),
+                'cpu_time': round(e['cpu_time'],3),
+                'peak_rss_mb': round(e['peak_rss']/1024**2,1) if e['peak_rss'] else '',
+                'read_mb': round(e['read']/1024**2,1),
+                'written_mb': round(e['written']/1024**2,1),
+                'pid': e['pid']
+            })
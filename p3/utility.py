@@ -1,5 +1,5 @@
 import os
-from bids.grabbids import BIDSLayout
+from .layout import load_layout
 
 def get_basename(filename):
     """
@@ -31,13 +31,31 @@ def set_atlas_path(atlas):
     # return the path to the atlas
     return atlas
 
+def get_subject_files(settings):
+    """
+        Get the images selected by each bids query for the subjects being processed
+    """
+
+    # get bids layout
+    layout = load_layout(settings['bids_dir'])
+
+    # run each query (a subject filter in the query itself takes precedence)
+    files = {}
+    for key in settings['bids_query']:
+        query = dict(settings['bids_query'][key])
+        query.setdefault('subject',settings['subject'])
+        files[key] = [f.filename for f in layout.get(**query) if f.filename.endswith(('.nii','.nii.gz'))]
+
+    # return the files for each query
+    return files
+
 def output_BIDS_summary(bids_dir):
     """
         Get a summary of the BIDS dataset input
     """
 
-    # call pybids
-    layout = BIDSLayout(bids_dir)
+    # get the bids layout index
+    layout = load_layout(bids_dir)
     print('Below are some available keys in the dataset to filter on:\n')
 
     # show availiable keys
@@ -0,0 +1,172 @@
+"""Validate the BIDS dataset, checking only the subjects that changed since the last validation
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from .layout import scan_files,FINGERPRINT_SKIP
+
+# file in output_dir holding the fingerprints of the subjects that passed validation
+VALIDATION_FILE = 'bids_validation.json'
+
+def _digest(entries):
+    # hash a list of file entries
+    digest = hashlib.sha256()
+    for entry in sorted(entries):
+        digest.update(entry.encode()+b'\n')
+    return digest.hexdigest()
+
+def dataset_fingerprints(bids_dir,n_threads=8):
+    """
+        Get a fingerprint of the top level of a dataset (files and non subject folders) and of each subject folder
+
+        Only file metadata (paths, sizes and modification times) is read; subject
+        folders are scanned in parallel.
+    """
+
+    # split the dataset into the top level and the subject folders
+    top = []
+    subjects = {}
+    for entry in os.scandir(bids_dir):
+        if entry.name.startswith('.') or entry.name in FINGERPRINT_SKIP:
+            continue
+        if entry.is_dir() and entry.name.startswith('sub-'):
+            subjects[entry.name] = entry.path
+        elif entry.is_dir():
+            top.extend(scan_files(entry.path,bids_dir))
+        else:
+            stat = entry.stat()
+            top.append('{} {} {}'.format(entry.name,stat.st_size,stat.st_mtime_ns))
+
+    # fingerprint each subject
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        fingerprints = pool.map(lambda path: _digest(scan_files(path,bids_dir)),subjects.values())
+    return _digest(top),dict(zip(subjects,fingerprints))
+
+def subset_dataset(bids_dir,subjects,subset_dir):
+    """
+        Create a dataset in subset_dir with the top level of bids_dir and only the given subject folders (as links)
+    """
+
+    for entry in os.scandir(bids_dir):
+        # skip the other subjects
+        if entry.name.startswith('sub-') and entry.name not in subjects:
+            continue
+
+        # only list the included subjects in participants.tsv (or the validator reports the others as missing)
+        if entry.name == 'participants.tsv':
+            with open(entry.path,'r') as f, open(os.path.join(subset_dir,entry.name),'w') as g:
+                for n,line in enumerate(f):
+                    if n == 0 or line.split('\t')[0].strip() in subjects:
+                        g.write(line)
+            continue
+
+        # link everything else
+        os.symlink(entry.path,os.path.join(subset_dir,entry.name))
+
+class BIDSValidation:
+    """bids-validator run in the background while the pipeline is built
+
+        The fingerprints of the subjects that passed validation are kept in
+        cache_file. A later validation only checks the subjects whose files
+        changed (all subjects if the top level of the dataset changed), by
+        running the validator on a copy of the dataset that links to those
+        subjects. Failed validations are not cached, so they are repeated until
+        the dataset is fixed. The validator report is kept until wait is called,
+        so it is printed between building and running the pipeline instead of in
+        the middle of the run.
+
+    """
+
+    def __init__(self,bids_dir,cache_file=None):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.cache_file = cache_file
+        self.passed = None
+        self.report = []
+        self._thread = None
+
+    def start(self):
+        """
+            Start validating in the background
+        """
+
+        self._thread = threading.Thread(target=self.run,name='bids-validator')
+        self._thread.start()
+        return self
+
+    def wait(self):
+        """
+            Wait for the validation and print its report, returns whether the dataset passed (None if it could not be validated)
+        """
+
+        if self._thread:
+            self._thread.join()
+        for message in self.report:
+            print(message)
+        self.report = []
+        return self.passed
+
+    def _read_cache(self):
+        # get the fingerprints of the last validation
+        try:
+            with open(self.cache_file,'r') as f:
+                return json.load(f)
+        except (TypeError,OSError,ValueError):
+            return {}
+
+    def _write_cache(self,cache):
+        # save the fingerprints (moved into place, so a crash never leaves a partial file)
+        if not self.cache_file:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file),exist_ok=True)
+            with open(self.cache_file+'.tmp','w') as f:
+                json.dump(cache,f,indent=4)
+            os.replace(self.cache_file+'.tmp',self.cache_file)
+        except OSError:
+            pass
+
+    def run(self):
+        """
+            Validate the subjects that changed since the last validation
+        """
+
+        # find the subjects that changed
+        try:
+            top,subjects = dataset_fingerprints(self.bids_dir)
+        except OSError as err:
+            self.report.append('BIDS validation: could not read the dataset: {}'.format(err))
+            return
+        cache = self._read_cache()
+        passed = cache.get('subjects',{}) if cache.get('top') == top else {}
+        changed = sorted(subject for subject,fingerprint in subjects.items() if passed.get(subject) != fingerprint)
+        if not changed:
+            self.report.append('BIDS validation: no files changed since the last validation.')
+            self.passed = True
+            return
+
+        # validate the changed subjects (the dataset itself when they all changed)
+        with tempfile.TemporaryDirectory() as subset_dir:
+            if len(changed) == len(subjects):
+                dataset = self.bids_dir
+            else:
+                subset_dataset(self.bids_dir,changed,subset_dir)
+                dataset = subset_dir
+            try:
+                proc = subprocess.run(['bids-validator',dataset],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            except OSError as err:
+                self.report.append('BIDS validation: could not run bids-validator: {}'.format(err))
+                return
+
+        # keep the report for wait
+        self.report.append('BIDS validation of {} ({} of {} subjects changed):\n{}'.format(
+            self.bids_dir,len(changed),len(subjects),proc.stdout.decode('utf-8',errors='replace')))
+
+        # remember the subjects that passed
+        self.passed = proc.returncode == 0
+        if self.passed:
+            passed.update({subject: subjects[subject] for subject in changed})
+            self._write_cache({'top': top,'subjects': {s: f for s,f in passed.items() if s in subjects}})
@@ -41,7 +41,7 @@ class definednodes(basenodedefs):
         self.epi_automask = Node(
             afni.Automask(
                 args='-overwrite',
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             name='epi_automask'
         )
@@ -49,7 +49,7 @@ class definednodes(basenodedefs):
             afni.Calc(
                 expr='c*or(a,b)',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             name='epi_3dcalc'
         )
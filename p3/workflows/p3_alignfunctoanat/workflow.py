@@ -1,7 +1,9 @@
 from nipype import Workflow
 from .nodedefs import definednodes
 from p3.base import workflowgenerator
+from p3.registry import register_workflow
 
+@register_workflow('p3_alignfunctoanat')
 class alignfunctoanatworkflow(workflowgenerator):
     """ Defines the functional alignment to anatomy alignment workflow
 
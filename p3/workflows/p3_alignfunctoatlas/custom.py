@@ -11,21 +11,21 @@ def get_resolution(reference):
 
     return resolution
 
-def format_reference(func,reference,bids_dir):
+def format_reference(func,reference,metadata,ext='.nii.gz'):
     import os
     import nibabel
     from p3.utility import get_basename
-    from bids.grabbids import BIDSLayout
+    from p3.command import run_command
 
     # save to node folder (go up 2 directories bc of iterfield)
     cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
     # get filename to output
-    formatted_reference = os.path.join(cwd,'{}_format4D.nii.gz'.format(get_basename(func)))
+    formatted_reference = os.path.join(cwd,'{}_format4D{}'.format(get_basename(func),ext))
 
     # get dim 4 and TR of input image
     dim4 = nibabel.load(func).header.get_data_shape()[3] # get the 4th dim
-    TR = BIDSLayout(bids_dir).get_metadata(func)['RepetitionTime'] # get the TR
+    TR = metadata['RepetitionTime'] # get the TR (from the manifest entry of the image)
 
     # make the reference image the same dims as the input
     print('Formatting reference image...')
@@ -35,22 +35,22 @@ def format_reference(func,reference,bids_dir):
         dim4,
         TR
     )
-    print(command)
-    os.system(command)
+    run_command(command)
 
     return (formatted_reference,dim4,TR)
 
-def combinetransforms(func,reference,dim4,TR,affine_func_2_anat,affine_anat_2_atlas,warp_anat_2_atlas,warp_fmc=None):
+def combinetransforms(func,reference,dim4,TR,affine_func_2_anat,affine_anat_2_atlas,warp_anat_2_atlas,warp_fmc=None,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # save to node folder (go up 2 directories bc of iterfield)
     cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
     # get filename to output
     name = get_basename(func)
-    combined_transforms = os.path.join(cwd,'{}_combined_transforms.nii.gz'.format(name))
-    combined_transforms4D = os.path.join(cwd,'{}_combined_transforms4D.nii.gz'.format(name))
+    combined_transforms = os.path.join(cwd,'{}_combined_transforms{}'.format(name,ext))
+    combined_transforms4D = os.path.join(cwd,'{}_combined_transforms4D{}'.format(name,ext))
 
     # set up transforms (check in field map correction files exist)
     # we exclude the func_2_refimg transform since it is already 4D
@@ -75,8 +75,7 @@ def combinetransforms(func,reference,dim4,TR,affine_func_2_anat,affine_anat_2_at
         transforms,
         reference
     )
-    print(command)
-    os.system(command)
+    run_command(command)
 
     # replicate the combined transform
     print('Replicating the combined transform into 4D...')
@@ -86,22 +85,22 @@ def combinetransforms(func,reference,dim4,TR,affine_func_2_anat,affine_anat_2_at
         dim4,
         TR
     )
-    print(command)
-    os.system(command)
+    run_command(command)
 
     # return the 4D combined transform
     return combined_transforms4D
 
-def create_dfnd_mask(refimg,affine_func_2_anat,affine_anat_2_atlas,warp_anat_2_atlas,reference):
+def create_dfnd_mask(refimg,affine_func_2_anat,affine_anat_2_atlas,warp_anat_2_atlas,reference,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # get the current node directory
     cwd = os.getcwd()
 
     # get filename to output
-    out_file = os.path.join(cwd,'{}_atlas.nii.gz'.format(get_basename(refimg)))
-    mask_file = os.path.join(cwd,'{}_atlas_dfnd.nii.gz'.format(get_basename(refimg)))
+    out_file = os.path.join(cwd,'{}_atlas{}'.format(get_basename(refimg),ext))
+    mask_file = os.path.join(cwd,'{}_atlas_dfnd{}'.format(get_basename(refimg),ext))
 
     # create dfnd mask
     command = 'antsApplyTransforms -f 0.0 -d 3 -o {} -i {} -t {} -t {} -t {} -r {} -v'.format(
@@ -112,26 +111,26 @@ def create_dfnd_mask(refimg,affine_func_2_anat,affine_anat_2_atlas,warp_anat_2_a
         affine_func_2_anat,
         reference
     )
-    print(command)
-    os.system(command)
+    run_command(command)
 
     # convert to binary
-    os.system('fslmaths {} -bin {}'.format(
+    run_command('fslmaths {} -bin {}'.format(
         out_file,
         mask_file
     ))
 
     return mask_file
 
-def applytransforms(in_file,reference4D,combined_transforms4D,warp_func_2_refimg,dfnd_mask):
+def applytransforms(in_file,reference4D,combined_transforms4D,warp_func_2_refimg,dfnd_mask,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # save to node folder (go up 2 directories bc of iterfield)
     cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
     # get filename to output
-    out_file = os.path.join(cwd,'{}_moco_atlas.nii.gz'.format(get_basename(in_file)))
+    out_file = os.path.join(cwd,'{}_moco_atlas{}'.format(get_basename(in_file),ext))
 
     # set up command to run
     command = 'antsApplyTransforms -f 0.0 -d 4 -i {} -r {} -o {} -t {} -t {} -v'.format(
@@ -141,14 +140,13 @@ def applytransforms(in_file,reference4D,combined_transforms4D,warp_func_2_refimg
         combined_transforms4D,
         warp_func_2_refimg
     )
-    print(command)
 
     # apply transforms
-    os.system(command)
+    run_command(command)
 
     # mask the aligned func with the dfnd mask
     print('Applying dfnd mask...')
-    os.system('fslmaths {0} -mul {1} {0}'.format(
+    run_command('fslmaths {0} -mul {1} {0}'.format(
         out_file,
         dfnd_mask
     ))
@@ -67,17 +67,20 @@ class definednodes(basenodedefs):
         self.resample.inputs.in_file = set_atlas_path(settings['atlas'])
         self.resample.inputs.reference = set_atlas_path(settings['atlas'])
 
+        # get the acquisition parameters of each run
+        self.set_metadata(settings)
+
         # format the reference image (which should be the resampled atlas)
         self.format_reference = MapNode(
             Function(
-                input_names=['func','reference','bids_dir'],
+                input_names=['func','reference','metadata','ext'],
                 output_names=['formatted_reference','dim4','TR'],
                 function=format_reference
             ),
-            iterfield=['func'],
+            iterfield=['func','metadata'],
             name='format_reference'
         )
-        self.format_reference.inputs.bids_dir = settings['bids_dir']
+        self.format_reference.inputs.ext = self.ext
 
         # combine 3D transforms and replicate to 4D
         self.combinetransforms = MapNode(
@@ -90,7 +93,8 @@ class definednodes(basenodedefs):
                     'affine_func_2_anat',
                     'affine_anat_2_atlas',
                     'warp_anat_2_atlas',
-                    'warp_fmc'
+                    'warp_fmc',
+                    'ext'
                     ],
                output_names=['combined_transforms4D'],
                function=combinetransforms
@@ -98,6 +102,7 @@ class definednodes(basenodedefs):
            iterfield=['func','dim4','TR','warp_fmc'],
            name='combinetransforms'
         )
+        self.combinetransforms.inputs.ext = self.ext
         self.combinetransforms.n_procs = settings['num_threads']
 
         # align the reference image to atlas and create a dfnd mask from it
@@ -108,23 +113,26 @@ class definednodes(basenodedefs):
                     'affine_func_2_anat',
                     'affine_anat_2_atlas',
                     'warp_anat_2_atlas',
-                    'reference'
+                    'reference',
+                    'ext'
                 ],
                 output_names=['mask_file'],
                 function=create_dfnd_mask
             ),
             name='create_dfnd_mask'
         )
+        self.create_dfnd_mask.inputs.ext = self.ext
         self.create_dfnd_mask.n_procs = settings['num_threads']
 
         # apply nonlinear transform
         self.applytransforms = MapNode(
            Function(
-               input_names=['in_file','reference4D','combined_transforms4D','warp_func_2_refimg','dfnd_mask'],
+               input_names=['in_file','reference4D','combined_transforms4D','warp_func_2_refimg','dfnd_mask','ext'],
                output_names=['out_file'],
                function=applytransforms
            ),
            iterfield=['in_file','reference4D','combined_transforms4D','warp_func_2_refimg'],
            name='applytransforms'
         )
+        self.applytransforms.inputs.ext = self.ext
         self.applytransforms.n_procs = settings['num_threads']
@@ -1,7 +1,9 @@
 from nipype import Workflow
 from .nodedefs import definednodes
 from p3.base import workflowgenerator
+from p3.registry import register_workflow
 
+@register_workflow('p3_alignfunctoatlas')
 class alignfunctoatlasworkflow(workflowgenerator):
     """ Defines the align functional image to atlas workflow
 
@@ -29,9 +31,15 @@ class alignfunctoatlasworkflow(workflowgenerator):
             ]),
 
             # format the reference
+            (dn.inputnode,dn.select_metadata,[
+                ('func','func')
+            ]),
             (dn.inputnode,dn.format_reference,[
                 ('func','func')
             ]),
+            (dn.select_metadata,dn.format_reference,[
+                ('metadata','metadata')
+            ]),
             (dn.resample,dn.format_reference,[
                 ('out_file','reference')
             ]),
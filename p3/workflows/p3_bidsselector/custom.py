@@ -1,10 +1,42 @@
 """
     Define Custom Functions and Interfaces
 """
+from nipype.interfaces.io import BIDSDataGrabber
+from nipype.interfaces.base import isdefined,Undefined
 
-def avganats(anat_list):
+# Extend BIDSDataGrabber
+class IndexedBIDSDataGrabber(BIDSDataGrabber):
+    """BIDSDataGrabber querying the p3 layout index instead of indexing the dataset again
+    """
+
+    def _list_outputs(self):
+        from p3.layout import load_layout
+
+        # get the bids layout index
+        layout = load_layout(self.inputs.base_dir)
+
+        # filter on the inputs that were set
+        filters = {key: getattr(self.inputs,key) for key in self._infields if isdefined(getattr(self.inputs,key))}
+
+        # run each query
+        outputs = {}
+        for key,query in self.inputs.output_query.items():
+            args = dict(query)
+            args.update(filters)
+            filelist = layout.get(return_type='file',**args)
+            if not filelist:
+                if self.inputs.raise_on_empty:
+                    raise IOError('Output key: {} returned no files'.format(key))
+                filelist = Undefined
+            outputs[key] = filelist
+
+        # return outputs
+        return outputs
+
+def avganats(anat_list,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # get current path
     path = os.getcwd()
@@ -13,9 +45,9 @@ def avganats(anat_list):
     filelist = ' '.join(anat_list)
 
     # get filename of first file
-    outfile = '{}_avg.nii.gz'.format(get_basename(anat_list[0]))
+    outfile = '{}_avg{}'.format(get_basename(anat_list[0]),ext)
 
-    os.system('3dMean -prefix {} {}'.format(
+    run_command('3dMean -prefix {} {}'.format(
         outfile,
         filelist
     ))
@@ -27,10 +59,10 @@ def check_query(bids_query,bids_dir):
     """
         Check BIDS selection query
     """
-    from bids.grabbids import BIDSLayout
+    from p3.layout import load_layout
 
     # get bids layout
-    layout = BIDSLayout(bids_dir)
+    layout = load_layout(bids_dir)
 
     # parse bids query
     print('\n')
@@ -7,7 +7,6 @@ import os
 from p3.base import basenodedefs
 from .custom import *
 from nipype.interfaces import afni
-from nipype.interfaces.io import BIDSDataGrabber
 from nipype.interfaces.utility import Merge,Function
 from nipype import Node,MapNode
 
@@ -40,7 +39,7 @@ class definednodes(basenodedefs):
 
         # Get BIDs dataset and organize data for input
         self.bidsselection = Node(
-            BIDSDataGrabber(
+            IndexedBIDSDataGrabber(
                 base_dir=settings['bids_dir'],
                 output_query=settings['bids_query']
             ),
@@ -61,7 +60,7 @@ class definednodes(basenodedefs):
         # create node for aligning multiple T1 images to T1 reference
         self.alignanattoanat = MapNode(
             afni.Allineate(
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
             ),
             iterfield=['in_file'],
             name='alignanattoanat'
@@ -79,9 +78,10 @@ class definednodes(basenodedefs):
         # avg all anats
         self.avganat = Node(
             Function(
-                input_names=['anat_list'],
+                input_names=['anat_list','ext'],
                 output_names=['avg_anat'],
                 function=avganats
             ),
             name='avganat'
         )
+        self.avganat.inputs.ext = self.ext
@@ -1,7 +1,9 @@
 from nipype import Workflow
 from .nodedefs import definednodes
 from p3.base import workflowgenerator
+from p3.registry import register_workflow
 
+@register_workflow('p3_bidsselector')
 class bidsselectorworkflow(workflowgenerator):
     """ Defines the bids selector workflow
 
@@ -2,17 +2,18 @@
     Define Custom Functions and Interfaces
 """
 
-def join_warps(reference,affine_fs_2_anat,affine_anat_2_atlas,warp_anat_2_atlas):
+def join_warps(reference,affine_fs_2_anat,affine_anat_2_atlas,warp_anat_2_atlas,ext='.nii.gz'):
     """
         join warps to align freesurfer output to atlas
     """
     import os
+    from p3.command import run_command
 
     # get the current working directory
     cwd = os.getcwd()
 
     # just set the output name for the freesurfer concatenated transform
-    fs_concat_transform = os.path.join(cwd,'fs_concat_transform.nii.gz')
+    fs_concat_transform = os.path.join(cwd,'fs_concat_transform{}'.format(ext))
 
     # setup command for execution
     command = 'antsApplyTransforms -f 0.0 -d 3 -o [{},1] -t {} -t {} -t {} -r {} -v'.format(
@@ -22,23 +23,23 @@ def join_warps(reference,affine_fs_2_anat,affine_anat_2_atlas,warp_anat_2_atlas)
         affine_fs_2_anat,
         reference
     )
-    print(command)
 
     # run concat transforms
-    os.system(command)
+    run_command(command)
 
     # return the combined tranform
     return fs_concat_transform
 
-def apply_warp(in_file,reference,transform):
+def apply_warp(in_file,reference,transform,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # get cwd
     cwd = os.getcwd()
 
     # get filename to output
-    out_file = os.path.join(cwd,'{}_atlas.nii.gz'.format(get_basename(in_file)))
+    out_file = os.path.join(cwd,'{}_atlas{}'.format(get_basename(in_file),ext))
 
     # set up command to run
     command = 'antsApplyTransforms -f 0.0 -d 3 -i {} -r {} -o {} -t {} -v'.format(
@@ -47,21 +48,21 @@ def apply_warp(in_file,reference,transform):
         out_file,
         transform
     )
-    print(command)
 
     # run transform
-    os.system(command)
+    run_command(command)
 
     # return output
     return out_file
 
-def resample_2_epi(T1,epi,aparc_aseg=None):
+def resample_2_epi(T1,epi,aparc_aseg=None,ext='.nii.gz'):
     """
         Resample images to epi resolution
     """
     import os
     import shutil
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # get cwd
     cwd = os.getcwd()
@@ -70,10 +71,10 @@ def resample_2_epi(T1,epi,aparc_aseg=None):
     epi = epi[0]
 
     # get filename of T1
-    out_file = os.path.join(cwd,'{}_funcres.nii.gz'.format(get_basename(T1)))
+    out_file = os.path.join(cwd,'{}_funcres{}'.format(get_basename(T1),ext))
 
     # resample the T1
-    os.system('3dresample -rmode Li -master {} -prefix {} -inset {}'.format(
+    run_command('3dresample -rmode Li -master {} -prefix {} -inset {}'.format(
         epi,
         out_file,
         T1
@@ -83,10 +84,10 @@ def resample_2_epi(T1,epi,aparc_aseg=None):
     # ONLY if aparc_aseg defined
     if aparc_aseg:
         # get filename of aparc_aseg
-        out_file = os.path.join(cwd,'{}_funcres.nii.gz'.format(get_basename(aparc_aseg)))
+        out_file = os.path.join(cwd,'{}_funcres{}'.format(get_basename(aparc_aseg),ext))
 
         # resample the aparc_aseg
-        os.system('3dresample -rmode NN -master {} -prefix {} -inset {}'.format(
+        run_command('3dresample -rmode NN -master {} -prefix {} -inset {}'.format(
             epi,
             out_file,
             aparc_aseg
@@ -66,7 +66,7 @@ class definednodes(basenodedefs):
         # convert freesurfer segmentation
         self.mri_convert = Node(
             freesurfer.MRIConvert(
-                out_type='niigz'
+                out_type=self.ext.replace('.','')
             ),
             name='mri_convert'
         )
@@ -104,23 +104,25 @@ class definednodes(basenodedefs):
         # join warps (leave defaults for nonlinear warp)
         self.join_warps = Node(
             Function(
-                input_names=['reference','affine_fs_2_anat','affine_anat_2_atlas','warp_anat_2_atlas'],
+                input_names=['reference','affine_fs_2_anat','affine_anat_2_atlas','warp_anat_2_atlas','ext'],
                 output_names=['fs_concat_transform'],
                 function=join_warps
             ),
             name='join_warps'
         )
+        self.join_warps.inputs.ext = self.ext
         self.join_warps.inputs.reference = set_atlas_path(settings['atlas'])
 
         # apply atlas alignment to aparc+aseg
         self.apply_warp = Node(
             Function(
-                input_names=['in_file','reference','transform'],
+                input_names=['in_file','reference','transform','ext'],
                 output_names=['out_file'],
                 function=apply_warp
             ),
             name='apply_warp'
         )
+        self.apply_warp.inputs.ext = self.ext
         self.apply_warp.inputs.reference = set_atlas_path(settings['atlas'])
 
         # get the first run
@@ -139,14 +141,14 @@ class definednodes(basenodedefs):
         self.calc1 = Node(
             afni.Calc(
                 expr='not(equals(a,0))',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc1'
         )
         self.resample1 = Node(
             afni.Resample(
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 resample_mode='NN',
             ),
             name='resample1'
@@ -156,7 +158,7 @@ class definednodes(basenodedefs):
         self.calc2_wm = Node(
             afni.Calc(
                 expr='equals(a,2)+equals(a,7)+equals(a,41)+equals(a,46)+equals(a,251)+equals(a,252)+equals(a,253)+equals(a,254)+equals(a,255)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_wm'
@@ -167,7 +169,7 @@ class definednodes(basenodedefs):
                 afni.Calc(
                     args='-b a+i -c a-i -d a+j -e a-j -f a+k -g a-k',
                     expr='a*(1-amongst(0,b,c,d,e,f,g))',
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     overwrite=True
                 ),
                 name='calc3_wm_{}'.format(n)
@@ -176,7 +178,7 @@ class definednodes(basenodedefs):
         for n in range(5):
             self.resample2_wm.append(Node(
                 afni.Resample(
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     resample_mode='NN',
                 ),
                 name='resample2_wm_{}'.format(n)
@@ -186,7 +188,7 @@ class definednodes(basenodedefs):
         self.calc2_csf = Node(
             afni.Calc(
                 expr='equals(a,4)+equals(a,43)+equals(a,14)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_csf'
@@ -197,7 +199,7 @@ class definednodes(basenodedefs):
                 afni.Calc(
                     args='-b a+i -c a-i -d a+j -e a-j -f a+k -g a-k',
                     expr='a*(1-amongst(0,b,c,d,e,f,g))',
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     overwrite=True
                 ),
                 name='calc3_csf_{}'.format(n)
@@ -206,7 +208,7 @@ class definednodes(basenodedefs):
         for n in range(5):
             self.resample2_csf.append(Node(
                 afni.Resample(
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     resample_mode='NN',
                 ),
                 name='resample2_csf_{}'.format(n)
@@ -216,14 +218,14 @@ class definednodes(basenodedefs):
         self.calc2_gmr = Node(
             afni.Calc(
                 expr='within(a,1000,3000)+equals(a,17)+equals(a,18)+equals(a,53)+equals(a,54)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_gmr'
         )
         self.resample2_gmr = Node(
             afni.Resample(
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 resample_mode='NN',
             ),
             name='resample2_gmr'
@@ -233,7 +235,7 @@ class definednodes(basenodedefs):
         self.calc2_cb = Node(
             afni.Calc(
                 expr='equals(a,47)+equals(a,8)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_cb'
@@ -244,7 +246,7 @@ class definednodes(basenodedefs):
                 afni.Calc(
                     args='-b a+i -c a-i -d a+j -e a-j -f a+k -g a-k',
                     expr='a*(1-amongst(0,b,c,d,e,f,g))',
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     overwrite=True
                 ),
                 name='calc3_cb_{}'.format(n)
@@ -253,7 +255,7 @@ class definednodes(basenodedefs):
         for n in range(3):
             self.resample2_cb.append(Node(
                 afni.Resample(
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     resample_mode='NN',
                 ),
                 name='resample2_cb_{}'.format(n)
@@ -263,7 +265,7 @@ class definednodes(basenodedefs):
         self.calc2_scn = Node(
             afni.Calc(
                 expr='equals(a,11)+equals(a,12)+equals(a,10)+equals(a,49)+equals(a,50)+equals(a,51)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_scn'
@@ -274,7 +276,7 @@ class definednodes(basenodedefs):
                 afni.Calc(
                     args='-b a+i -c a-i -d a+j -e a-j -f a+k -g a-k',
                     expr='a*(1-amongst(0,b,c,d,e,f,g))',
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     overwrite=True
                 ),
                 name='calc3_scn_{}'.format(n)
@@ -283,7 +285,7 @@ class definednodes(basenodedefs):
         for n in range(3):
             self.resample2_scn.append(Node(
                 afni.Resample(
-                    outputtype='NIFTI_GZ',
+                    outputtype=self.outputtype,
                     resample_mode='NN',
                 ),
                 name='resample2_scn_{}'.format(n)
@@ -293,14 +295,14 @@ class definednodes(basenodedefs):
         self.calc2_gm = Node(
             afni.Calc(
                 expr='within(a,1000,3000)+equals(a,17)+equals(a,18)+equals(a,53)+equals(a,54)+equals(a,47)+equals(a,8)+equals(a,11)+equals(a,12)+equals(a,10)+equals(a,49)+equals(a,50)+equals(a,51)',
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 overwrite=True
             ),
             name='calc2_gm'
         )
         self.resample2_gm = Node(
             afni.Resample(
-                outputtype='NIFTI_GZ',
+                outputtype=self.outputtype,
                 resample_mode='NN',
             ),
             name='resample2_gm'
@@ -309,9 +311,10 @@ class definednodes(basenodedefs):
         # and finally create images of the atlas and the MPRAGE and the FS segmentation, resampled to BOLD resolution
         self.epi_resampled = Node(
             Function(
-                input_names=['T1','epi','aparc_aseg'],
+                input_names=['T1','epi','aparc_aseg','ext'],
                 output_names=['T1_epi','aparc_aseg_epi'],
                 function=resample_2_epi
             ),
             name='epi_resampled'
         )
+        self.epi_resampled.inputs.ext = self.ext
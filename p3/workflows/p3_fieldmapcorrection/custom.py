@@ -2,86 +2,41 @@
     Define Custom Functions and Interfaces
 """
 
-def get_metadata(epi_file,bids_dir):
+def get_metadata(epi_file,metadata):
     """
-        This function requires the "IntendedFor" field in the json sidecar of the field map to be defined.
-        (See section 8.3.5 of the BIDS spec)
+        Get the field map of an epi image and the parameters needed to unwarp it
+
+        metadata is the manifest entry of the image (see p3.metadata), where the
+        field map was paired with the image when the pipeline was built.
     """
 
-    import re
-    import os
     import subprocess
-    from bids.grabbids import BIDSLayout
-
-    # save to node folder (go up 2 directories bc of iterfield)
-    cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
-    # get bids layout
-    layout = BIDSLayout(bids_dir)
-
-    # get fieldmaps for epi
-    fieldmap = layout.get_fieldmap(epi_file)
-
-    # check if None; this means the IntendedFor tag is not defined; Try to guess the field map from the data
-    # TODO THIS POTENTIALLY UNSTABLE CODE. SOMEONE SHOULD COME UP WITH A BETTER WAY TO DO THIS!
-    # I assume there is only 1 fieldmap per session
-    if not fieldmap:
-        print('\n****************************************************************************')
-        print('File: {}'.format(epi_file))
-        print('IntendedFor field undefined! I\'ll try to guess the fieldmap file...\n')
-        sub = os.path.split(epi_file)[1].split("_")[0].split("sub-")[1] # set subject
-        type_ = '(phase1|phasediff|epi|fieldmap)' # get all fieldmap types
-        files = layout.get(subject=sub, type=type_, extensions=['nii.gz', 'nii']) # get the potential fmaps
-        # check files length, if 1 then there is probable only 1 session and only one fieldmap
-        if len(files) == 1:
-            fieldmap = {
-                'phasediff': files[0].filename,
-                'type': files[0].type,
-                'magnitude1': files[0].filename.replace('phasediff','magnitude1'),
-                'magnitude2': files[0].filename.replace('phasediff','magnitude2')
-            }
-        else: # assume more than one session
-            ses = os.path.split(epi_file)[1].split("_")[1].split("ses-")[1]
-            for file in files:
-                if file.session == ses: # match the session number
-                    fieldmap = {
-                        'phasediff': file.filename,
-                        'type': file.type,
-                        'magnitude1': file.filename.replace('phasediff','magnitude1'),
-                        'magnitude2': file.filename.replace('phasediff','magnitude2')
-                    }
-
-        # check if we were able to get the fieldmap
-        assert bool(fieldmap), 'We couldn\'t find a fieldmap. Specify the IntendedFor Field or disable field map correction.'
-        print('I think {} is the fieldmap. You should verify this is correct.'.format(fieldmap['phasediff']))
-        print('****************************************************************************\n')
+    # check the field map
+    fieldmap = metadata['fieldmap']
+    assert bool(fieldmap), 'We couldn\'t find a fieldmap for {}. Specify the IntendedFor Field or disable field map correction.'.format(epi_file)
 
     # we only know how to use phasediff map, anything else is not supported...
     assert fieldmap['type'] == 'phasediff', 'Non-phasediff map unsupported for field map correction.'
 
-    # get the phase diff image
+    # get the phase diff and magnitude images, and the effective echo time of phasediff
     phasediff = fieldmap['phasediff']
-
-    # get the list of magnitude images
-    magnitude = [fieldmap[key] for key in fieldmap if re.match('magnitude',key)]
-
-    # choose 1st magnitude image TODO: add setting that lets user choose magnitude image
-    magnitude = magnitude[0]
-
-    # get effective echo time of phasediff
-    echotime1 = layout.get_metadata(phasediff)['EchoTime1']
-    echotime2 = layout.get_metadata(phasediff)['EchoTime2']
-    TE = abs(echotime2 - echotime1)*1000
+    magnitude = fieldmap['magnitude']
+    TE = fieldmap['TE']
+    if TE is None:
+        raise ValueError('The phasediff map {} of {} needs EchoTime1 and EchoTime2 in its json sidecar.'.format(phasediff,epi_file))
 
     # get the echospacing for the epi image
-    echospacing = layout.get_metadata(epi_file)['EffectiveEchoSpacing']
+    echospacing = metadata['EffectiveEchoSpacing']
 
     # get the phase encoding direction
-    ped = layout.get_metadata(epi_file)['PhaseEncodingDirection']
+    ped = metadata['PhaseEncodingDirection']
 
-    # determine image orientation
-    output = subprocess.run(['3dinfo','-orient',phasediff],stdout=subprocess.PIPE)
-    orientation = output.stdout.decode('utf-8').rstrip()
+    # determine image orientation (read when the layout index was built, unless the header couldn't be read)
+    orientation = fieldmap['orientation']
+    if not orientation:
+        output = subprocess.run(['3dinfo','-orient',phasediff],stdout=subprocess.PIPE)
+        orientation = output.stdout.decode('utf-8').rstrip()
 
     if ped[0] == 'i':
         # choose orientation based on ped
@@ -118,18 +73,47 @@ def get_metadata(epi_file,bids_dir):
     # return the magnitude and phase image paths
     return (magnitude,phasediff,TE,echospacing,ped)
 
-def fsl_prepare_fieldmap(phasediff,magnitude,TE):
+def group_fieldmaps(magnitude,phasediff,TE):
+    """
+        Get the distinct field maps of the runs, and the index of the field map of each run
+    """
+
+    # list each field map once (in order of first use)
+    fieldmaps = []
+    run_fieldmap = []
+    for fieldmap in zip(magnitude,phasediff,TE):
+        if fieldmap not in fieldmaps:
+            fieldmaps.append(fieldmap)
+        run_fieldmap.append(fieldmaps.index(fieldmap))
+
+    # return the field maps and the field map of each run
+    magnitude,phasediff,TE = [list(f) for f in zip(*fieldmaps)]
+    return (magnitude,phasediff,TE,run_fieldmap)
+
+def expand_fieldmaps(magnitude,fieldmap,mask,run_fieldmap):
+    """
+        Get the processed field map images of each run from the images of the distinct field maps
+    """
+
+    return (
+        [magnitude[i] for i in run_fieldmap],
+        [fieldmap[i] for i in run_fieldmap],
+        [mask[i] for i in run_fieldmap]
+    )
+
+def fsl_prepare_fieldmap(phasediff,magnitude,TE,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # save to node folder (go up 2 directories bc of iterfield)
     cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
     # get filename to output
-    out_file = os.path.join(cwd,'{}_fieldmap.nii.gz'.format(get_basename(phasediff)))
+    out_file = os.path.join(cwd,'{}_fieldmap{}'.format(get_basename(phasediff),ext))
 
     # run prepare field map
-    os.system('fsl_prepare_fieldmap SIEMENS {} {} {} {}'.format(
+    run_command('fsl_prepare_fieldmap SIEMENS {} {} {} {}'.format(
         phasediff,
         magnitude,
         out_file,
@@ -139,7 +123,7 @@ def fsl_prepare_fieldmap(phasediff,magnitude,TE):
     # return the fieldmap file
     return out_file
 
-def convertvsm2ANTSwarp(in_file,ped):
+def convertvsm2ANTSwarp(in_file,ped,ext='.nii.gz'):
     """
         Convert the voxel shift map to ants warp
 
@@ -190,20 +174,21 @@ def convertvsm2ANTSwarp(in_file,ped):
     field = field[:, :, :, np.newaxis, :]
 
     # Write out
-    out_file = os.path.join(cwd,'{}_antswarp.nii.gz'.format(get_basename(in_file)))
+    out_file = os.path.join(cwd,'{}_antswarp{}'.format(get_basename(in_file),ext))
     nb.Nifti1Image(field.astype(np.dtype('<f4')), nii.affine, hdr).to_filename(out_file)
 
     return out_file
 
-def combinetransforms(avgepi,reference,unwarp,realign):
+def combinetransforms(avgepi,reference,unwarp,realign,ext='.nii.gz'):
     import os
     from p3.utility import get_basename
+    from p3.command import run_command
 
     # save to node folder (go up 2 directories bc of iterfield)
     cwd = os.path.dirname(os.path.dirname(os.getcwd()))
 
     # get filename to output
-    combined_transforms = os.path.join(cwd,'{}_unwarpedtransform.nii.gz'.format(get_basename(avgepi)))
+    combined_transforms = os.path.join(cwd,'{}_unwarpedtransform{}'.format(get_basename(avgepi),ext))
 
     # set up transforms
     transforms = '-t {} -t {}'.format(
@@ -218,8 +203,7 @@ def combinetransforms(avgepi,reference,unwarp,realign):
         transforms,
         reference
     )
-    print(command)
-    os.system(command)
+    run_command(command)
 
     # return the 4D combined transform
     return combined_transforms
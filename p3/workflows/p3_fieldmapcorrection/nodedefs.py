@@ -39,23 +39,35 @@ class definednodes(basenodedefs):
             (r'_realign\d{1,3}','')
         ])
 
+        # get the acquisition parameters of each run
+        self.set_metadata(settings)
+
         # get magnitude and phase
         self.get_metadata = MapNode(
             Function(
-                input_names=['epi_file','bids_dir'],
+                input_names=['epi_file','metadata'],
                 output_names=['magnitude','phasediff','TE','echospacing','ped'],
                 function=get_metadata
             ),
-            iterfield=['epi_file'],
+            iterfield=['epi_file','metadata'],
             name='get_metadata'
         )
-        self.get_metadata.inputs.bids_dir = settings['bids_dir']
+
+        # process each field map once, even when several runs share it
+        self.group_fieldmaps = Node(
+            Function(
+                input_names=['magnitude','phasediff','TE'],
+                output_names=['magnitude','phasediff','TE','run_fieldmap'],
+                function=group_fieldmaps
+            ),
+            name='group_fieldmaps'
+        )
 
         # get skullstrip of magnitude image
         self.skullstrip_magnitude = MapNode(
             fsl.BET(
                 robust=True,
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['in_file'],
             name='skullstrip_magnitude'
@@ -66,7 +78,7 @@ class definednodes(basenodedefs):
         for n in range(3):
             self.erode_magnitude.append(MapNode(
                 fsl.ErodeImage(
-                    output_type='NIFTI_GZ',
+                    output_type=self.outputtype,
                 ),
                 iterfield=['in_file'],
                 name='erode_magnitude{}'.format(n)
@@ -76,7 +88,7 @@ class definednodes(basenodedefs):
         self.create_mask = MapNode(
             fsl.maths.MathsCommand(
                 args='-bin',
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['in_file'],
             name='create_mask'
@@ -85,18 +97,19 @@ class definednodes(basenodedefs):
         # calculate fieldmap image (rad/s)
         self.calculate_fieldmap = MapNode(
             Function(
-                input_names=['phasediff','magnitude','TE'],
+                input_names=['phasediff','magnitude','TE','ext'],
                 output_names=['out_file'],
                 function=fsl_prepare_fieldmap
             ),
             iterfield=['phasediff','magnitude','TE'],
             name='calculate_fieldmap'
         )
+        self.calculate_fieldmap.inputs.ext = self.ext
 
         # apply mask to fieldmap image
         self.apply_mask = MapNode(
             fsl.ApplyMask(
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['in_file','mask_file'],
             name='apply_mask'
@@ -106,16 +119,26 @@ class definednodes(basenodedefs):
         self.unmask = MapNode(
             fsl.FUGUE(
                 save_unmasked_fmap=True,
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['fmap_in_file','mask_file'],
             name='unmask'
         )
 
+        # give each run the images of its field map
+        self.expand_fieldmaps = Node(
+            Function(
+                input_names=['magnitude','fieldmap','mask','run_fieldmap'],
+                output_names=['magnitude','fieldmap','mask'],
+                function=expand_fieldmaps
+            ),
+            name='expand_fieldmaps'
+        )
+
         # average epi image
         self.avg_epi = MapNode(
             fsl.MeanImage(
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['in_file'],
             name='avg_epi'
@@ -125,7 +148,7 @@ class definednodes(basenodedefs):
         self.skullstrip_avg_epi = MapNode(
             fsl.BET(
                 robust=True,
-                output_type="NIFTI_GZ",
+                output_type=self.outputtype,
             ),
             iterfield=['in_file'],
             name='skullstrip_avg_epi'
@@ -134,7 +157,7 @@ class definednodes(basenodedefs):
         # register field map images to the averaged epi image
         self.register_magnitude = MapNode(
             fsl.FLIRT(
-                output_type='NIFTI_GZ',
+                output_type=self.outputtype,
                 dof=6
             ),
             iterfield=['in_file','reference'],
@@ -142,7 +165,7 @@ class definednodes(basenodedefs):
         )
         self.register_fieldmap = MapNode(
             fsl.FLIRT(
-                output_type='NIFTI_GZ',
+                output_type=self.outputtype,
                 apply_xfm=True
             ),
             iterfield=['in_file','reference','in_matrix_file'],
@@ -150,7 +173,7 @@ class definednodes(basenodedefs):
         )
         self.register_mask = MapNode(
             fsl.FLIRT(
-                output_type='NIFTI_GZ',
+                output_type=self.outputtype,
                 apply_xfm=True,
                 interp='nearestneighbour'
             ),
@@ -162,7 +185,7 @@ class definednodes(basenodedefs):
         self.unwarp_epis = MapNode(
             fsl.FUGUE(
                 save_shift=True,
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             iterfield=['in_file','dwell_time','fmap_in_file','mask_file','unwarp_direction'],
             name='unwarp_epis'
@@ -171,13 +194,14 @@ class definednodes(basenodedefs):
         # Convert vsm to ANTS warp
         self.convertvsm2antswarp = MapNode(
             Function(
-                input_names=['in_file','ped'],
+                input_names=['in_file','ped','ext'],
                 output_names=['out_file'],
                 function=convertvsm2ANTSwarp
             ),
             iterfield=['in_file','ped'],
             name='convertvsm2antswarp'
         )
+        self.convertvsm2antswarp.inputs.ext = self.ext
 
         # apply fmc ant warp
         self.applyantsunwarp = MapNode(
@@ -236,11 +260,12 @@ class definednodes(basenodedefs):
         # combine transforms
         self.combine_transforms = MapNode(
             Function(
-                input_names=['avgepi','reference','unwarp','realign'],
+                input_names=['avgepi','reference','unwarp','realign','ext'],
                 output_names=['fmc_warp'],
                 function=combinetransforms
             ),
             iterfield=['avgepi','reference','unwarp','realign'],
             name='combine_transforms'
         )
+        self.combine_transforms.inputs.ext = self.ext
         self.combine_transforms.n_procs = settings['num_threads']
@@ -1,7 +1,9 @@
 from nipype import Workflow
 from .nodedefs import definednodes
 from p3.base import workflowgenerator
+from p3.registry import register_workflow
 
+@register_workflow('p3_fieldmapcorrection')
 class fieldmapcorrectionworkflow(workflowgenerator):
     """ Defines the field map correction workflow
 
@@ -21,12 +23,25 @@ class fieldmapcorrectionworkflow(workflowgenerator):
             # connect the workflow
             cls.workflow.connect([ # connect nodes
                 # get the magnitude and phase images
+                (dn.inputnode,dn.select_metadata,[
+                    ('func','func')
+                ]),
                 (dn.inputnode,dn.get_metadata,[
                     ('func','epi_file')
                 ]),
+                (dn.select_metadata,dn.get_metadata,[
+                    ('metadata','metadata')
+                ]),
+
+                # get the distinct field maps
+                (dn.get_metadata,dn.group_fieldmaps,[
+                    ('magnitude','magnitude'),
+                    ('phasediff','phasediff'),
+                    ('TE','TE')
+                ]),
 
                 # skullstrip the magnitude image
-                (dn.get_metadata,dn.skullstrip_magnitude,[
+                (dn.group_fieldmaps,dn.skullstrip_magnitude,[
                     ('magnitude','in_file')
                 ]),
 
@@ -47,7 +62,7 @@ class fieldmapcorrectionworkflow(workflowgenerator):
                 ]),
 
                 # create fieldmap image
-                (dn.get_metadata,dn.calculate_fieldmap,[
+                (dn.group_fieldmaps,dn.calculate_fieldmap,[
                     ('phasediff','phasediff'),
                     ('TE','TE')
                 ]),
@@ -79,15 +94,29 @@ class fieldmapcorrectionworkflow(workflowgenerator):
                     ('out_file','in_file')
                 ]),
 
+                # give each run the images of its field map
+                (dn.erode_magnitude[2],dn.expand_fieldmaps,[
+                    ('out_file','magnitude')
+                ]),
+                (dn.unmask,dn.expand_fieldmaps,[
+                    ('fmap_out_file','fieldmap')
+                ]),
+                (dn.create_mask,dn.expand_fieldmaps,[
+                    ('out_file','mask')
+                ]),
+                (dn.group_fieldmaps,dn.expand_fieldmaps,[
+                    ('run_fieldmap','run_fieldmap')
+                ]),
+
                 # register fieldmap outputs to avg epi
-                (dn.erode_magnitude[2],dn.register_magnitude,[ # magnitude image
-                    ('out_file','in_file')
+                (dn.expand_fieldmaps,dn.register_magnitude,[ # magnitude image
+                    ('magnitude','in_file')
                 ]),
                 (dn.skullstrip_avg_epi,dn.register_magnitude,[
                     ('out_file','reference')
                 ]),
-                (dn.unmask,dn.register_fieldmap,[ # fieldmap image
-                    ('fmap_out_file','in_file')
+                (dn.expand_fieldmaps,dn.register_fieldmap,[ # fieldmap image
+                    ('fieldmap','in_file')
                 ]),
                 (dn.register_magnitude,dn.register_fieldmap,[
                     ('out_matrix_file','in_matrix_file')
@@ -95,8 +124,8 @@ class fieldmapcorrectionworkflow(workflowgenerator):
                 (dn.skullstrip_avg_epi,dn.register_fieldmap,[
                     ('out_file','reference')
                 ]),
-                (dn.create_mask,dn.register_mask,[ # mask image
-                    ('out_file','in_file')
+                (dn.expand_fieldmaps,dn.register_mask,[ # mask image
+                    ('mask','in_file')
                 ]),
                 (dn.register_magnitude,dn.register_mask,[
                     ('out_matrix_file','in_matrix_file')
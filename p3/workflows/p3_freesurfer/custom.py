@@ -1,6 +1,17 @@
 """Define Custom Functions and Interfaces
 """
 from nipype.interfaces.utility import Function
+from nipype.interfaces import freesurfer
+from nipype.interfaces.base import traits
+
+# Extend recon-all so its thread count is not part of the node hash
+# (changing the number of threads shouldn't rerun recon-all)
+class ThreadedReconAllInputSpec(freesurfer.preprocess.ReconAllInputSpec):
+    openmp = traits.Int(argstr="-openmp %d", nohash=True, desc="Number of processors to use in parallel")
+
+# define extended recon-all
+class ThreadedReconAll(freesurfer.ReconAll):
+    input_spec = ThreadedReconAllInputSpec
 
 def gett1name(T1):
     from p3.utility import get_basename
@@ -48,30 +48,32 @@ class definednodes(basenodedefs):
 
         # Recon-all
         self.recon1 = MapNode( # for T1 mask
-            freesurfer.ReconAll(
+            ThreadedReconAll(
                 directive='autorecon1',
                 subjects_dir=os.path.join(self.freesurfer_dir,'skullstrip'),
                 parallel=True,
-                openmp=4
+                openmp=settings['num_threads']
             ),
             iterfield=['T1_files','subject_id'],
             name='recon1'
         )
+        self.recon1.n_procs = settings['num_threads']
         self.reconall = Node(
-            freesurfer.ReconAll(
+            ThreadedReconAll(
                 directive='all',
                 subjects_dir=self.freesurfer_dir,
                 parallel=True,
-                openmp=4
+                openmp=settings['num_threads']
             ),
             name='reconall'
         )
+        self.reconall.n_procs = settings['num_threads']
 
         # MRIConvert
         self.orig_convert = MapNode(
             freesurfer.MRIConvert(
                 in_type='mgz',
-                out_type='niigz'
+                out_type=self.ext.replace('.','')
             ),
             iterfield=['in_file'],
             name='orig_mriconvert'
@@ -79,7 +81,7 @@ class definednodes(basenodedefs):
         self.brainmask_convert = MapNode(
             freesurfer.MRIConvert(
                 in_type='mgz',
-                out_type='niigz'
+                out_type=self.ext.replace('.','')
             ),
             iterfield=['in_file'],
             name='brainmask_mriconvert'
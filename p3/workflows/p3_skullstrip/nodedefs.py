@@ -34,7 +34,7 @@ class definednodes(basenodedefs):
             afni.Allineate(
                 out_matrix='FSorig2MPR.aff12.1D',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file','reference'],
             name='3dallineate_orig'
@@ -44,7 +44,7 @@ class definednodes(basenodedefs):
             afni.Allineate(
                 overwrite=True,
                 no_pad=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file','reference','in_matrix'],
             name='3dallineate_brainmask'
@@ -54,7 +54,7 @@ class definednodes(basenodedefs):
         self.afni_skullstrip = MapNode(
             afni.SkullStrip(
                 args="-orig_vol",
-                outputtype="NIFTI_GZ"
+                outputtype=self.outputtype
             ),
             iterfield=['in_file'],
             name='afni_skullstrip'
@@ -64,7 +64,7 @@ class definednodes(basenodedefs):
             afni.Calc(
                 expr='step(a)',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file_a'],
             name='maskop1'
@@ -76,7 +76,7 @@ class definednodes(basenodedefs):
                     args='-b a+i -c a-i -d a+j -e a-j -f a+k -g a-k',
                     expr='ispositive(a+b+c+d+e+f+g)',
                     overwrite=True,
-                    outputtype='NIFTI_GZ'
+                    outputtype=self.outputtype
                 ),
                 iterfield=['in_file_a'],
                 name='maskop2_{}'.format(n)
@@ -102,7 +102,7 @@ class definednodes(basenodedefs):
             afni.Calc(
                 expr='a*and(b,b)',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file_a','in_file_b'],
             name='uniformintensity'
@@ -118,7 +118,7 @@ class definednodes(basenodedefs):
             afni.Calc(
                 expr='or(a,b,c)',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file_a','in_file_b','in_file_c'],
             name='maskop3'
@@ -127,7 +127,7 @@ class definednodes(basenodedefs):
             afni.Calc(
                 expr='c*and(a,b)',
                 overwrite=True,
-                outputtype='NIFTI_GZ'
+                outputtype=self.outputtype
             ),
             iterfield=['in_file_a','in_file_b','in_file_c'],
             name='maskop4'
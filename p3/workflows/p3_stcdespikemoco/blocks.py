@@ -0,0 +1,130 @@
+"""Process functional images as blocks of voxel time series, memory mapped and in a pool of processes
+
+The input is memory mapped as (voxels x frames); voxels are in file order, so
+each slice is a contiguous range of voxels. Blocks of voxels are read as
+double precision, processed by a block function, and written to memory maps
+of single precision outputs, so only a few blocks are held in memory at a
+time and long runs scale with the number of processes.
+"""
+import os
+import gzip
+import shutil
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor
+from p3.base import compress_file
+
+# values (voxels x frames) of a block processed at once (64 MB of double precision data)
+BLOCK_VALUES = 2**23
+
+def _volume(filename):
+    # get the memory map layout of an uncompressed image: (filename,(voxels,frames),dtype,offset,slope,inter)
+    img = nib.load(filename)
+    shape = img.shape
+    return (filename,(int(np.prod(shape[:3])),int(shape[3]) if len(shape) > 3 else 1),img.get_data_dtype().str,
+            int(img.dataobj.offset),float(img.dataobj.slope),float(img.dataobj.inter))
+
+def _memmap(volume,mode='r'):
+    # memory map an image as (voxels x frames)
+    filename,shape,dtype,offset,_,_ = volume
+    return np.memmap(filename,dtype=np.dtype(dtype),mode=mode,offset=offset,shape=shape,order='F')
+
+def _create_volume(filename,header,shape):
+    # create an uncompressed single precision image with the geometry (and NIfTI version) of header, returns its layout
+    header = header.copy()
+    header.extensions.clear()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1,0)
+    offset = header.single_vox_offset # header and extension flag (352 bytes for NIfTI-1, 544 for NIfTI-2)
+    header.set_data_offset(offset)
+    with open(filename,'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00'*(offset-f.tell()))
+        f.truncate(offset+int(np.prod(shape))*4)
+    return _volume(filename)
+
+def read_block(volume,start,stop):
+    """
+        Read voxels start:stop of a memory mapped image (see open_image) as (voxels x frames) double precision data
+    """
+
+    _,_,_,_,slope,inter = volume
+    data = np.asarray(_memmap(volume)[start:stop],dtype=np.float64)
+    if (slope,inter) != (1.0,0.0):
+        data = data*slope+inter
+    return data
+
+def open_image(filename,work_dir):
+    """
+        Get the memory map layout of an image, decompressing it into work_dir first if it is compressed
+
+        Returns the layout, the image header, and the decompressed file (None
+        if the image was not compressed) for the caller to remove.
+    """
+
+    source = None
+    if filename.endswith('.gz'):
+        source = os.path.join(work_dir,os.path.basename(filename)[:-len('.gz')])
+        with gzip.open(filename,'rb') as f, open(source,'wb') as g:
+            shutil.copyfileobj(f,g,1024*1024)
+    volume = _volume(source if source else filename)
+    return volume,nib.load(volume[0]).header,source
+
+def _process_block(function,in_volume,out_volumes,shape,start,stop,args):
+    # process voxels start:stop and write the outputs (run in the process pool)
+    results = function(read_block(in_volume,start,stop),start,shape,*args)
+    for volume,result in zip(out_volumes,results):
+        if volume is None:
+            continue
+        out = _memmap(volume,'r+')
+        out[start:stop] = result
+        out.flush()
+
+def process_image(in_file,out_files,function,args=(),n_procs=1,out_frames=None):
+    """
+        Process an image as blocks of voxel time series, writing the results to out_files
+
+        function(data,start,shape,*args) gets a (voxels x frames) block of
+        double precision data starting at voxel start of an image of the given
+        (x,y,z,frames) shape, and returns (voxels x frames) arrays for the files
+        of out_files (results past the last file, or for files that are None,
+        are dropped). out_frames gives the number of frames of each output
+        (None for the frames of the input, 1 writes a 3D image). The function
+        must be importable from a module, since blocks are processed by
+        n_procs processes. Compressed images (.nii.gz) are decompressed next
+        to the first output, and outputs are compressed when their file names
+        end with .gz.
+    """
+
+    # memory map the uncompressed input
+    work_dir = os.path.dirname(os.path.abspath([f for f in out_files if f][0]))
+    in_volume,header,source = open_image(in_file,work_dir)
+    voxels,frames = in_volume[1]
+    shape = header.get_data_shape()
+
+    # create the outputs
+    out_frames = out_frames if out_frames else [None]*len(out_files)
+    outputs = [f[:-len('.gz')] if f and f.endswith('.gz') else f for f in out_files]
+    out_volumes = [_create_volume(output,header,shape if n is None else shape[:3]+((n,) if n > 1 else ()))
+                   if output else None for output,n in zip(outputs,out_frames)]
+
+    # process blocks of voxels
+    block = max(1,BLOCK_VALUES//frames)
+    blocks = [(start,min(start+block,voxels)) for start in range(0,voxels,block)]
+    if n_procs > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_procs,len(blocks))) as pool:
+            jobs = [pool.submit(_process_block,function,in_volume,out_volumes,shape,start,stop,args) for start,stop in blocks]
+            for job in jobs:
+                job.result()
+    else:
+        for start,stop in blocks:
+            _process_block(function,in_volume,out_volumes,shape,start,stop,args)
+
+    # remove the decompressed input and compress the outputs
+    if source:
+        os.remove(source)
+    for filename,output in zip(out_files,outputs):
+        if filename and filename != output:
+            compress_file(output)
+    return out_files
@@ -0,0 +1,99 @@
+"""Despike functional images without AFNI
+
+Implements the 3dDespike -NEW method: each voxel time series is median
+filtered (9 frames), the filtered series is least squares fitted with a
+quadratic polynomial and corder sine/cosine pairs (corder = frames/30, at most
+50), and the spikiness of each frame is its residual divided by sigma =
+sqrt(pi/2) * the mean absolute residual. Frames with a spikiness s above
+cut1 are pulled towards the fit, to a spikiness of
+cut1+(cut2-cut1)*tanh((s-cut1)/(cut2-cut1)). Frames before ignore are copied
+unchanged and not used in the fit. All voxels are despiked (-nomask).
+
+Images are processed as memory mapped blocks of voxels in a pool of processes
+(see blocks.py).
+"""
+import numpy as np
+from .blocks import process_image
+
+# length of the median filter
+MEDIAN_LENGTH = 9
+
+# sqrt(pi/2), converting a mean absolute residual to sigma
+SQRT_PI2 = 1.2533141
+
+# fewest frames (after ignore) 3dDespike works on
+MIN_FRAMES = 15
+
+def reference_functions(frames,corder=None):
+    """
+        Get the (frames x regressors) functions the time series are fitted with
+
+        A constant, linear and quadratic term, and corder sine/cosine pairs
+        (frames/30, at most 50, if not given).
+    """
+
+    if corder is None:
+        corder = min(int(np.rint(frames/30.0)),50)
+    t = np.arange(frames)
+    centered = (t-0.5*(frames-1.0))*2.0/frames
+    refs = [np.ones(frames),centered,centered**2]
+    for k in range(1,corder+1):
+        refs += [np.sin(2*np.pi*k*t/frames),np.cos(2*np.pi*k*t/frames)]
+    return np.stack(refs,axis=1)
+
+def despike_series(series,refs,cut1=2.5,cut2=4.0):
+    """
+        Despike time series (voxels x frames), returns the despiked series and the spikiness of each frame
+
+        refs are the reference functions of the fit (see reference_functions).
+    """
+    from scipy.ndimage import median_filter
+
+    # fit the median filtered series
+    filtered = median_filter(series,size=(1,MEDIAN_LENGTH),mode='nearest')
+    fit = (filtered@np.linalg.pinv(refs).T)@refs.T
+
+    # spikiness of each frame (0 for constant series)
+    residuals = series-fit
+    sigma = SQRT_PI2*np.mean(np.abs(residuals),axis=1,keepdims=True)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        spikiness = np.where(sigma > 0,np.abs(residuals)/sigma,0.0)
+
+    # pull the spikes towards the fit
+    spikes = spikiness > cut1
+    limited = cut1+(cut2-cut1)*np.tanh((spikiness-cut1)/(cut2-cut1))
+    despiked = np.where(spikes,fit+np.sign(residuals)*sigma*limited,series)
+    return despiked,spikiness
+
+def check_frames(in_file,ignore):
+    """
+        Check a run has enough frames after ignore to be despiked (raises ValueError)
+    """
+    import nibabel as nib
+
+    frames = nib.load(in_file).shape[3]
+    if frames-ignore < MIN_FRAMES:
+        raise ValueError('{} has {} frames after ignoring {}, despiking needs at least {}.'.format(
+            in_file,frames-ignore,ignore,MIN_FRAMES))
+
+def despike_block(data,start,shape,ignore,cut1,cut2):
+    """
+        Despike a block of voxel time series (a process_image function), returns the despiked series and spikiness
+
+        Frames before ignore are copied unchanged (spikiness 0).
+    """
+
+    despiked,spikiness = despike_series(data[:,ignore:],reference_functions(data.shape[1]-ignore),cut1,cut2)
+    return (np.concatenate((data[:,:ignore],despiked),axis=1),
+            np.concatenate((np.zeros((data.shape[0],ignore)),spikiness),axis=1))
+
+def despike(in_file,out_file,spike_file=None,ignore=0,cut1=2.5,cut2=4.0,n_procs=1):
+    """
+        Despike a functional image (the 3dDespike -NEW -nomask method), writing the spikiness of each frame to spike_file
+
+        Blocks of voxels are despiked by n_procs processes.
+    """
+
+    check_frames(in_file,ignore)
+    process_image(in_file,[f for f in [out_file,spike_file] if f],despike_block,(ignore,cut1,cut2),n_procs)
+    return out_file,spike_file
@@ -34,33 +34,49 @@ class definednodes(basenodedefs):
         self.set_resubs([
             ('_moco_before\d{1,3}/',''), # get rid of _moco_before subfolders
             ('sub-(?P<subject>\w+)_','func/sub-\g<subject>_'), # place files under func folder
-            ('func/(?P<filename>\S+).nii.gz','\g<filename>.nii.gz'), # ...except for the QC files, it should NOT have a func folder
+            ('func/(?P<filename>\S+).nii(?P<gz>(.gz)?)','\g<filename>.nii\g<gz>'), # ...except for the QC files, it should NOT have a func folder
             ('func/sub-(?P<subject>\w+)_ses-(?P<session>\w+)_','func/ses-\g<session>/sub-\g<subject>_ses-\g<session>_') # add session folders if they exist
         ])
 
+        # get the acquisition parameters of each run
+        self.set_metadata(settings)
+
         # extract slice timing so we can pass it to slice time correction
         self.extract_stc = MapNode(
             Function(
-                input_names=['epi','bids_dir'],
+                input_names=['epi','metadata'],
                 output_names=['slicetiming','TR'],
                 function=extract_slicetime
             ),
-            iterfield=['epi'],
+            iterfield=['epi','metadata'],
             name='extract_slicetime'
         )
-        self.extract_stc.inputs.bids_dir = settings['bids_dir']
 
         # Despike epi data (create 2 for permutations with slice time correction)
-        self.despike = MapNode(
-            ExtendedDespike(
-                args="-ignore {} -NEW -nomask".format(
-                    settings['func_reference_frame']
+        if settings['despike_engine'] == 'native':
+            self.despike = MapNode(
+                Function(
+                    input_names=['in_file','ignore','spikes','ext'],
+                    output_names=['out_file','spike_file'],
+                    function=nativeDespike
                 ),
-                outputtype="NIFTI_GZ"
-            ),
-            iterfield=['in_file'],
-            name='despike'
-        )
+                iterfield=['in_file'],
+                name='despike'
+            )
+            self.despike.inputs.ignore = settings['func_reference_frame']
+            self.despike.inputs.spikes = settings['spike_qc']
+            self.despike.inputs.ext = self.ext
+        else:
+            self.despike = MapNode(
+                ExtendedDespike(
+                    args="-ignore {} -NEW -nomask".format(
+                        settings['func_reference_frame']
+                    ),
+                    outputtype=self.outputtype
+                ),
+                iterfield=['in_file'],
+                name='despike'
+            )
 
         # skip despike node
         self.skip_despike = MapNode(
@@ -81,16 +97,46 @@ class definednodes(basenodedefs):
         )
 
         # timeshift data
-        self.tshift = MapNode(
-            afni.TShift(
-                args="-heptic",
-                ignore=settings['func_reference_frame'],
-                tzero=0,
-                outputtype="NIFTI_GZ"
+        if settings['slicetime_engine'] == 'native':
+            self.tshift = MapNode(
+                Function(
+                    input_names=['in_file','metadata','ignore','method','ext'],
+                    output_names=['out_file'],
+                    function=nativeSliceTime
+                ),
+                iterfield=['in_file','metadata'],
+                name='tshift'
+            )
+            self.tshift.inputs.ignore = settings['func_reference_frame']
+            self.tshift.inputs.method = settings['slicetime_interpolation']
+            self.tshift.inputs.ext = self.ext
+        else:
+            self.tshift = MapNode(
+                afni.TShift(
+                    args="-heptic",
+                    ignore=settings['func_reference_frame'],
+                    tzero=0,
+                    outputtype=self.outputtype
+                ),
+                iterfield=['in_file','tpattern','tr'],
+                name='tshift'
+            )
+
+        # despike and timeshift data in one pass, extracting the reference frame for moco (native engines)
+        self.despike_tshift = MapNode(
+            Function(
+                input_names=['in_file','metadata','ignore','ref_frame','method','spikes','ext'],
+                output_names=['out_file','spike_file','ref_file'],
+                function=nativeDespikeSliceTime
             ),
-            iterfield=['in_file','tpattern','tr'],
-            name='tshift'
+            iterfield=['in_file','metadata'],
+            name='despike_tshift'
         )
+        self.despike_tshift.inputs.ignore = settings['func_reference_frame']
+        self.despike_tshift.inputs.ref_frame = settings['func_reference_frame']
+        self.despike_tshift.inputs.method = settings['slicetime_interpolation']
+        self.despike_tshift.inputs.spikes = settings['spike_qc']
+        self.despike_tshift.inputs.ext = self.ext
 
         # skip stc node
         self.skip_stc = MapNode(
@@ -124,7 +170,7 @@ class definednodes(basenodedefs):
             fsl.ExtractROI(
                 t_min=settings['func_reference_frame'],
                 t_size=1,
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             name='extractroi'
         )
@@ -143,7 +189,7 @@ class definednodes(basenodedefs):
             fsl.ExtractROI(
                 t_min=settings['func_reference_frame'],
                 t_size=1,
-                output_type='NIFTI_GZ'
+                output_type=self.outputtype
             ),
             name='extractroi_post'
         )
@@ -151,13 +197,14 @@ class definednodes(basenodedefs):
         # Moco (after)
         self.moco = MapNode(
             Function(
-                input_names=['fixed_image','moving_image','transform','writewarp'],
+                input_names=['fixed_image','moving_image','transform','writewarp','ext'],
                 output_names=['warp','mocoparams','warped_img'],
                 function=antsMotionCorr
             ),
             iterfield=['moving_image'],
             name='moco'
         )
+        self.moco.inputs.ext = self.ext
         self.moco.inputs.transform = 'Rigid'
         self.moco.inputs.writewarp = True
         self.moco.n_procs = settings['num_threads']
@@ -170,20 +217,19 @@ class definednodes(basenodedefs):
                 ),
                 verbose=True,
                 zpad=10,
-                outputtype="NIFTI_GZ"
+                outputtype=self.outputtype
             ),
             iterfield=['in_file'],
             name='moco_before'
         )
 
-        # Calc FD
-        self.calcFD = MapNode(
+        # Calc FD (for all runs at once)
+        self.calcFD = Node(
             Function(
                 input_names=['func','moco_params','brain_radius','threshold','filtered_threshold','TR','min_bpm','max_bpm'],
-                output_names=['FD','tmask','filt_moco','filt_FD','filt_tmask'],
+                output_names=['FD','tmask','filt_moco','filt_FD','filt_tmask','FD_npz'],
                 function=calcFD
             ),
-            iterfield=['moco_params','TR'],
             name='calcFD'
         )
         self.calcFD.inputs.min_bpm = settings['min_bpm']
@@ -0,0 +1,130 @@
+"""Slice time correct functional images without AFNI
+
+Each slice (along the third image axis) is shifted in time so its frames line
+up with the start of each frame (3dTShift -tzero 0): the value at frame n of
+a slice acquired t seconds into the frame is interpolated at n-t/TR. Series
+have their mean removed before shifting (so values outside the run are the
+mean) and restored after. Frames before ignore are copied unchanged and not
+used.
+
+Two interpolations are available: heptic (7th order Lagrange polynomials
+over 8 frames, as 3dTShift -heptic) and fourier (a phase shift of the series
+extended with its mirror image). Images are processed as memory mapped blocks of voxels in a
+pool of processes (see blocks.py); slice timing correction can also be fused
+with despiking, so the run is read and written once (along with the
+reference frame of motion correction).
+"""
+import numpy as np
+from .blocks import process_image
+from .despike import check_frames,despike_block
+
+# frames of the heptic interpolation, relative to the frame before the interpolated point
+HEPTIC_FRAMES = np.arange(-3,5)
+
+def slice_shifts(slice_timing,TR):
+    """
+        Get the shift (in frames) of each slice from its acquisition time (in seconds, e.g. the SliceTiming metadata)
+    """
+
+    return -np.asarray(slice_timing,dtype=float)/float(TR)
+
+def heptic_weights(fraction):
+    """
+        Get the weights of HEPTIC_FRAMES interpolating at a fraction (0 to 1) after frame 0
+    """
+
+    weights = np.ones(len(HEPTIC_FRAMES))
+    for n,j in enumerate(HEPTIC_FRAMES):
+        for m in HEPTIC_FRAMES:
+            if m != j:
+                weights[n] *= (fraction-m)/(j-m)
+    return weights
+
+def shift_series(series,shift,method='heptic'):
+    """
+        Shift time series (voxels x frames) by shift frames (the value at frame n becomes the value at n+shift)
+    """
+
+    frames = series.shape[1]
+    mean = series.mean(axis=1,keepdims=True)
+    centered = series-mean
+
+    if method == 'fourier':
+        # phase shift the series extended with its mirror image (so it has no jump where it wraps around)
+        n = 2*frames
+        spectrum = np.fft.rfft(np.concatenate((centered,centered[:,::-1]),axis=1),axis=1)
+        spectrum *= np.exp(2j*np.pi*np.fft.rfftfreq(n)*shift)
+        return np.fft.irfft(spectrum,n=n,axis=1)[:,:frames]+mean
+    if method != 'heptic':
+        raise ValueError('Unknown slice timing interpolation "{}" (heptic or fourier).'.format(method))
+
+    # interpolate from the 8 frames around each shifted frame (padded with the mean)
+    whole = int(np.floor(shift))
+    weights = heptic_weights(shift-whole)
+    pad = abs(whole)+len(HEPTIC_FRAMES)
+    padded = np.pad(centered,((0,0),(pad,pad)),mode='constant')
+    shifted = np.zeros_like(centered)
+    for weight,j in zip(weights,HEPTIC_FRAMES):
+        shifted += weight*padded[:,pad+whole+j:pad+whole+j+frames]
+    return shifted+mean
+
+def slicetime_block(data,start,shape,shifts,ignore,method):
+    """
+        Slice time correct a block of voxel time series (a process_image function)
+
+        shifts holds the shift of each slice (see slice_shifts).
+    """
+
+    # slice of each voxel of the block (voxels are in file order)
+    slices = (start+np.arange(data.shape[0]))//(shape[0]*shape[1])
+    corrected = data.copy()
+    for s in np.unique(slices):
+        rows = slices == s
+        corrected[rows,ignore:] = shift_series(data[rows,ignore:],shifts[s],method)
+    return (corrected,)
+
+def despike_slicetime_block(data,start,shape,shifts,ignore,method,cut1,cut2,ref_frame=0):
+    """
+        Despike and slice time correct a block of voxel time series (a process_image function)
+
+        Returns the corrected series, the spikiness and the corrected frame ref_frame.
+    """
+
+    despiked,spikiness = despike_block(data,start,shape,ignore,cut1,cut2)
+    corrected, = slicetime_block(despiked,start,shape,shifts,ignore,method)
+    return corrected,spikiness,corrected[:,ref_frame:ref_frame+1]
+
+def _shifts(in_file,slice_timing,TR):
+    # get the slice shifts of a run, checking there is a time for every slice
+    import nibabel as nib
+
+    slices = nib.load(in_file).shape[2]
+    if len(slice_timing) != slices:
+        raise ValueError('{} has {} slices but {} slice times.'.format(in_file,slices,len(slice_timing)))
+    return slice_shifts(slice_timing,TR)
+
+def slicetime(in_file,out_file,slice_timing,TR,ignore=0,method='heptic',n_procs=1):
+    """
+        Slice time correct a functional image with the acquisition time of each slice (in seconds) and the TR
+
+        Blocks of voxels are corrected by n_procs processes.
+    """
+
+    process_image(in_file,[out_file],slicetime_block,(_shifts(in_file,slice_timing,TR),ignore,method),n_procs)
+    return out_file
+
+def despike_slicetime(in_file,out_file,slice_timing,TR,spike_file=None,ignore=0,method='heptic',cut1=2.5,cut2=4.0,n_procs=1,
+                      ref_file=None,ref_frame=0):
+    """
+        Despike (see despike.py) then slice time correct a functional image, reading and writing it once
+
+        The spikiness of each frame is written to spike_file, and the corrected
+        frame ref_frame (e.g. the reference of motion correction) to the 3D
+        image ref_file, if they are given.
+    """
+
+    check_frames(in_file,ignore)
+    shifts = _shifts(in_file,slice_timing,TR)
+    process_image(in_file,[out_file,spike_file,ref_file],despike_slicetime_block,(shifts,ignore,method,cut1,cut2,ref_frame),
+        n_procs,out_frames=[None,None,1])
+    return out_file,spike_file,ref_file
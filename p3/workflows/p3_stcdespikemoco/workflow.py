@@ -1,7 +1,9 @@
 from nipype import Workflow
 from .nodedefs import definednodes
 from p3.base import workflowgenerator
+from p3.registry import register_workflow
 
+@register_workflow('p3_stcdespikemoco')
 class stcdespikemocoworkflow(workflowgenerator):
     """ Defines the slice time correction, despike, motion correction workflow
 
@@ -19,9 +21,15 @@ class stcdespikemocoworkflow(workflowgenerator):
         # connect the workflow
         cls.workflow.connect([ # connect nodes
             ### Extract Slice timing info + TR
+            (dn.inputnode,dn.select_metadata,[
+                ('func','func')
+            ]),
             (dn.inputnode,dn.extract_stc,[
                 ('func','epi')
             ]),
+            (dn.select_metadata,dn.extract_stc,[
+                ('metadata','metadata')
+            ]),
 
             # Setup basefile for motion correction (pre-stc/despike)
             (dn.inputnode,dn.refrunonly,[
@@ -47,30 +55,7 @@ class stcdespikemocoworkflow(workflowgenerator):
                 ('TR','TR')
             ]),
 
-            # Setup basefile for motion correction (post-stc/despike)
-            (dn.stc_despike_pool,dn.refrunonly_post,[
-                ('epi','epi')
-            ]),
-            (dn.refrunonly_post,dn.extractroi_post,[
-                ('epi','in_file')
-            ]),
-
-            ### Do motion correction (after stc/despike)
-            # Align to ref frame of ref run
-            (dn.extractroi_post,dn.moco,[
-                ('roi_file','fixed_image')
-            ]),
-            (dn.stc_despike_pool,dn.moco,[
-                ('epi','moving_image')
-            ]),
-
             # output to output node
-            (dn.extractroi_post,dn.outputnode,[
-                ('roi_file','refimg')
-            ]),
-            (dn.stc_despike_pool,dn.outputnode,[
-                ('epi','func_stc_despike')
-            ]),
             (dn.moco,dn.outputnode,[
                 ('warp','warp_func_2_refimg')
             ]),
@@ -93,49 +78,128 @@ class stcdespikemocoworkflow(workflowgenerator):
                 ('filt_moco','p3.@filt_moco'), # filtered moco
                 ('filt_FD','p3.@filt_FD'), # filtered FD
                 ('filt_tmask','p3.@filt_tmask'), # filtered tmask
+                ('FD_npz','p3.@FD_npz'), # all of the above in one file
             ])
         ])
 
         # Conditionals for Time Shift/Despiking
-        if settings['despiking']:
+        fuse = (settings['despiking'] and settings['slice_time_correction'] and settings['fuse_despike_stc']
+            and settings['despike_engine'] == 'native' and settings['slicetime_engine'] == 'native')
+        if fuse:
+            # despike and time shift in one pass, then motion correct the uncompressed output
+            # to the reference frame extracted in the same pass (no pools or extractroi_post)
             cls.workflow.connect([
-                (dn.inputnode,dn.despike,[ # despike
+                (dn.inputnode,dn.despike_tshift,[
                     ('func','in_file')
                 ]),
-                (dn.despike,dn.despike_pool,[
-                    ('out_file','epi')
-                ])
-            ])
-        else:
-            cls.workflow.connect([
-                (dn.inputnode,dn.skip_despike,[ # skip despike
-                    ('func','epi')
+                (dn.select_metadata,dn.despike_tshift,[
+                    ('metadata','metadata')
                 ]),
-                (dn.skip_despike,dn.despike_pool,[
-                    ('epi','epi')
-                ])
-            ])
-        if settings['slice_time_correction']:
-            cls.workflow.connect([
-                (dn.despike_pool,dn.tshift,[ # time shift
-                    ('epi','in_file')
+                (dn.despike_tshift,dn.refrunonly_post,[
+                    ('ref_file','epi')
+                ]),
+                (dn.refrunonly_post,dn.moco,[
+                    ('epi','fixed_image')
                 ]),
-                (dn.extract_stc,dn.tshift,[
-                    ('slicetiming','tpattern'),
-                    ('TR','tr')
+                (dn.despike_tshift,dn.moco,[
+                    ('out_file','moving_image')
                 ]),
-                (dn.tshift,dn.stc_despike_pool,[
-                    ('out_file','epi')
+                (dn.refrunonly_post,dn.outputnode,[
+                    ('epi','refimg')
                 ]),
+                (dn.despike_tshift,dn.outputnode,[
+                    ('out_file','func_stc_despike')
+                ])
             ])
+            if settings['spike_qc']:
+                cls.workflow.connect([
+                    (dn.despike_tshift,dn.datasink,[ # output spikiness for QC
+                        ('spike_file','p3_QC.stcdespikemoco.@spikes')
+                    ])
+                ])
         else:
+            if settings['despiking']:
+                cls.workflow.connect([
+                    (dn.inputnode,dn.despike,[ # despike
+                        ('func','in_file')
+                    ]),
+                    (dn.despike,dn.despike_pool,[
+                        ('out_file','epi')
+                    ])
+                ])
+                if settings['spike_qc']:
+                    cls.workflow.connect([
+                        (dn.despike,dn.datasink,[ # output spikiness for QC
+                            ('spike_file','p3_QC.stcdespikemoco.@spikes')
+                        ])
+                    ])
+            else:
+                cls.workflow.connect([
+                    (dn.inputnode,dn.skip_despike,[ # skip despike
+                        ('func','epi')
+                    ]),
+                    (dn.skip_despike,dn.despike_pool,[
+                        ('epi','epi')
+                    ])
+                ])
+            if settings['slice_time_correction']:
+                cls.workflow.connect([
+                    (dn.despike_pool,dn.tshift,[ # time shift
+                        ('epi','in_file')
+                    ]),
+                    (dn.tshift,dn.stc_despike_pool,[
+                        ('out_file','epi')
+                    ]),
+                ])
+                if settings['slicetime_engine'] == 'native':
+                    # slice times are read from the manifest entry of each run
+                    cls.workflow.connect([
+                        (dn.select_metadata,dn.tshift,[
+                            ('metadata','metadata')
+                        ])
+                    ])
+                else:
+                    cls.workflow.connect([
+                        (dn.extract_stc,dn.tshift,[
+                            ('slicetiming','tpattern'),
+                            ('TR','tr')
+                        ])
+                    ])
+            else:
+                cls.workflow.connect([
+                    (dn.despike_pool,dn.skip_stc,[ # skip time shift
+                        ('epi','epi')
+                    ]),
+                    (dn.skip_stc,dn.stc_despike_pool,[
+                        ('epi','epi')
+                    ]),
+                ])
+
+            # Setup basefile for motion correction (post-stc/despike)
             cls.workflow.connect([
-                (dn.despike_pool,dn.skip_stc,[ # skip time shift
+                (dn.stc_despike_pool,dn.refrunonly_post,[
                     ('epi','epi')
                 ]),
-                (dn.skip_stc,dn.stc_despike_pool,[
-                    ('epi','epi')
+                (dn.refrunonly_post,dn.extractroi_post,[
+                    ('epi','in_file')
+                ]),
+
+                ### Do motion correction (after stc/despike)
+                # Align to ref frame of ref run
+                (dn.extractroi_post,dn.moco,[
+                    ('roi_file','fixed_image')
                 ]),
+                (dn.stc_despike_pool,dn.moco,[
+                    ('epi','moving_image')
+                ]),
+
+                # output to output node
+                (dn.extractroi_post,dn.outputnode,[
+                    ('roi_file','refimg')
+                ]),
+                (dn.stc_despike_pool,dn.outputnode,[
+                    ('epi','func_stc_despike')
+                ])
             ])
 
         # return workflow
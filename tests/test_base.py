@@ -4,6 +4,8 @@ from p3.base import *
 from p3.settings import default_preproc_settings
 from nipype import Node,Workflow
 import tempfile
+import gzip
+import os
 
 class test(unittest.TestCase):
     def test_basenodedefs(self):
@@ -34,6 +36,30 @@ class test(unittest.TestCase):
             dn.datasink,
             Node
         )
+    def test_compress_intermediates(self):
+        settings = default_preproc_settings()
+        settings['output_dir'] = tempfile.TemporaryDirectory().name
+        settings['compress_intermediates'] = False
+        dn = basenodedefs(settings)
+        self.assertEqual(dn.ext,'.nii')
+        self.assertIsInstance(
+            dn.datasink.interface,
+            CompressingDataSink
+        )
+
+        # the datasink compresses the images it copies
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp,'image.nii')
+            with open(image,'wb') as f:
+                f.write(b'p3'*1000)
+            sink = CompressingDataSink(base_directory=os.path.join(tmp,'out'))
+            sink.inputs.test = image
+            out_file = sink.run().outputs.out_file
+            self.assertEqual(out_file,[os.path.join(tmp,'out','test','image.nii.gz')])
+            out_file = out_file[0]
+            with gzip.open(out_file,'rb') as f:
+                self.assertEqual(f.read(),b'p3'*1000)
+            self.assertFalse(os.path.exists(os.path.join(tmp,'out','test','image.nii')))
     def test_workflowgnerator(self):
         settings = default_preproc_settings()
         settings['tmp_dir'] = tempfile.TemporaryDirectory().name
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import unittest
+from p3.cleanup import *
+from p3.scheduler import P3MultiProcPlugin
+from nipype import Node,Workflow
+from nipype.interfaces.utility import Function
+import os
+import glob
+import tempfile
+
+def write_file(in_file):
+    # write a new file in the node directory
+    import os
+    out_file = os.path.join(os.getcwd(),'out.txt')
+    with open(out_file,'w') as f:
+        f.write('data')
+    return out_file
+
+def pass_file(in_file):
+    return in_file
+
+class test(unittest.TestCase):
+    def test_eager_cleanup(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # first -> second -> passthrough -> last (last passes the file of second through)
+            wf = Workflow(name='test',base_dir=tmp_dir)
+            first = Node(Function(input_names=['in_file'],output_names=['out_file'],function=write_file),name='first')
+            first.inputs.in_file = ''
+            second = Node(Function(input_names=['in_file'],output_names=['out_file'],function=write_file),name='second')
+            passthrough = Node(Function(input_names=['in_file'],output_names=['out_file'],function=pass_file),name='passthrough')
+            last = Node(Function(input_names=['in_file'],output_names=['out_file'],function=pass_file),name='last')
+            wf.connect([
+                (first,second,[('out_file','in_file')]),
+                (second,passthrough,[('out_file','in_file')]),
+                (passthrough,last,[('out_file','in_file')])
+            ])
+            wf.run(plugin=P3MultiProcPlugin(plugin_args={'n_procs': 1,'cleanup_dir': tmp_dir}))
+
+            # the consumed file is deleted (and its node will rerun if needed)
+            first_dir = os.path.join(tmp_dir,'test','first')
+            self.assertFalse(os.path.exists(os.path.join(first_dir,'out.txt')))
+            self.assertEqual(glob.glob(os.path.join(first_dir,'_0x*.json')),[])
+            self.assertTrue(os.path.exists(os.path.join(first_dir,'result_first.pklz')))
+
+            # the file passed through to the last node is kept
+            second_dir = os.path.join(tmp_dir,'test','second')
+            self.assertTrue(os.path.exists(os.path.join(second_dir,'out.txt')))
+            self.assertNotEqual(glob.glob(os.path.join(second_dir,'_0x*.json')),[])
+
+if __name__ == '__main__':
+    unittest.main()
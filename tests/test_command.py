@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.command import *
+from p3.trace import start_trace,stop_trace,load_events
+import os
+import tempfile
+
+class test(unittest.TestCase):
+    def test_run_command(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch('os.getcwd',return_value=tmp_dir):
+            # output goes to the node log and the thread count is set
+            with patch.dict(os.environ,{THREADS_ENV: '3'}):
+                run_command('echo $OMP_NUM_THREADS $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+            with open(os.path.join(tmp_dir,COMMAND_LOG),'r') as f:
+                self.assertEqual(f.read().splitlines()[-1],'3 3')
+
+            # failures raise errors with the end of the log
+            with self.assertRaisesRegex(CommandError,'exit code 2'):
+                run_command('echo oops; exit 2')
+            with self.assertRaises(CommandError):
+                run_command('sleep 10',timeout=0.2)
+
+    def test_command_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch('os.getcwd',return_value=tmp_dir):
+            # commands are recorded in the trace
+            start_trace(os.path.join(tmp_dir,'events'))
+            try:
+                run_command('true')
+            finally:
+                stop_trace()
+            events = load_events(os.path.join(tmp_dir,'events'))
+            self.assertEqual([(e['kind'],e['name'],e['status']) for e in events],[('command','true','ok')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import unittest
+from p3.graphcache import *
+from p3.pipeline import create_and_run_p3_workflow
+from p3.settings import default_preproc_settings
+import os
+import tempfile
+from nipype import Workflow
+from mock import patch
+from .mock_stdout import MockDevice
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+class test(unittest.TestCase):
+    def test_graph_key(self):
+        settings = default_preproc_settings()
+        key = graph_key(settings,'dataset')
+
+        # settings that only change how the pipeline runs keep the key
+        settings['n_procs'] = 64
+        settings['hash_cache'] = not settings['hash_cache']
+        self.assertEqual(graph_key(settings,'dataset'),key)
+
+        # settings that change the graph, and the dataset, change the key
+        self.assertNotEqual(graph_key(settings,'changed dataset'),key)
+        settings['despiking'] = not settings['despiking']
+        self.assertNotEqual(graph_key(settings,'dataset'),key)
+
+    def test_save_load_graph(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir,GRAPH_CACHE_DIR,'graph.pklz')
+            self.assertIsNone(load_graph(filename))
+            save_graph(Workflow(name='test_graph',base_dir=tmp_dir),filename)
+            self.assertEqual(load_graph(filename).name,'test_graph')
+            self.assertEqual(os.listdir(os.path.dirname(filename)),['graph.pklz'])
+
+            # an unreadable cache is rebuilt
+            with open(filename,'wb') as f:
+                f.write(b'broken')
+            self.assertIsNone(load_graph(filename))
+
+    def test_cached_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch('sys.stdout',new=MockDevice()) as fake_out:
+            settings = default_preproc_settings()
+            settings['output_dir'] = tmp_dir
+            settings['tmp_dir'] = os.path.join(tmp_dir,'tmp')
+            settings['bids_dir'] = os.path.join(current_dir,'example_data')
+            settings['subject'] = ['01']
+            settings['debug'] = False
+            settings['disable_run'] = True
+
+            # the first run builds and caches the graph, the second loads it
+            create_and_run_p3_workflow(None,settings)
+            self.assertEqual(len(os.listdir(os.path.join(settings['tmp_dir'],GRAPH_CACHE_DIR))),1)
+            with patch('p3.pipeline.generate_subworkflows') as generate:
+                create_and_run_p3_workflow(None,settings)
+                generate.assert_not_called()
+
+                # rebuilding ignores the cache
+                settings['rebuild_graph'] = True
+                with self.assertRaises(Exception):
+                    create_and_run_p3_workflow(None,settings)
+                generate.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import unittest
+from p3.graphs import *
+from nipype import Workflow,Node,MapNode
+from nipype.interfaces.utility import IdentityInterface
+import os
+import json
+import tempfile
+
+def create_workflow():
+    # a pipeline with a subworkflow holding a node with iterables and a MapNode
+    sub = Workflow(name='sub')
+    input_node = Node(IdentityInterface(fields=['a']),name='input')
+    input_node.iterables = [('a',[1,2])]
+    map_node = MapNode(IdentityInterface(fields=['b']),iterfield=['b'],name='map')
+    sub.connect(input_node,'a',map_node,'b')
+    pipeline = Workflow(name='pipeline')
+    output_node = Node(IdentityInterface(fields=['c']),name='output')
+    pipeline.connect(sub,'map.b',output_node,'c')
+    return pipeline
+
+class test(unittest.TestCase):
+    def test_graph_description(self):
+        description = graph_description(create_workflow())
+        self.assertEqual(description['name'],'pipeline')
+        nodes = {node['id']: node for node in description['nodes']}
+        self.assertEqual(sorted(nodes),['pipeline.output','pipeline.sub.input','pipeline.sub.map'])
+        self.assertEqual(nodes['pipeline.sub.input']['iterables'],['a'])
+        self.assertEqual(nodes['pipeline.sub.input']['workflow'],'pipeline.sub')
+        self.assertTrue(nodes['pipeline.sub.map']['mapnode'])
+        self.assertEqual(nodes['pipeline.output']['interface'],'IdentityInterface')
+        self.assertEqual(description['edges'],[
+            {'source': 'pipeline.sub.input','target': 'pipeline.sub.map','links': [['a','b']]},
+            {'source': 'pipeline.sub.map','target': 'pipeline.output','links': [['b','c']]}
+        ])
+
+    def test_graph_writer(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # json graphs of the pipeline and its subworkflows are written in the background
+            writer = GraphWriter(create_workflow(),tmp_dir,['json']).start()
+            writer.wait()
+            self.assertEqual(sorted(os.listdir(tmp_dir)),['p3','sub'])
+            with open(os.path.join(tmp_dir,'sub','graph.json'),'r') as f:
+                self.assertEqual(json.load(f)['name'],'sub')
+
+            # failures are logged, not raised
+            open(os.path.join(tmp_dir,'file'),'w').close()
+            for background in [True,False]:
+                GraphWriter(create_workflow(),os.path.join(tmp_dir,'file'),['json'],background).start().wait()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import unittest
+from p3.group import *
+from p3.motion import calc_fd,write_fd
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from mock import patch
+from .mock_stdout import MockDevice
+
+def create_outputs(output_dir):
+    # FD outputs of 3 runs of 2 subjects (the last run only has text files without the filtered outputs)
+    rng = np.random.RandomState(0)
+    runs = {
+        'sub-01/func/ses-1/sub-01_ses-1_task-rest_run-1_bold_moco': 40,
+        'sub-01/func/ses-1/sub-01_ses-1_task-rest_run-2_bold_moco': 30,
+        'sub-02/func/sub-02_task-rest_bold_moco': 20
+    }
+    for n,(name,frames) in enumerate(runs.items()):
+        prefix = os.path.join(output_dir,'p3',name)
+        os.makedirs(os.path.dirname(prefix),exist_ok=True)
+        results = calc_fd([rng.randn(frames,6)*0.1],[2.0],50,0.2,0.1,18.582,25.7263)
+        files = write_fd(prefix,results,0)
+        if n == 2:
+            for filename in files[2:]:
+                os.remove(filename)
+    return runs
+
+class test(unittest.TestCase):
+    def test_group(self):
+        with tempfile.TemporaryDirectory() as output_dir, patch('sys.stdout',new=MockDevice()) as fake_out:
+            runs = create_outputs(output_dir)
+
+            # every run is found (or only those of the selected subjects)
+            prefixes = find_fd_files(output_dir)
+            self.assertEqual(prefixes,sorted(os.path.join(output_dir,'p3',name) for name in runs))
+            self.assertEqual(len(find_fd_files(output_dir,['02'])),1)
+
+            # one row per frame
+            table = load_fd_table(prefixes)
+            self.assertEqual(len(table),90)
+            self.assertEqual(table['frame'].max(),39)
+            self.assertEqual(list(table[table['subject'] == '02']['frame']),list(range(20)))
+            self.assertTrue(table[table['subject'] == '02']['filt_FD'].isnull().all())
+            np.testing.assert_allclose(table[table['run'] == '2']['FD'],np.loadtxt(prefixes[1]+'.FD'))
+
+            # per run statistics
+            summary = run_group(output_dir).set_index('run')
+            FD = np.loadtxt(prefixes[1]+'.FD')
+            tmask = np.loadtxt(prefixes[1]+'.tmask')
+            self.assertEqual(summary.loc['2','frames'],30)
+            self.assertEqual(summary.loc['2','retained'],tmask.sum())
+            self.assertEqual(summary.loc['2','censored'],30-tmask.sum())
+            self.assertAlmostEqual(summary.loc['2','retention'],tmask.mean())
+            self.assertAlmostEqual(summary.loc['2','mean_FD'],FD.mean())
+            self.assertEqual(summary.loc['2','session'],'1')
+
+            # tables are written to the group folder
+            subjects = pd.read_csv(os.path.join(output_dir,GROUP_DIR,'motion_subjects.tsv'),sep='\t',dtype={'subject': str})
+            self.assertEqual(list(subjects['subject']),['01','02'])
+            self.assertEqual(list(subjects['runs']),[2,1])
+            self.assertEqual(list(subjects['frames']),[70,20])
+            self.assertTrue(os.path.exists(os.path.join(output_dir,GROUP_DIR,'motion_runs.tsv')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.hashcache import *
+from nipype.utils import filemanip
+import os
+import tempfile
+
+class test(unittest.TestCase):
+    def test_hash_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # create a file to hash
+            filename = os.path.join(tmp_dir,'func.nii.gz')
+            with open(filename,'w') as f:
+                f.write('run 1')
+            cache_file = os.path.join(tmp_dir,'hash_cache.json')
+            cache = HashCache(cache_file)
+            cache.prime([filename])
+            md5 = filemanip.hash_infile(filename)
+            self.assertEqual(cache.hash_infile(filename),md5)
+
+            # a new cache reads the hash from the journal without reading the file
+            with patch('p3.hashcache._hash_infile') as hash_infile:
+                self.assertEqual(HashCache(cache_file).hash_infile(filename),md5)
+                hash_infile.assert_not_called()
+
+            # a changed file is hashed again
+            with open(filename,'w') as f:
+                f.write('run 2 (changed)')
+            self.assertEqual(cache.hash_infile(filename),filemanip.hash_infile(filename))
+            self.assertNotEqual(cache.hash_infile(filename),md5)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # hash many files from several threads
+            files = [os.path.join(tmp_dir,'run-{}.nii.gz'.format(n)) for n in range(50)]
+            for n,filename in enumerate(files):
+                with open(filename,'w') as f:
+                    f.write('run {}'.format(n))
+            cache_file = os.path.join(tmp_dir,'hash_cache.json')
+            cache = HashCache(cache_file)
+            other = HashCache(cache_file)
+            cache.prime(files)
+            self.assertEqual(len(cache._hashes),len(files))
+
+            # a line that can't be parsed is passed over, and later entries are still read
+            with open(cache_file,'a') as f:
+                f.write('not json\n')
+            filename = os.path.join(tmp_dir,'new.nii.gz')
+            with open(filename,'w') as f:
+                f.write('new run')
+            md5 = other.hash_infile(filename)
+            with patch('p3.hashcache._hash_infile') as hash_infile:
+                self.assertEqual(cache.hash_infile(filename),md5)
+                self.assertEqual(other.hash_infile(files[0]),cache.hash_infile(files[0]))
+                hash_infile.assert_not_called()
+            self.assertEqual(cache._offset,os.path.getsize(cache_file))
+
+    def test_install_hash_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # nipype hashing goes through the cache until it is uninstalled
+            cache = install_hash_cache(os.path.join(tmp_dir,'hash_cache.json'))
+            try:
+                from nipype.interfaces.base import specs
+                self.assertEqual(specs.hash_infile,cache.hash_infile)
+            finally:
+                uninstall_hash_cache()
+            self.assertEqual(filemanip.hash_infile.__module__,'nipype.utils.filemanip')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.layout import *
+from p3 import layout as p3layout
+from bids.grabbids import BIDSLayout
+import os
+import json
+import shutil
+import tempfile
+import nibabel
+import numpy as np
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+class test(unittest.TestCase):
+    def test_load_layout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # copy the example dataset and store its index in the temp directory
+            bids_dir = os.path.join(tmp_dir,'bids')
+            shutil.copytree(os.path.join(current_dir,'example_data'),bids_dir)
+            with patch.dict(os.environ,{LAYOUT_ENV: os.path.join(tmp_dir,'layouts')}), patch.dict(p3layout._indexes,clear=True):
+                os.environ.pop(INDEX_ENV,None)
+
+                # the index answers like a pybids layout
+                index = load_layout(bids_dir)
+                self.assertTrue(os.path.exists(index_file(bids_dir)))
+                bold = index.get(type='bold',subject='01',return_type='file')
+                self.assertEqual(bold,BIDSLayout(bids_dir).get(type='bold',subject='01',return_type='file'))
+                self.assertEqual(index.get_metadata(bold[0]),BIDSLayout(bids_dir).get_metadata(bold[0]))
+
+                # a new process loads the stored index instead of indexing the dataset
+                p3layout._indexes.clear()
+                with patch('p3.layout.BIDSLayout') as layout:
+                    self.assertEqual(load_layout(bids_dir).fingerprint,index.fingerprint)
+                    layout.assert_not_called()
+
+                # a changed dataset is indexed again
+                open(os.path.join(bids_dir,'sub-01','ses-1','func','sub-01_ses-1_task-rest_acq-fullbrain_run-9_bold.nii.gz'),'w').close()
+                new_index = load_layout(bids_dir)
+                self.assertNotEqual(new_index.fingerprint,index.fingerprint)
+                self.assertEqual(len(new_index.get(type='bold',subject='01')),len(bold)+1)
+
+                # a validated index is trusted without checking the dataset
+                validate_layout(bids_dir)
+                try:
+                    with patch('p3.layout.dataset_fingerprint') as fingerprint:
+                        self.assertIs(load_layout(bids_dir),new_index)
+                        fingerprint.assert_not_called()
+                finally:
+                    os.environ.pop(INDEX_ENV,None)
+
+    def test_fingerprint_skips_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bids_dir = os.path.join(tmp_dir,'bids')
+            shutil.copytree(os.path.join(current_dir,'example_data'),bids_dir)
+            fingerprint = dataset_fingerprint(bids_dir,exclude=[])
+
+            # derivatives, sourcedata, hidden entries and excluded folders don't change the fingerprint
+            for folder in ['derivatives/p3','sourcedata','.git','sub-01/.cache','work']:
+                os.makedirs(os.path.join(bids_dir,folder))
+                open(os.path.join(bids_dir,folder,'file.txt'),'w').close()
+            self.assertEqual(dataset_fingerprint(bids_dir,exclude=[os.path.join(bids_dir,'work')]),fingerprint)
+            with patch.dict(os.environ,{EXCLUDE_ENV: os.path.join(bids_dir,'work')}):
+                self.assertEqual(dataset_fingerprint(bids_dir),fingerprint)
+
+            # ...other files do
+            self.assertNotEqual(dataset_fingerprint(bids_dir,exclude=[]),fingerprint)
+
+    def test_fieldmap_index(self):
+        bids_dir = os.path.join(current_dir,'example_data')
+        index = BIDSIndex(bids_dir,dataset_fingerprint(bids_dir))
+        func = os.path.join(bids_dir,'sub-01','ses-1','func','sub-01_ses-1_task-rest_acq-{}_bold.nii.gz')
+        fmap = os.path.join(bids_dir,'sub-01','ses-1','fmap','sub-01_ses-1_run-{}_{}.nii.gz')
+
+        # runs listed in IntendedFor get that field map
+        entry = index.get_fieldmap_entry(func.format('fullbrain_run-1'))
+        self.assertEqual(entry['phasediff'],fmap.format(1,'phasediff'))
+        self.assertEqual(entry['magnitude'],fmap.format(1,'magnitude1'))
+        self.assertAlmostEqual(entry['TE'],1.02)
+        self.assertFalse(entry['guessed'])
+
+        # other runs get a field map of their session
+        entry = index.get_fieldmap_entry(func.format('prefrontal'))
+        self.assertEqual(os.path.dirname(entry['phasediff']),os.path.dirname(fmap))
+        self.assertTrue(entry['guessed'])
+
+    def test_fieldmap_without_echo_times(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a phasediff sidecar without echo times
+            bids_dir = os.path.join(tmp_dir,'bids')
+            shutil.copytree(os.path.join(current_dir,'example_data'),bids_dir)
+            sidecar = os.path.join(bids_dir,'sub-01','ses-1','fmap','sub-01_ses-1_run-1_phasediff.json')
+            with open(sidecar,'r') as f:
+                metadata = json.load(f)
+            metadata.pop('EchoTime1')
+            metadata.pop('EchoTime2')
+            with open(sidecar,'w') as f:
+                json.dump(metadata,f)
+
+            # the index is still built, the field map just has no TE
+            index = BIDSIndex(bids_dir,dataset_fingerprint(bids_dir))
+            func = os.path.join(bids_dir,'sub-01','ses-1','func','sub-01_ses-1_task-rest_acq-fullbrain_run-1_bold.nii.gz')
+            entry = index.get_fieldmap_entry(func)
+            self.assertEqual(entry['type'],'phasediff')
+            self.assertIsNone(entry['TE'])
+
+            # ...which is reported when the field map is used
+            from p3.workflows.p3_fieldmapcorrection.custom import get_metadata
+            with self.assertRaises(ValueError):
+                get_metadata(func,{'fieldmap': entry,'EffectiveEchoSpacing': 0.0005,'PhaseEncodingDirection': 'j-'})
+
+    def test_afni_orientation(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # an image with an identity affine is RAS+ in nibabel and LPI in afni
+            image = os.path.join(tmp_dir,'image.nii.gz')
+            nibabel.save(nibabel.Nifti1Image(np.zeros((2,2,2),dtype=np.int16),np.eye(4)),image)
+            self.assertEqual(afni_orientation(image),'LPI')
+            self.assertIsNone(afni_orientation(os.path.join(tmp_dir,'missing.nii.gz')))
+
+if __name__ == '__main__':
+    unittest.main()
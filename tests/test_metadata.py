@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.metadata import *
+from p3.layout import LAYOUT_ENV
+from p3.settings import default_preproc_settings
+from bids.grabbids import BIDSLayout
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+class test(unittest.TestCase):
+    def test_build_manifest(self):
+        settings = default_preproc_settings()
+        settings['bids_dir'] = os.path.join(current_dir,'example_data')
+        settings['subject'] = ['01']
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.dict(os.environ,{LAYOUT_ENV: tmp_dir}), \
+                patch.dict('p3.metadata._manifests',clear=True):
+            # guessed field maps are logged, not printed
+            with redirect_stdout(io.StringIO()) as output, self.assertLogs('nipype.workflow',level='WARNING') as logs:
+                manifest = build_manifest(settings)
+            self.assertEqual(output.getvalue(),'')
+            self.assertTrue(any('guessed' in message for message in logs.output))
+
+            # every run gets its sidecar fields and a phasediff field map
+            layout = BIDSLayout(settings['bids_dir'])
+            bold = layout.get(subject='01',type='bold',return_type='file')
+            self.assertEqual(sorted(manifest),sorted(f for f in bold if f.endswith('.nii.gz')))
+            for epi,entry in manifest.items():
+                self.assertEqual(entry['RepetitionTime'],layout.get_metadata(epi)['RepetitionTime'])
+                self.assertEqual(entry['SliceTiming'],layout.get_metadata(epi)['SliceTiming'])
+                self.assertEqual(entry['fieldmap']['type'],'phasediff')
+                self.assertGreater(entry['fieldmap']['TE'],0)
+
+            # the manifest is built once
+            with patch('p3.metadata.get_subject_files') as get_files:
+                self.assertIs(build_manifest(settings),manifest)
+                get_files.assert_not_called()
+
+    def test_select_metadata(self):
+        settings = default_preproc_settings()
+        settings['bids_dir'] = os.path.join(current_dir,'example_data')
+        manifest = {
+            '/data/sub-01_run-1_bold.nii.gz': {'RepetitionTime': 2.0},
+            '/data/sub-01_run-2_bold.nii.gz': {'RepetitionTime': 3.0},
+            '/data/sub-02_run-1_bold.nii.gz': {'RepetitionTime': 4.0}
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir, patch('p3.metadata.build_manifest',return_value=manifest):
+            settings['tmp_dir'] = tmp_dir
+            manifest_dir = write_manifest(settings)
+
+            # each subject gets its own file
+            self.assertEqual(sorted(os.listdir(manifest_dir)),['sub-01.json','sub-02.json'])
+            self.assertEqual(
+                select_metadata(['/data/sub-01_run-2_bold.nii.gz','/data/sub-01_run-1_bold.nii.gz'],manifest_dir),
+                [{'RepetitionTime': 3.0},{'RepetitionTime': 2.0}]
+            )
+            with self.assertRaises(ValueError):
+                select_metadata(['/data/sub-01_run-3_bold.nii.gz'],manifest_dir)
+
+            # a changed manifest is written to a new folder
+            manifest['/data/sub-02_run-1_bold.nii.gz'] = {'RepetitionTime': 5.0}
+            self.assertNotEqual(write_manifest(settings),manifest_dir)
+            self.assertEqual(write_manifest(settings),write_manifest(settings))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import unittest
+from p3.motion import *
+from p3.workflows.p3_stcdespikemoco.custom import calcFD
+import os
+import math
+import tempfile
+import numpy as np
+from scipy import signal
+
+def reference_fd(params,TR,brain_radius=50,bpm_min=18.582,bpm_max=25.7263):
+    # FD of one run computed frame by frame
+    FD = [0]
+    for f1,f2 in zip(params[:-1],params[1:]):
+        FD.append(sum(abs(v1-v2)*(brain_radius*math.pi/180 if n < 3 else 1) for n,(v1,v2) in enumerate(zip(f1,f2))))
+    b,a = respiration_iirnotch(TR,bpm_min,bpm_max)
+    filt_moco = signal.filtfilt(b,a,signal.filtfilt(b,a,params,axis=0,padtype=None),axis=0,padtype=None)
+    filt_moco[:,4:7] = filt_moco[:,4:7]*brain_radius*math.pi/180
+    filt_FD = np.concatenate(([0],np.sum(np.absolute(filt_moco[1:,:]-filt_moco[0:-1,:]),axis=1)))
+    return np.array(FD),filt_moco,filt_FD
+
+class test(unittest.TestCase):
+    def test_calc_fd(self):
+        # runs of different lengths and TRs
+        rng = np.random.RandomState(0)
+        runs = [rng.randn(length,6)*0.1 for length in [40,40,55,40]]
+        TRs = [2.0,2.0,2.0,'2.5']
+        results = calc_fd(runs,TRs,50,0.2,0.1,18.582,25.7263)
+        for run,TR,FD,filt_moco,filt_FD,tmask in zip(runs,TRs,results['FD'],results['filt_moco'],results['filt_FD'],results['tmask']):
+            ref_FD,ref_filt_moco,ref_filt_FD = reference_fd(run,float(TR))
+            np.testing.assert_allclose(FD,ref_FD)
+            np.testing.assert_allclose(filt_moco,ref_filt_moco)
+            np.testing.assert_allclose(filt_FD,ref_filt_FD)
+            np.testing.assert_array_equal(tmask,ref_FD<0.2)
+
+    def test_calcFD(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # write motion parameter files of two runs
+            rng = np.random.RandomState(1)
+            moco_params = []
+            for n in range(2):
+                moco_params.append(os.path.join(tmp_dir,'sub-01_task-rest_run-{}_bold_MOCOparams.1D'.format(n+1)))
+                np.savetxt(moco_params[-1],rng.randn(30,6)*0.1,fmt='%.4f',delimiter='  ')
+
+            # each output is a list of runs
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                outputs = calcFD(moco_params,50,0.2,0.1,[2.0,2.0],18.582,25.7263)
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(len(outputs),6)
+            self.assertTrue(all(len(files) == 2 for files in outputs))
+            FD,tmask,filt_moco,filt_FD,filt_tmask,FD_npz = outputs
+            self.assertTrue(FD[1].endswith('run-2_bold_MOCOparams.FD'))
+
+            # the text files match the .npz file
+            table = load_fd(FD_npz)
+            self.assertEqual(table['FD'].shape,(60,))
+            self.assertEqual(table['filt_moco'].shape,(60,6))
+            np.testing.assert_array_equal(table['run'],np.repeat([0,1],30))
+            np.testing.assert_allclose(np.loadtxt(FD[1]),table['FD'][30:])
+            np.testing.assert_array_equal(np.loadtxt(filt_tmask[0]),table['filt_tmask'][:30])
+            np.testing.assert_allclose(np.loadtxt(filt_moco[0]),table['filt_moco'][:30])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,23 @@ class test(unittest.TestCase):
     def test_get_prefix(self):
         basename = get_prefix('test/test/test.nii.gz')
         self.assertEqual(basename,'test_')
+    def test_group_fieldmaps(self):
+        # three runs sharing two field maps
+        magnitude,phasediff,TE,run_fieldmap = group_fieldmaps(
+            ['mag1','mag2','mag1'],
+            ['phase1','phase2','phase1'],
+            [2.46,2.46,2.46]
+        )
+        self.assertEqual(magnitude,['mag1','mag2'])
+        self.assertEqual(phasediff,['phase1','phase2'])
+        self.assertEqual(TE,[2.46,2.46])
+        self.assertEqual(run_fieldmap,[0,1,0])
+
+        # each run gets the images of its field map
+        self.assertEqual(
+            expand_fieldmaps(['mag1_ero','mag2_ero'],['fmap1','fmap2'],['mask1','mask2'],run_fieldmap),
+            (['mag1_ero','mag2_ero','mag1_ero'],['fmap1','fmap2','fmap1'],['mask1','mask2','mask1'])
+        )
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.workflows.p3_stcdespikemoco.despike import *
+from p3.workflows.p3_stcdespikemoco import blocks
+from p3.workflows.p3_stcdespikemoco.slicetime import *
+from p3.workflows.p3_stcdespikemoco.nodedefs import definednodes
+from p3.workflows.p3_stcdespikemoco.workflow import stcdespikemocoworkflow
+from p3.settings import default_preproc_settings
+import os
+import tempfile
+import numpy as np
+import nibabel as nib
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+def create_image(filename):
+    # a noisy run with one spike
+    data = (np.random.RandomState(0).randn(6,5,4,60)*5+1000).astype(np.int16)
+    data[2,3,1,30] += 300
+    nib.save(nib.Nifti1Image(data,np.diag([2,2,2,1])),filename)
+    return data
+
+class test(unittest.TestCase):
+    def test_despike(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data = create_image(os.path.join(tmp_dir,'func.nii.gz'))
+            despike(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'despiked.nii.gz'),
+                os.path.join(tmp_dir,'spikes.nii.gz'),ignore=4)
+            self.assertEqual(sorted(os.listdir(tmp_dir)),['despiked.nii.gz','func.nii.gz','spikes.nii.gz'])
+            despiked = nib.load(os.path.join(tmp_dir,'despiked.nii.gz'))
+            spikes = nib.load(os.path.join(tmp_dir,'spikes.nii.gz')).get_fdata()
+            self.assertTrue(np.allclose(despiked.affine,np.diag([2,2,2,1])))
+            despiked = despiked.get_fdata()
+
+            # the spike is pulled towards the fit, ignored frames are unchanged
+            self.assertGreater(spikes[2,3,1,30],4.0)
+            self.assertLess(despiked[2,3,1,30],data[2,3,1,30]-200)
+            self.assertTrue((despiked[...,:4] == data[...,:4]).all())
+            self.assertTrue((spikes[...,:4] == 0).all())
+            np.testing.assert_allclose(despiked[spikes <= 2.5],data[spikes <= 2.5],atol=1e-3)
+
+            # blocks despiked by a pool of processes give the same result
+            with patch.object(blocks,'BLOCK_VALUES',600):
+                despike(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'pooled.nii'),ignore=4,n_procs=3)
+            np.testing.assert_allclose(nib.load(os.path.join(tmp_dir,'pooled.nii')).get_fdata(),despiked)
+
+            # too short runs are reported
+            with self.assertRaises(ValueError):
+                despike(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'short.nii'),ignore=50)
+
+    def test_despike_noise(self):
+        # pure gaussian noise has about 1.2% of frames above cut1 (|z| > 2.5), a few more with the fit removed
+        noise = np.random.RandomState(1).randn(2000,300)
+        despiked,spikiness = despike_series(noise,reference_functions(300))
+        self.assertLess((spikiness > 2.5).mean(),0.025)
+        self.assertGreater((spikiness > 2.5).mean(),0.005)
+
+    def test_shift_series(self):
+        # shifting a smooth series matches the shifted signal
+        frames = np.arange(200)
+        series = np.sin(2*np.pi*frames/37.0)[None,:]*10+100
+        for shift in [0.3,-0.7,1.5]:
+            for method,tolerance in [('heptic',1e-6),('fourier',1e-2)]:
+                shifted = shift_series(series,shift,method)
+                np.testing.assert_allclose(shifted[0,10:-10],np.sin(2*np.pi*(frames[10:-10]+shift)/37.0)*10+100,atol=tolerance)
+        np.testing.assert_allclose(shift_series(series,0),series)
+
+    def test_slicetime(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data = create_image(os.path.join(tmp_dir,'func.nii.gz'))
+            slice_timing = [0.0,0.5,1.0,1.5]
+            slicetime(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'tshift.nii'),slice_timing,2.0,ignore=4)
+            tshift = nib.load(os.path.join(tmp_dir,'tshift.nii')).get_fdata()
+
+            # each slice is shifted by its acquisition time, ignored frames are unchanged
+            np.testing.assert_allclose(tshift[:,:,0],data[:,:,0],atol=1e-3)
+            expected = shift_series(data[:,:,2,4:].reshape(-1,56).astype(float),-0.5).reshape(6,5,56)
+            np.testing.assert_allclose(tshift[:,:,2,4:],expected,atol=1e-3)
+            self.assertTrue((tshift[...,:4] == data[...,:4]).all())
+
+            # despiking and slice time correction in one pass gives the same result as one after the other
+            despike(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'despike.nii'),ignore=4)
+            slicetime(os.path.join(tmp_dir,'despike.nii'),os.path.join(tmp_dir,'despike_tshift.nii'),slice_timing,2.0,ignore=4)
+            despike_slicetime(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'fused.nii.gz'),slice_timing,2.0,
+                os.path.join(tmp_dir,'spikes.nii.gz'),ignore=4)
+            np.testing.assert_allclose(nib.load(os.path.join(tmp_dir,'fused.nii.gz')).get_fdata(),
+                nib.load(os.path.join(tmp_dir,'despike_tshift.nii')).get_fdata(),atol=1e-2)
+
+            # the fused pass can skip the spikiness and extract a reference frame as a 3D image
+            despike_slicetime(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'fused.nii'),slice_timing,2.0,
+                ignore=4,ref_file=os.path.join(tmp_dir,'ref.nii'),ref_frame=4)
+            ref = nib.load(os.path.join(tmp_dir,'ref.nii'))
+            self.assertEqual(ref.shape,(6,5,4))
+            np.testing.assert_allclose(ref.get_fdata(),nib.load(os.path.join(tmp_dir,'fused.nii')).get_fdata()[...,4])
+
+            # slice times must match the slices
+            with self.assertRaises(ValueError):
+                slicetime(os.path.join(tmp_dir,'func.nii.gz'),os.path.join(tmp_dir,'bad.nii'),slice_timing[:3],2.0)
+
+    def test_nifti2(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the same run as NIfTI-1 and NIfTI-2
+            data = create_image(os.path.join(tmp_dir,'func.nii'))
+            nib.save(nib.Nifti2Image(data,np.diag([2,2,2,1])),os.path.join(tmp_dir,'func2.nii'))
+
+            # outputs keep the NIfTI version of the input, and its header is intact
+            for name in ['func','func2']:
+                despike(os.path.join(tmp_dir,name+'.nii'),os.path.join(tmp_dir,name+'_despike.nii'),ignore=4)
+            out = nib.load(os.path.join(tmp_dir,'func2_despike.nii'))
+            self.assertIsInstance(out,nib.Nifti2Image)
+            self.assertEqual(out.shape,data.shape)
+            self.assertTrue(np.allclose(out.affine,np.diag([2,2,2,1])))
+            np.testing.assert_allclose(out.get_fdata(),nib.load(os.path.join(tmp_dir,'func_despike.nii')).get_fdata())
+
+            # ...and so do the slice time corrected and fused outputs (with the fused reference frame)
+            slice_timing = [0.0,0.5,1.0,1.5]
+            for name in ['func','func2']:
+                slicetime(os.path.join(tmp_dir,name+'.nii'),os.path.join(tmp_dir,name+'_tshift.nii'),slice_timing,2.0,ignore=4)
+                despike_slicetime(os.path.join(tmp_dir,name+'.nii'),os.path.join(tmp_dir,name+'_fused.nii'),slice_timing,2.0,
+                    ignore=4,ref_file=os.path.join(tmp_dir,name+'_ref.nii'),ref_frame=4)
+            for output in ['tshift','fused','ref']:
+                out = nib.load(os.path.join(tmp_dir,'func2_{}.nii'.format(output)))
+                self.assertIsInstance(out,nib.Nifti2Image)
+                self.assertTrue(np.allclose(out.affine,np.diag([2,2,2,1])))
+                np.testing.assert_allclose(out.get_fdata(),nib.load(os.path.join(tmp_dir,'func_{}.nii'.format(output))).get_fdata())
+            np.testing.assert_allclose(nib.load(os.path.join(tmp_dir,'func2_ref.nii')).get_fdata(),
+                nib.load(os.path.join(tmp_dir,'func2_fused.nii')).get_fdata()[...,4])
+
+    def test_engines(self):
+        settings = default_preproc_settings()
+        settings['output_dir'] = tempfile.gettempdir()
+        settings['tmp_dir'] = os.path.join(settings['output_dir'],'tmp')
+        settings['bids_dir'] = os.path.join(current_dir,'example_data')
+        settings['subject'] = ['01']
+        settings['despike_engine'] = 'native'
+        settings['slicetime_engine'] = 'native'
+        self.assertEqual(definednodes(settings).despike.interface.__class__.__name__,'Function')
+        self.assertEqual(definednodes(settings).tshift.interface.__class__.__name__,'Function')
+        settings['despike_engine'] = 'afni'
+        settings['slicetime_engine'] = 'afni'
+        self.assertEqual(definednodes(settings).despike.interface.__class__.__name__,'ExtendedDespike')
+        self.assertEqual(definednodes(settings).tshift.interface.__class__.__name__,'TShift')
+
+        # the native engines are fused into one node
+        settings['despike_engine'] = 'native'
+        settings['slicetime_engine'] = 'native'
+        nodes = stcdespikemocoworkflow('p3_stcdespikemoco',settings).list_node_names()
+        self.assertIn('despike_tshift',nodes)
+        self.assertNotIn('despike',nodes)
+        self.assertNotIn('tshift',nodes)
+
+        # ...and hand their output straight to moco
+        for node in ['despike_pool','stc_despike_pool','extractroi_post']:
+            self.assertNotIn(node,nodes)
+        self.assertIn('moco',nodes)
+        settings['fuse_despike_stc'] = False
+        nodes = stcdespikemocoworkflow('p3_stcdespikemoco',settings).list_node_names()
+        self.assertNotIn('despike_tshift',nodes)
+        self.assertIn('tshift',nodes)
+        self.assertIn('extractroi_post',nodes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import unittest
+import os
+import re
+import sys
+import tempfile
+import subprocess
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+p3proc = os.path.join(os.path.dirname(current_dir),'p3proc')
+
+# modules the commands that don't process data must not import
+HEAVY_MODULES = ['nipype','bids','nibabel','numpy']
+
+# import time the fast commands may spend (seconds)
+IMPORT_BUDGET = 0.5
+
+def import_times(*args):
+    # run p3proc and get the modules it imports and the cumulative import time of the top level ones
+    output = subprocess.run([sys.executable,'-X','importtime',p3proc]+list(args),
+        stdout=subprocess.PIPE,stderr=subprocess.PIPE,check=True).stderr.decode()
+    modules = set()
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)$',line)
+        if match:
+            modules.add(match.group(3).split('.')[0])
+            if len(match.group(2)) == 1:
+                times[match.group(3)] = int(match.group(1))/1e6
+    return modules,times
+
+class test(unittest.TestCase):
+    def test_fast_commands(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for args in [['--version'],['-g',os.path.join(tmp_dir,'settings.json')],['-c',os.path.join(tmp_dir,'workflow')]]:
+                modules,times = import_times(*args)
+
+                # heavy dependencies are not imported
+                for module in HEAVY_MODULES:
+                    self.assertNotIn(module,modules,'{} imports {}'.format(' '.join(args),module))
+
+                # imports stay within budget
+                self.assertLess(sum(times.values()),IMPORT_BUDGET,'{} imports: {}'.format(' '.join(args),times))
+
+if __name__ == '__main__':
+    unittest.main()
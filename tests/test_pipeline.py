@@ -8,7 +8,7 @@ import sys
 import importlib
 import tempfile
 from nipype import Workflow
-from mock import patch
+from mock import patch,Mock
 from .mock_stdout import MockDevice
 sys.path.append(os.path.abspath(os.path.dirname(workflows.__file__))) # set default workflows path
 current_dir = os.path.dirname(os.path.abspath(os.path.realpath(__file__))) # get the current directory
@@ -100,12 +100,31 @@ class test(unittest.TestCase):
             sideload = settings['sideload'][2]
             field = p3.get_node('{}.{}'.format(sideload['workflow'],sideload['node'])).inputs.input_image
             self.assertEqual(field,'test3')
+            # the sideloaded fields are no longer connected
+            index = connection_index(p3)
+            for sideload in settings['sideload']:
+                self.assertNotIn((sideload['workflow'],sideload['node'],sideload['input'][0]),index)
+            # unknown nodes and fields are all reported before the graph is changed
+            settings['sideload'] = [
+                {'workflow': 'p3_skullstrip','node': 'input','input': ['not_a_field','test4']},
+                {'workflow': 'p3_skullstrip','node': 'not_a_node','input': ['T1','test5']},
+                {'workflow': 'not_a_workflow','node': 'input','input': ['T1','test6']}
+            ]
+            with self.assertRaises(ValueError) as error:
+                sideload_nodes(p3,connections,settings)
+            for name in ['not_a_field','not_a_node','not_a_workflow']:
+                self.assertIn(name,str(error.exception))
+            settings['sideload'] = []
 
     def test_create_and_run_p3_workflow(self):
         with patch('sys.stdout',new=MockDevice()) as fake_out:
             settings['disable_run'] = True # we can't really test when the pipeline runs, so disable it
             # test pipeline with various settings
             create_and_run_p3_workflow(imported_workflows,settings) # default
+            # the dataset validation is finished once the graph is built
+            validation = Mock()
+            create_and_run_p3_workflow(imported_workflows,settings,validation)
+            validation.wait.assert_called_once_with()
             # switch settings
             settings['debug'] = True
             settings['avganats'] = False
@@ -115,5 +134,18 @@ class test(unittest.TestCase):
             settings['run_recon_all'] = False
             create_and_run_p3_workflow(imported_workflows,settings) # run with changed settings
 
+    def test_run_subjects_sharded(self):
+        with patch('sys.stdout',new=MockDevice()) as fake_out:
+            # build each subject as its own pipeline
+            shard_settings = dict(settings)
+            shard_settings['disable_run'] = True
+            shard_settings['n_procs'] = 2
+            shard_settings['memory_gb'] = 4
+            shard_settings['subject_parallel'] = 2
+            self.assertEqual(run_subjects_sharded(shard_settings),[])
+            # a broken subject pipeline is reported, not raised
+            shard_settings['workflows'] = ['not_a_workflow']
+            self.assertEqual(run_subjects_sharded(shard_settings),['01','02','03'])
+
 if __name__ == '__main__':
     unittest.main()
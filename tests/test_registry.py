@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import unittest
+from p3.registry import *
+from p3.base import workflowgenerator
+import os
+import sys
+import tempfile
+import subprocess
+
+class test(unittest.TestCase):
+    def test_builtin_workflows(self):
+        # only the module of the requested workflow is imported
+        code = (
+            'import sys\n'
+            'from p3.registry import get_workflow\n'
+            'print(get_workflow("p3_skullstrip").__name__)\n'
+            'print(sorted(m for m in sys.modules if m.startswith("p3.workflows.p3_") and m.endswith(".workflow")))\n'
+        )
+        output = subprocess.run([sys.executable,'-c',code],stdout=subprocess.PIPE,check=True).stdout.decode().splitlines()
+        self.assertEqual(output[0],'skullstripworkflow')
+        self.assertEqual(output[1],"['p3.workflows.p3_skullstrip.workflow']")
+
+    def test_register_workflow(self):
+        @register_workflow('test_registered')
+        class registered(workflowgenerator):
+            pass
+        self.assertIs(get_workflow('test_registered'),registered)
+
+    def test_workflow_folder(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a workflow folder on sys.path that doesn't register its class
+            os.makedirs(os.path.join(tmp_dir,'test_folderworkflow'))
+            open(os.path.join(tmp_dir,'test_folderworkflow','__init__.py'),'w').close()
+            with open(os.path.join(tmp_dir,'test_folderworkflow','workflow.py'),'w') as f:
+                f.write('from p3.base import workflowgenerator\nclass newworkflow(workflowgenerator):\n    pass\n')
+            sys.path.append(tmp_dir)
+            try:
+                self.assertEqual(get_workflow('test_folderworkflow').__name__,'newworkflow')
+            finally:
+                sys.path.remove(tmp_dir)
+
+        # unknown workflows are reported
+        with self.assertRaises(ValueError):
+            get_workflow('test_missingworkflow')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import unittest
+from p3.resources import *
+from p3.pipeline import generate_subworkflows,generate_connections
+from p3.settings import default_preproc_settings
+from p3 import workflows
+import os
+import sys
+import importlib
+import tempfile
+import numpy as np
+from nipype import Workflow,Node
+from nipype.interfaces.utility import IdentityInterface
+from mock import patch
+from .mock_stdout import MockDevice
+sys.path.append(os.path.abspath(os.path.dirname(workflows.__file__))) # set default workflows path
+current_dir = os.path.dirname(os.path.abspath(os.path.realpath(__file__))) # get the current directory
+
+class test(unittest.TestCase):
+    def test_image_footprint(self):
+        # write a small 4D image
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir,'test.nii.gz')
+            image = nibabel.Nifti1Image(np.zeros((4,5,6,7),dtype=np.int16),np.diag([2,2,3,1]))
+            image.to_filename(filename)
+            # check the footprint
+            self.assertEqual(
+                image_footprint(filename),
+                {'voxels': 120,'frames': 7,'itemsize': 4,'voxel_volume': 12.0}
+            )
+
+    def test_assign_node_resources(self):
+        with patch('sys.stdout',new=MockDevice()) as fake_out:
+            # get settings
+            settings = default_preproc_settings()
+            settings['output_dir'] = tempfile.TemporaryDirectory().name
+            settings['tmp_dir'] = os.path.join(settings['output_dir'],'tmp')
+            settings['bids_dir'] = os.path.join(current_dir,'example_data')
+            settings['subject'] = ['01']
+            settings['n_procs'] = 4
+            settings['memory_gb'] = 16
+            # build the pipeline
+            imported_workflows = {}
+            for module in settings['workflows']:
+                imported_workflows[module] = importlib.import_module('{}.workflow'.format(module))
+            subworkflows = generate_subworkflows(imported_workflows,settings)
+            p3 = Workflow(name='p3_pipeline')
+            p3.connect(generate_connections(subworkflows,settings))
+            # size the nodes
+            assign_node_resources(p3,settings)
+            nodes = {node.name: node for node in p3._get_all_nodes()}
+            # threaded nodes are capped to the budget
+            self.assertEqual(nodes['atlasregister'].n_procs,4)
+            # the example images are empty, so only the base memory is used
+            self.assertEqual(nodes['applytransforms'].mem_gb,BASE_MEMORY_GB)
+            self.assertEqual(
+                plugin_args(settings),
+                {'n_procs': 4,'memory_gb': 16,'raise_insufficient': False}
+            )
+
+    def test_memory_scaling(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # write a small synthetic functional run and anatomical image
+            func = os.path.join(tmp_dir,'sub-01_task-rest_bold.nii.gz')
+            anat = os.path.join(tmp_dir,'sub-01_T1w.nii.gz')
+            nibabel.Nifti1Image(np.zeros((8,8,4,20),dtype=np.int16),np.diag([3,3,3,1])).to_filename(func)
+            nibabel.Nifti1Image(np.zeros((30,30,30),dtype=np.float32),np.eye(4)).to_filename(anat)
+            func_gb = 8*8*4*20*4/1024**3
+            anat_gb = 30*30*30*4/1024**3
+
+            # build a workflow with nodes of the memory model (and one outside it)
+            settings = default_preproc_settings()
+            settings['n_procs'] = 4
+            settings['num_threads'] = 2
+            settings['memory_gb'] = BASE_MEMORY_GB+anat_gb*10
+            p3 = Workflow(name='p3_pipeline')
+            p3.add_nodes([Node(IdentityInterface(fields=['x']),name=name)
+                for name in ['moco','extractroi_post','applytransforms','reconall','calcFD']])
+
+            # size the nodes from the images
+            with patch('p3.resources.get_subject_files',return_value={'func': [func],'anat': [anat]}):
+                footprints = dataset_footprints(settings)
+                assign_node_resources(p3,settings)
+            nodes = {node.name: node for node in p3._get_all_nodes()}
+            self.assertAlmostEqual(footprints['func'],func_gb)
+            self.assertAlmostEqual(footprints['func3d'],func_gb/20)
+            self.assertAlmostEqual(footprints['anat'],anat_gb)
+
+            # memory scales with the image and the copies each node holds
+            self.assertAlmostEqual(nodes['moco'].mem_gb,BASE_MEMORY_GB+6*func_gb)
+            self.assertAlmostEqual(nodes['extractroi_post'].mem_gb,BASE_MEMORY_GB+func_gb)
+            self.assertAlmostEqual(nodes['applytransforms'].mem_gb,min(BASE_MEMORY_GB+9*footprints['func_atlas'],settings['memory_gb']))
+            self.assertGreater(nodes['applytransforms'].mem_gb,BASE_MEMORY_GB)
+            # ...capped to the machine budget
+            self.assertAlmostEqual(nodes['reconall'].mem_gb,settings['memory_gb'])
+
+            # threaded nodes get num_threads cores, others one
+            self.assertEqual(nodes['moco'].n_procs,2)
+            self.assertEqual(nodes['reconall'].n_procs,2)
+            self.assertEqual(nodes['extractroi_post'].n_procs,1)
+            self.assertEqual(nodes['calcFD'].n_procs,1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.resultcache import *
+from p3.scheduler import P3MultiProcPlugin
+from nipype import Node,Workflow
+from nipype.interfaces.utility import Function
+from nipype.interfaces import afni
+from p3.threads import apply_threads
+import os
+import tempfile
+
+def stamp(in_file):
+    # write a file that records when it was made
+    import os
+    from time import time
+    out_file = os.path.join(os.getcwd(),'stamped.txt')
+    with open(in_file,'r') as f, open(out_file,'w') as g:
+        g.write('{} {}'.format(f.read(),time()))
+    return out_file
+
+def run_stamp(base_dir,store):
+    # create an input file in the working directory
+    in_file = os.path.join(base_dir,'in.txt')
+    with open(in_file,'w') as f:
+        f.write('data')
+    # run a cached node
+    wf = Workflow(name='test',base_dir=base_dir)
+    moco = Node(Function(input_names=['in_file'],output_names=['out_file'],function=stamp),name='moco')
+    moco.inputs.in_file = in_file
+    wf.add_nodes([moco])
+    wf.run(plugin=P3MultiProcPlugin(plugin_args={'n_procs': 1,'result_store': store}))
+    out_file = os.path.join(base_dir,'test','moco','stamped.txt')
+    with open(out_file,'r') as f:
+        return f.read()
+
+class test(unittest.TestCase):
+    def test_result_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # run the same node in two working directories
+            store = ResultStore(os.path.join(tmp_dir,'cache'),1)
+            os.makedirs(os.path.join(tmp_dir,'run1'))
+            os.makedirs(os.path.join(tmp_dir,'run2'))
+            first = run_stamp(os.path.join(tmp_dir,'run1'),store)
+            # changing the output of the first run in place doesn't change the stored entry
+            with open(os.path.join(tmp_dir,'run1','test','moco','stamped.txt'),'a') as f:
+                f.write(' edited')
+            second = run_stamp(os.path.join(tmp_dir,'run2'),store)
+            # the second run restored the output of the first
+            self.assertEqual(first,second)
+            self.assertEqual(len(os.listdir(store.cache_dir)),1)
+
+    def test_node_key_threads(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.dict(os.environ):
+            in_file = os.path.join(tmp_dir,'func.nii.gz')
+            with open(in_file,'w') as f:
+                f.write('data')
+            store = ResultStore(os.path.join(tmp_dir,'cache'),1)
+
+            # a node keyed with one thread count...
+            despike = Node(afni.Despike(in_file=in_file),name='despike',base_dir=tmp_dir)
+            apply_threads(despike,2)
+            key = store.node_key(despike)
+
+            # ...is found with another (the thread environment is not hashed)
+            other = Node(afni.Despike(in_file=in_file),name='despike',base_dir=os.path.join(tmp_dir,'other'))
+            apply_threads(other,8)
+            self.assertIn('OMP_NUM_THREADS',other.inputs.environ)
+            self.assertEqual(store.node_key(other),key)
+
+            # inputs that change the result still change the key
+            other.inputs.args = '-NEW'
+            self.assertNotEqual(store.node_key(other),key)
+
+    def test_open_result_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a store that can't be created is skipped
+            blocker = os.path.join(tmp_dir,'file')
+            open(blocker,'w').close()
+            self.assertIsNone(open_result_store(os.path.join(blocker,'cache'),1))
+            self.assertIsInstance(open_result_store(os.path.join(tmp_dir,'cache'),1),ResultStore)
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # create two entries, the first used least recently
+            store = ResultStore(tmp_dir,1.5/1024**3)
+            for n,key in enumerate(['old','new']):
+                os.makedirs(os.path.join(tmp_dir,key))
+                with open(os.path.join(tmp_dir,key,'meta.json'),'w') as f:
+                    json.dump({'size': 1},f)
+                os.utime(os.path.join(tmp_dir,key),(n,n))
+            # only the most recently used entry fits
+            store.evict()
+            self.assertEqual(os.listdir(tmp_dir),['new'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import unittest
+from p3.scheduler import *
+from nipype import Node,Workflow
+from nipype.interfaces.utility import Function,IdentityInterface
+import os
+import tempfile
+import networkx as nx
+
+def add_one(x):
+    return x+1
+
+class test(unittest.TestCase):
+    def test_critical_path_priorities(self):
+        # create a graph with a long and a short branch
+        reconall = Node(IdentityInterface(fields=['x']),name='reconall')
+        masks = Node(IdentityInterface(fields=['x']),name='masks')
+        calcFD = Node(IdentityInterface(fields=['x']),name='calcFD')
+        graph = nx.DiGraph()
+        graph.add_edge(reconall,masks)
+        graph.add_node(calcFD)
+        # recon-all gates the longest path
+        priorities = critical_path_priorities(graph,{})
+        self.assertEqual(priorities[reconall],NODE_DURATIONS['reconall']+DEFAULT_DURATION)
+        self.assertEqual(priorities[calcFD],DEFAULT_DURATION)
+        # measured durations override the cost table
+        calcFD._hierarchy = 'p3.p3_stcdespikemoco'
+        priorities = critical_path_priorities(graph,{'p3_stcdespikemoco.calcFD': [50000.0,1]})
+        self.assertGreater(priorities[calcFD],priorities[reconall])
+
+    def test_plugin(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # create a small workflow
+            wf = Workflow(name='test',base_dir=tmp_dir)
+            first = Node(Function(input_names=['x'],output_names=['x'],function=add_one),name='first')
+            first.inputs.x = 1
+            second = Node(Function(input_names=['x'],output_names=['x'],function=add_one),name='second')
+            wf.connect(first,'x',second,'x')
+            # run with the critical path scheduler
+            history_file = os.path.join(tmp_dir,'node_durations.json')
+            wf.run(plugin=P3MultiProcPlugin(plugin_args={
+                'n_procs': 1,
+                'scheduler': 'critical_path',
+                'history_file': history_file
+            }))
+            # the node durations were recorded
+            history = load_history(history_file)
+            self.assertEqual(sorted(history),['test.first','test.second'])
+            self.assertEqual(history['test.first'][1],1)
+
+            # measurements of other runs sharing the file are merged, not overwritten
+            update_history(history_file,'test.first',history['test.first'][0])
+            self.assertEqual(load_history(history_file)['test.first'][1],2)
+            self.assertEqual(load_history(history_file)['test.second'],history['test.second'])
+
+    def test_submitted_jobs(self):
+        # record the job each submitted node was matched to
+        submitted = []
+        class RecordingPlugin(P3MultiProcPlugin):
+            def _submit_job(self,node,updatehash=False):
+                submitted.append((self.procs[self._submitting].itername,node.itername))
+                return super()._submit_job(node,updatehash)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # iterables copies share their fullname
+            wf = Workflow(name='test',base_dir=tmp_dir)
+            first = Node(Function(input_names=['x'],output_names=['x'],function=add_one),name='first')
+            first.iterables = ('x',[1,2,3])
+            wf.add_nodes([first])
+            wf.run(plugin=RecordingPlugin(plugin_args={'n_procs': 1}))
+
+            # ...but each is matched to its own job
+            self.assertEqual(len(submitted),3)
+            for job,node in submitted:
+                self.assertEqual(job,node)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.threads import *
+from p3.command import THREADS_ENV
+from nipype import Node
+from nipype.interfaces import ants
+from nipype.interfaces.utility import IdentityInterface
+import os
+
+class test(unittest.TestCase):
+    def test_balance(self):
+        # two registrations (8 threads) and a single threaded node are ready
+        register = [Node(ants.Registration(),name='register{}'.format(n)) for n in range(2)]
+        for node in register:
+            node.n_procs = 8
+        ident = Node(IdentityInterface(fields=['x']),name='ident')
+        budget = ThreadBudget(16)
+        # idle cores are shared between the registrations (up to max_threads)
+        budget.balance(register+[ident],41)
+        self.assertEqual([node.n_procs for node in register],[16,16])
+        self.assertEqual(ident.n_procs,1)
+        # nodes never get fewer threads than they were assigned
+        budget.balance(register+[ident],9)
+        self.assertEqual([node.n_procs for node in register],[8,8])
+
+    def test_apply_threads(self):
+        with patch.dict(os.environ):
+            # ants nodes get the thread count as an input and in their environment
+            node = Node(ants.Registration(num_threads=8),name='register')
+            apply_threads(node,3)
+            self.assertEqual(node.inputs.num_threads,3)
+            self.assertEqual(node.inputs.environ['OMP_NUM_THREADS'],'3')
+            self.assertEqual(node.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'],'3')
+            self.assertEqual(os.environ[THREADS_ENV],'3')
+
+if __name__ == '__main__':
+    unittest.main()
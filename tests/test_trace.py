@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import unittest
+from p3.trace import *
+from p3.scheduler import P3MultiProcPlugin
+from nipype import Node,Workflow
+from nipype.interfaces.utility import Function
+import os
+import csv
+import json
+import tempfile
+from time import sleep
+
+def add_one(x):
+    return x+1
+
+def create_workflow(base_dir):
+    # create a small workflow
+    wf = Workflow(name='test',base_dir=base_dir)
+    first = Node(Function(input_names=['x'],output_names=['x'],function=add_one),name='first')
+    first.inputs.x = 1
+    second = Node(Function(input_names=['x'],output_names=['x'],function=add_one),name='second')
+    wf.connect(first,'x',second,'x')
+    return wf
+
+class test(unittest.TestCase):
+    def check_trace(self,trace_dir):
+        # the chrome trace has an event for each node
+        write_trace(os.path.join(trace_dir,'events'),trace_dir)
+        with open(os.path.join(trace_dir,'p3_trace.json'),'r') as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(sorted(e['name'] for e in events),['test.first','test.second'])
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 for e in events))
+        # and so does the csv summary
+        with open(os.path.join(trace_dir,'p3_trace.csv'),'r') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['name'] for row in rows],['test.first','test.second'])
+        self.assertEqual({row['status'] for row in rows},{'ok'})
+        # every node gets its peak memory, even in a reused worker process
+        self.assertTrue(all(float(row['peak_rss_mb']) > 0 for row in rows))
+
+    def test_multiproc_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_dir = os.path.join(tmp_dir,'trace')
+            start_trace(os.path.join(trace_dir,'events'))
+            try:
+                create_workflow(tmp_dir).run(plugin=P3MultiProcPlugin(plugin_args={'n_procs': 1}))
+            finally:
+                stop_trace()
+            self.check_trace(trace_dir)
+
+    def test_linear_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_dir = os.path.join(tmp_dir,'trace')
+            start_trace(os.path.join(trace_dir,'events'))
+            try:
+                create_workflow(tmp_dir).run(plugin='Linear',plugin_args={'status_callback': NodeTracer()})
+            finally:
+                stop_trace()
+            self.check_trace(trace_dir)
+
+    def test_rss_sampler(self):
+        # the peak of memory allocated and freed during the span is caught
+        sampler = RSSSampler()
+        before = tree_rss()
+        data = bytearray(200*1024**2)
+        for n in range(0,len(data),4096):
+            data[n] = 1
+        sleep(3*RSS_INTERVAL)
+        del data
+        self.assertGreater(sampler.stop(),before+150*1024**2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+from p3.validator import *
+import io
+import os
+import shutil
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+
+class test(unittest.TestCase):
+    def test_dataset_fingerprints(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bids_dir = os.path.join(tmp_dir,'bids')
+            shutil.copytree(os.path.join(current_dir,'example_data'),bids_dir)
+            top,subjects = dataset_fingerprints(bids_dir)
+            self.assertIn('sub-01',subjects)
+
+            # only the fingerprint of the changed subject changes
+            with open(os.path.join(bids_dir,'sub-02','sub-02_sessions.tsv'),'w') as f:
+                f.write('session_id\n')
+            new_top,new_subjects = dataset_fingerprints(bids_dir)
+            self.assertEqual(new_top,top)
+            self.assertNotEqual(new_subjects['sub-02'],subjects['sub-02'])
+            self.assertEqual(new_subjects['sub-01'],subjects['sub-01'])
+
+    def test_subset_dataset(self):
+        with tempfile.TemporaryDirectory() as subset_dir:
+            bids_dir = os.path.join(current_dir,'example_data')
+            subset_dataset(bids_dir,['sub-02'],subset_dir)
+            self.assertEqual(
+                sorted(d for d in os.listdir(subset_dir) if d.startswith('sub-')),
+                ['sub-02']
+            )
+            self.assertTrue(os.path.exists(os.path.join(subset_dir,'dataset_description.json')))
+            with open(os.path.join(subset_dir,'participants.tsv'),'r') as f:
+                self.assertEqual([line.split('\t')[0] for line in f],['participant_id','sub-02'])
+
+    def test_validation(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bids_dir = os.path.join(tmp_dir,'bids')
+            shutil.copytree(os.path.join(current_dir,'example_data'),bids_dir)
+            cache_file = os.path.join(tmp_dir,'output',VALIDATION_FILE)
+
+            # record the subjects each validator call sees
+            validated = []
+            def validator(command,**kwargs):
+                validated.append(sorted(d for d in os.listdir(command[1]) if d.startswith('sub-')))
+                return subprocess.CompletedProcess(command,0,stdout=b'This dataset appears to be BIDS compatible.')
+
+            with patch('p3.validator.subprocess.run',side_effect=validator):
+                # the first validation checks every subject
+                self.assertTrue(BIDSValidation(bids_dir,cache_file).start().wait())
+                self.assertEqual(len(validated[0]),len(dataset_fingerprints(bids_dir)[1]))
+
+                # nothing changed, nothing to validate
+                self.assertTrue(BIDSValidation(bids_dir,cache_file).start().wait())
+                self.assertEqual(len(validated),1)
+
+                # only the changed subject is validated again
+                with open(os.path.join(bids_dir,'sub-02','sub-02_sessions.tsv'),'w') as f:
+                    f.write('session_id\n')
+                self.assertTrue(BIDSValidation(bids_dir,cache_file).start().wait())
+                self.assertEqual(validated[1],['sub-02'])
+
+                # the report is only printed when the validation is waited on
+                validation = BIDSValidation(bids_dir,cache_file)
+                with redirect_stdout(io.StringIO()) as output:
+                    validation.run()
+                self.assertEqual(output.getvalue(),'')
+                with redirect_stdout(io.StringIO()) as output:
+                    validation.wait()
+                self.assertIn('no files changed',output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()